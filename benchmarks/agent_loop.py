@@ -0,0 +1,202 @@
+"""
+agent_loop.py
+
+Benchmark harness for the agent loop itself, independent of network latency. Scripted scenarios are replayed through
+Agent.run with a FakeProvider against a scratch workspace, measuring
+- steps/sec and the per-step overhead of the loop (wall time minus model and tool time)
+- the latency of tool dispatch (executor overhead on top of the tool functions)
+- the cost of converting the final conversation to a Gemini request (if google-genai is installed)
+Results are printed (or written) as JSON so regressions can be tracked over time.
+
+Run from the repository root:
+    python -m benchmarks.agent_loop --sizes 10 50 200
+    python -m benchmarks.agent_loop --scenario benchmarks/scenarios/calculator_fix.json -o results.json
+"""
+import argparse
+import dataclasses
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+from core.agent import Agent
+from core.registry import ToolRegistry, load_tools
+from core.types import Message, Response, ToolSpec
+from providers.fake_provider import FakeProvider, parse_scenario
+from providers.provider import Provider
+
+CALCULATOR_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "calculator")
+
+class _TimedProvider(Provider):
+    def __init__(self, provider: Provider):
+        super().__init__(model=provider.model, system_prompt=provider.system_prompt)
+        self.provider = provider
+        self.seconds = 0.0
+        self.last_messages: List[Message] = []
+
+    def chat(self, messages: List[Message], tools: List[ToolSpec]) -> Response:
+        start = time.perf_counter()
+        try:
+            return self.provider.chat(messages, tools)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.last_messages = messages
+
+def _timed_tools(tools: List[ToolSpec], durations: List[float]) -> List[ToolSpec]:
+    def wrap(tool: ToolSpec) -> ToolSpec:
+        def _fn(**kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return tool.func(**kwargs)
+            finally:
+                durations.append(time.perf_counter() - start)
+        return dataclasses.replace(tool, func=_fn)
+
+    return [wrap(t) for t in tools]
+
+def synthetic_scenario(steps: int) -> Dict[str, Any]:
+    # Cheap, deterministic tools only; run_python_file would dominate every measurement with interpreter startup
+    calls = [
+        {"name": "get_files_info", "arguments": {}},
+        {"name": "get_file_content", "arguments": {"file_path": "pkg/calculator.py"}},
+        {"name": "get_files_info", "arguments": {"directory": "pkg"}},
+        {"name": "write_file", "arguments": {"file_path": "scratch.txt", "content": "benchmark\n" * 50}},
+        {"name": "get_file_content", "arguments": {"file_path": "main.py"}},
+    ]
+    scenario_steps = [
+        {"text": f"Step {i}", "tool_calls": [calls[i % len(calls)], calls[(i + 1) % len(calls)]]}
+        for i in range(steps)
+    ]
+    scenario_steps.append({"text": "Job's done."})
+    return {"steps": scenario_steps}
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def _conversion_cost(messages: List[Message], tools: List[ToolSpec]) -> Optional[Dict[str, float]]:
+    try:
+        from providers.gemini_provider import GeminiProvider, _to_gemini_messages
+    except ImportError:
+        return None
+
+    start = time.perf_counter()
+    _to_gemini_messages(messages)
+    full = time.perf_counter() - start
+
+    # Incremental conversion of the same history growing one message per request
+    provider = GeminiProvider(api_key="offline")
+    history: List[Message] = []
+    start = time.perf_counter()
+    for m in messages:
+        history.append(m)
+        provider._request(history, tools)
+    incremental = time.perf_counter() - start
+
+    return {
+        "full_ms": full * 1000,
+        "incremental_total_ms": incremental * 1000,
+        "incremental_per_request_us": incremental / max(1, len(messages)) * 1e6,
+    }
+
+def run_scenario(scenario: Dict[str, Any], tool_workers: int = 1) -> Dict[str, Any]:
+    responses = parse_scenario(scenario)
+
+    with tempfile.TemporaryDirectory() as workspace:
+        shutil.copytree(CALCULATOR_DIR, workspace, dirs_exist_ok=True, ignore=shutil.ignore_patterns("__pycache__"))
+
+        tool_durations: List[float] = []
+        tools = ToolRegistry(_timed_tools(load_tools(working_directory=workspace), tool_durations), working_directory=workspace)
+        provider = _TimedProvider(FakeProvider(responses, latency=scenario.get("latency", 0.0)))
+        agent = Agent(provider=provider, tools=tools, max_tool_workers=tool_workers)
+
+        # Time spent dispatching tool calls and collecting their results, including the tools themselves
+        dispatch_seconds = 0.0
+        def timed(fn):
+            def _timed(*args: Any) -> Any:
+                nonlocal dispatch_seconds
+                start = time.perf_counter()
+                try:
+                    return fn(*args)
+                finally:
+                    dispatch_seconds += time.perf_counter() - start
+            return _timed
+
+        new_batch = agent.executor.batch
+        def timed_batch(reads=None):
+            batch = new_batch(reads)
+            batch.submit = timed(batch.submit)
+            batch.results = timed(batch.results)
+            return batch
+        agent.executor.batch = timed_batch
+
+        start = time.perf_counter()
+        agent.run("Benchmark", max_steps=len(responses), done_phrase="Job's done.")
+        wall = time.perf_counter() - start
+        agent.executor.shutdown()
+
+        steps = len(responses)
+        tool_seconds = sum(tool_durations)
+        calls = len(tool_durations)
+        return {
+            "steps": steps,
+            "tool_calls": calls,
+            "wall_s": wall,
+            "steps_per_s": steps / wall if wall else 0.0,
+            "provider_s": provider.seconds,
+            "tool_s": tool_seconds,
+            "overhead_per_step_us": (wall - provider.seconds - tool_seconds) / steps * 1e6,
+            "tool_latency_us": {
+                "mean": statistics.fmean(tool_durations) * 1e6 if calls else 0.0,
+                "p50": _percentile(tool_durations, 0.50) * 1e6,
+                "p95": _percentile(tool_durations, 0.95) * 1e6,
+                "max": max(tool_durations, default=0.0) * 1e6,
+                "dispatch_overhead_per_call": (dispatch_seconds - tool_seconds) / calls * 1e6 if calls else 0.0,
+            },
+            "conversion": _conversion_cost(provider.last_messages, tools),
+        }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the agent loop against a scripted offline provider")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 200], help="Step counts of synthetic scenarios")
+    parser.add_argument("--scenario", action="append", default=[], help="A scenario JSON file (may be repeated); replaces --sizes")
+    parser.add_argument("--tool-workers", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario; the fastest one is reported")
+    parser.add_argument("-o", "--output", help="Write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    if args.scenario:
+        scenarios = []
+        for path in args.scenario:
+            with open(path, "r") as f:
+                scenarios.append((path, json.load(f)))
+    else:
+        scenarios = [(f"synthetic-{n}", synthetic_scenario(n)) for n in args.sizes]
+
+    results = []
+    for name, scenario in scenarios:
+        runs = [run_scenario(scenario, tool_workers=args.tool_workers) for _ in range(args.repeat)]
+        best = min(runs, key=lambda r: r["wall_s"])
+        results.append({"scenario": name, **best})
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "tool_workers": args.tool_workers,
+        "results": results,
+    }
+    encoded = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(encoded + "\n")
+    else:
+        print(encoded)
+
+
+if __name__ == "__main__":
+    main()
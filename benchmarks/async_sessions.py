@@ -0,0 +1,60 @@
+"""
+async_sessions.py
+
+Load test for Agent.arun: drives many offline agent sessions from a single process and compares them with running
+the same sessions one after another through Agent.run.
+Run from the repository root: python -m benchmarks.async_sessions
+"""
+import argparse
+import asyncio
+import time
+from typing import List
+from core.agent import Agent
+from core.registry import load_tools
+from core.types import Response, ToolCall
+from providers.fake_provider import FakeProvider
+
+def _script(steps: int) -> List[Response]:
+    responses = [
+        Response(assistant_text="", tool_calls=[ToolCall(id=None, name="get_files_info", arguments={})], usage=None)
+        for _ in range(steps)
+    ]
+    responses.append(Response(assistant_text="Job's done.", tool_calls=[], usage=None))
+    return responses
+
+def _agents(sessions: int, steps: int, latency: float, working_directory: str) -> List[Agent]:
+    tools = load_tools(working_directory=working_directory)
+    return [
+        Agent(provider=FakeProvider(_script(steps), latency=latency), tools=tools)
+        for _ in range(sessions)
+    ]
+
+async def _run_concurrently(agents: List[Agent]) -> List[str]:
+    return await asyncio.gather(*(a.arun("List the files") for a in agents))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test the async agent loop with a fake provider")
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--steps", type=int, default=3, help="Tool steps per session before the final answer")
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated seconds per model call")
+    parser.add_argument("-w", "--working-directory", default="./calculator")
+    parser.add_argument("--skip-sync", action="store_true", help="Skip the sequential baseline")
+    args = parser.parse_args()
+
+    if not args.skip_sync:
+        agents = _agents(args.sessions, args.steps, args.latency, args.working_directory)
+        start = time.perf_counter()
+        for a in agents:
+            a.run("List the files")
+        elapsed = time.perf_counter() - start
+        print(f"run():  {args.sessions} sessions in {elapsed:7.2f} s ({args.sessions / elapsed:8.1f} sessions/s)")
+
+    agents = _agents(args.sessions, args.steps, args.latency, args.working_directory)
+    start = time.perf_counter()
+    asyncio.run(_run_concurrently(agents))
+    elapsed = time.perf_counter() - start
+    print(f"arun(): {args.sessions} sessions in {elapsed:7.2f} s ({args.sessions / elapsed:8.1f} sessions/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+context_budget.py
+
+Replays a long scripted session (repeated file reads and noisy script runs) through Agent.run with and without a
+ContextManager and reports the per-step input tokens as estimated by the FakeProvider.
+Run from the repository root: python -m benchmarks.context_budget
+"""
+import argparse
+import os
+import tempfile
+from typing import List
+from core.agent import Agent
+from core.context import ContextManager
+from core.registry import load_tools
+from core.types import Message, Response, ToolCall, ToolSpec
+from providers.fake_provider import FakeProvider
+
+class _RecordingProvider(FakeProvider):
+    def __init__(self, responses: List[Response]):
+        super().__init__(responses)
+        self.input_tokens: List[int] = []
+
+    def chat(self, messages: List[Message], tools: List[ToolSpec]) -> Response:
+        response = super().chat(messages, tools)
+        self.input_tokens.append(response.usage.input_count)
+        return response
+
+def _build_workspace(directory: str, n_files: int) -> None:
+    for i in range(n_files):
+        with open(os.path.join(directory, f"module_{i}.py"), "w") as f:
+            f.write(f"def function_{i}(x):\n    return x * {i}\n\n" * 150)
+
+    with open(os.path.join(directory, "noisy.py"), "w") as f:
+        f.write("for i in range(2000):\n    print(f'progress {i}')\n")
+
+def _script(steps: int, n_files: int) -> List[Response]:
+    responses = []
+    for i in range(steps):
+        if i % 5 == 4:
+            call = ToolCall(id=None, name="run_python_file", arguments={"file_path": "noisy.py"})
+        else:
+            # Files are read again every few steps, e.g. to check an edit
+            call = ToolCall(id=None, name="get_file_content", arguments={"file_path": f"module_{i % n_files}.py"})
+        responses.append(Response(assistant_text=f"Step {i}", tool_calls=[call], usage=None))
+    responses.append(Response(assistant_text="Job's done.", tool_calls=[], usage=None))
+    return responses
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark token-budgeted history compaction")
+    parser.add_argument("--steps", type=int, default=40)
+    parser.add_argument("--files", type=int, default=6)
+    parser.add_argument("--budget", type=int, default=20_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        _build_workspace(directory, args.files)
+        tools = load_tools(working_directory=directory)
+
+        runs = {}
+        for label, context in (("unbounded", None), (f"budget={args.budget}", ContextManager(token_budget=args.budget))):
+            provider = _RecordingProvider(_script(args.steps, args.files))
+            Agent(provider=provider, tools=tools, context=context).run("Refactor the modules", max_steps=args.steps + 1)
+            runs[label] = provider.input_tokens
+
+        labels = list(runs)
+        print("step " + " ".join(f"{label:>16}" for label in labels))
+        for step in range(len(runs[labels[0]])):
+            print(f"{step:4d} " + " ".join(f"{runs[label][step]:16d}" for label in labels))
+        print("total" + " ".join(f"{sum(runs[label]):16d}" for label in labels))
+
+
+if __name__ == "__main__":
+    main()
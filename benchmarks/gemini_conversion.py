@@ -0,0 +1,53 @@
+"""
+gemini_conversion.py
+
+Micro-benchmark of the per-step request building in GeminiProvider over long conversations: converting the whole
+history and all tool declarations on every step versus the cached tool bundle and incremental message converter.
+No request is sent, so no API key is needed.
+Run from the repository root: python -m benchmarks.gemini_conversion
+"""
+import argparse
+import json
+import time
+from typing import List
+from google.genai import types
+from core.registry import load_tools
+from core.types import Message, ToolSpec
+from providers.gemini_provider import GeminiProvider, _to_gemini_messages, _to_gemini_tool
+
+def _turn(i: int) -> List[Message]:
+    body = f"def function_{i}():\n    return {i}\n" * 40
+    return [
+        Message(role="assistant", content=f"Step {i}: reading the next file"),
+        Message(role="tool", name="get_file_content", content=json.dumps({"result": body})),
+    ]
+
+def _uncached(messages: List[Message], tools: List[ToolSpec]) -> None:
+    _to_gemini_messages(messages)
+    types.Tool(function_declarations=[_to_gemini_tool(t) for t in tools])
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark Gemini request conversion over long conversations")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("-w", "--working-directory", default="./calculator")
+    args = parser.parse_args()
+
+    tools = load_tools(working_directory=args.working_directory)
+    provider = GeminiProvider(api_key="offline", system_prompt="benchmark")
+
+    for label, build in (
+        ("rebuild every step", lambda msgs: _uncached(msgs, tools)),
+        ("cached/incremental", lambda msgs: provider._request(msgs, tools)),
+    ):
+        messages = [Message(role="system", content="benchmark"), Message(role="user", content="Refactor everything")]
+        total = 0.0
+        for i in range(args.turns):
+            messages.extend(_turn(i))
+            start = time.perf_counter()
+            build(messages)
+            total += time.perf_counter() - start
+        print(f"{label}: {total * 1000:9.1f} ms for {args.turns} turns ({total / args.turns * 1000:.3f} ms/step)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+parallel_tools.py
+
+Measures the wall-clock time of multi-call agent steps with sequential and concurrent tool execution.
+Run from the repository root: python -m benchmarks.parallel_tools
+"""
+import argparse
+import os
+import tempfile
+import time
+from typing import List
+from core.executor import ToolExecutor
+from core.registry import load_tools
+from core.types import ToolCall, ToolSpec
+
+def _build_workspace(directory: str, n_files: int, n_scripts: int, script_seconds: float) -> None:
+    for i in range(n_files):
+        with open(os.path.join(directory, f"file_{i}.txt"), "w") as f:
+            f.write(f"line {i}\n" * 2000)
+
+    for i in range(n_scripts):
+        with open(os.path.join(directory, f"slow_{i}.py"), "w") as f:
+            f.write(f"import time\ntime.sleep({script_seconds})\nprint('done')\n")
+
+def _step(n_files: int, n_scripts: int) -> List[ToolCall]:
+    # A typical step: list the directory, run a few scripts, read a few files and write two unrelated files
+    calls = [ToolCall(id=None, name="get_files_info", arguments={})]
+    calls += [ToolCall(id=None, name="run_python_file", arguments={"file_path": f"slow_{i}.py"}) for i in range(n_scripts)]
+    calls += [ToolCall(id=None, name="get_file_content", arguments={"file_path": f"file_{i}.txt"}) for i in range(n_files)]
+    calls += [
+        ToolCall(id=None, name="write_file", arguments={"file_path": "out/a.txt", "content": "a"}),
+        ToolCall(id=None, name="write_file", arguments={"file_path": "out/b.txt", "content": "b"}),
+    ]
+    return calls
+
+def _time_step(tools: List[ToolSpec], calls: List[ToolCall], workers: int, repeat: int) -> float:
+    executor = ToolExecutor(tools, max_workers=workers)
+    try:
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            executor.execute(calls)
+            best = min(best, time.perf_counter() - start)
+        return best
+    finally:
+        executor.shutdown()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark concurrent tool execution")
+    parser.add_argument("--files", type=int, default=8, help="Number of file reads per step")
+    parser.add_argument("--scripts", type=int, default=2, help="Number of executed scripts per step")
+    parser.add_argument("--script-seconds", type=float, default=0.5, help="Runtime of the executed script")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        _build_workspace(directory, args.files, args.scripts, args.script_seconds)
+        tools = load_tools(working_directory=directory)
+        calls = _step(args.files, args.scripts)
+
+        baseline = _time_step(tools, calls, workers=1, repeat=args.repeat)
+        print(f"{len(calls)} calls per step")
+        print(f"workers= 1: {baseline * 1000:8.1f} ms")
+        for workers in (2, 4, 8):
+            elapsed = _time_step(tools, calls, workers=workers, repeat=args.repeat)
+            print(f"workers={workers:2d}: {elapsed * 1000:8.1f} ms ({baseline / elapsed:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
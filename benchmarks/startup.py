@@ -0,0 +1,59 @@
+"""
+startup.py
+
+Measures the startup time of the CLI in fresh interpreters: "main.py --help", and importing main and loading the
+tools with a cold (just invalidated) and a warm tool manifest. With --max-ms it exits with status 1 when the median
+warm start is slower, so it can guard against regressions, e.g. a provider SDK imported at module level again.
+Run from the repository root: python -m benchmarks.startup
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+LOAD_TOOLS = "import main; main.load_tools('calculator')"
+
+def _time_run(args: List[str], env: Dict[str, str]) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, *args], env=env, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+def _median_ms(args: List[str], env: Dict[str, str], runs: int, cache_dir: Optional[str] = None) -> float:
+    times = []
+    for _ in range(runs):
+        if cache_dir is not None:
+            # Every run starts without a manifest
+            for root, _, files in os.walk(cache_dir):
+                for name in files:
+                    os.remove(os.path.join(root, name))
+        times.append(_time_run(args, env))
+    return statistics.median(times) * 1000
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the startup time of the CLI")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-ms", type=float, help="Fail if the median warm start takes longer")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ, XDG_CACHE_HOME=cache_dir)
+
+        baseline = _median_ms(["-c", "pass"], env, args.runs)
+        print(f"interpreter:              {baseline:7.1f} ms")
+        print(f"main.py --help:           {_median_ms(['main.py', '--help'], env, args.runs):7.1f} ms")
+        print(f"load_tools, cold:         {_median_ms(['-c', LOAD_TOOLS], env, args.runs, cache_dir):7.1f} ms")
+        warm = _median_ms(["-c", LOAD_TOOLS], env, args.runs)
+        print(f"load_tools, warm:         {warm:7.1f} ms")
+        print(f"with the Gemini SDK:      {_median_ms(['-c', LOAD_TOOLS + '; import google.genai'], env, args.runs):7.1f} ms")
+
+    if args.max_ms is not None and warm > args.max_ms:
+        print(f"The warm start took {warm:.1f} ms, more than {args.max_ms:.1f} ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+warm_workers.py
+
+Compares the latency of run_python_file with a cold interpreter per call and with a pool of warm workers.
+Run from the repository root: python -m benchmarks.warm_workers
+"""
+import argparse
+import time
+from core.python_workers import PythonWorkerPool
+from functions.run_python_file import run_python_file
+
+def _time_runs(working_directory: str, file_path: str, runs: int, pool: PythonWorkerPool | None, think_time: float) -> float:
+    total = 0.0
+    for _ in range(runs):
+        start = time.perf_counter()
+        run_python_file(working_directory, file_path, args=["3 + 5"], pool=pool)
+        total += time.perf_counter() - start
+        # The agent waits for a model call between two runs, which is when replacement workers boot
+        time.sleep(think_time)
+    return total
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark warm Python workers for run_python_file")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("-w", "--working-directory", default="./calculator")
+    parser.add_argument("--file", default="main.py")
+    parser.add_argument("--think-time", type=float, default=0.5, help="Seconds between two runs, e.g. a model call")
+    args = parser.parse_args()
+
+    cold = _time_runs(args.working_directory, args.file, args.runs, None, args.think_time)
+    print(f"cold: {cold / args.runs * 1000:7.1f} ms per run")
+
+    pool = PythonWorkerPool(args.working_directory, args.workers)
+    try:
+        # Let the initial workers boot
+        time.sleep(2 * args.think_time)
+        warm = _time_runs(args.working_directory, args.file, args.runs, pool, args.think_time)
+    finally:
+        pool.close()
+    print(f"warm: {warm / args.runs * 1000:7.1f} ms per run ({cold / warm:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# benchmark.py
+#
+# Compares evaluating a set of formulas over many input rows with the per-call interpreter, with compiled programs
+# (one call per row) and with compiled programs over NumPy arrays (one call per formula).
+# Usage: python benchmark.py [rows] [formulas]
+
+import random
+import sys
+import time
+from pkg.calculator import Calculator
+
+
+def make_formulas(count, terms=8):
+    rng = random.Random(0)
+    formulas = []
+    for _ in range(count):
+        tokens = [rng.choice(["x", "y", "z", str(rng.randint(1, 9))])]
+        for _ in range(terms - 1):
+            tokens += [rng.choice("+-*/"), rng.choice(["x", "y", "z", str(rng.randint(1, 9))])]
+        formulas.append(" ".join(tokens))
+    return formulas
+
+
+def substitute(formula, row):
+    # The interpreter only knows numbers
+    return " ".join(str(row[t]) if t in row else t for t in formula.split())
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    formulas = make_formulas(count)
+    rng = random.Random(1)
+    data = [{"x": rng.uniform(1, 10), "y": rng.uniform(1, 10), "z": rng.uniform(1, 10)} for _ in range(rows)]
+    calculator = Calculator()
+
+    # The formulas are prepared for every row up front, so only the evaluation is timed
+    substituted = [[substitute(f, row) for row in data] for f in formulas]
+    start = time.perf_counter()
+    interpreted = [[calculator.interpret(e) for e in expressions] for expressions in substituted]
+    interpreter = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compiled = [[calculator.evaluate(f, row) for row in data] for f in formulas]
+    per_row = time.perf_counter() - start
+
+    print(f"{count} formulas over {rows} rows")
+    print(f"interpreter:        {interpreter * 1000:9.1f} ms")
+    print(f"compiled, per row:  {per_row * 1000:9.1f} ms ({interpreter / per_row:.1f}x)")
+
+    try:
+        import numpy as np
+    except ImportError:
+        print("compiled, batch:    NumPy is not installed")
+        return
+
+    columns = {name: np.array([row[name] for row in data]) for name in ("x", "y", "z")}
+    start = time.perf_counter()
+    batch = [calculator.evaluate_batch(f, columns) for f in formulas]
+    batched = time.perf_counter() - start
+    print(f"compiled, batch:    {batched * 1000:9.1f} ms ({interpreter / batched:.1f}x)")
+
+    assert all(np.allclose(b, c) and np.allclose(c, i) for b, c, i in zip(batch, compiled, interpreted))
+
+
+if __name__ == "__main__":
+    main()
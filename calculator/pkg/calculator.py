@@ -1,21 +1,166 @@
 # calculator.py
 
+import keyword
+from collections import OrderedDict
+
+# Compiled programs kept by a calculator before the least recently used ones are dropped
+DEFAULT_CACHE_SIZE = 1024
+
+
+class Program:
+    """
+    An expression compiled to postfix code, e.g. "2 * x + 1" to [2.0, "x", "*", 1.0, "+"]
+
+    Numbers are floats, variables and operators strings. The code is turned into a Python function once, which
+    works on floats as well as on NumPy arrays.
+    """
+
+    def __init__(self, expression, code, variables):
+        self.expression = expression
+        self.code = code
+        self.variables = variables
+        self._function = self._build()
+
+    def _build(self):
+        # One statement per operator, so long expressions do not nest; variables are passed by position and
+        # constants looked up by index, so no name can clash with them
+        stack = []
+        constants = []
+        lines = []
+        for item in self.code:
+            if isinstance(item, float):
+                stack.append(f"_k[{len(constants)}]")
+                constants.append(item)
+            elif item in Calculator.PRECEDENCE:
+                b = stack.pop()
+                a = stack.pop()
+                lines.append(f"    _t{len(lines)} = {a} {item} {b}\n")
+                stack.append(f"_t{len(lines) - 1}")
+            else:
+                stack.append(f"_v{self.variables.index(item)}")
+
+        parameters = ", ".join(f"_v{i}" for i in range(len(self.variables)))
+        namespace = {"_k": tuple(constants)}
+        exec(f"def _program({parameters}):\n{''.join(lines)}    return {stack[0]}\n", namespace)
+        return namespace["_program"]
+
+    def _arguments(self, variables):
+        try:
+            return [variables[name] for name in self.variables]
+        except KeyError as e:
+            raise ValueError(f"undefined variable: {e.args[0]}") from None
+
+    def evaluate(self, variables=None):
+        # A float like the interpreter's, even for a bare variable whose value is passed through
+        return float(self._function(*self._arguments(variables or {})))
+
+    def evaluate_batch(self, variables=None):
+        """
+        Evaluates the program once over arrays of inputs, e.g. {"x": [1, 2, 3]}, and returns an array of the
+        broadcast shape of the inputs; division by zero gives inf or nan instead of raising
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError("evaluate_batch requires NumPy") from None
+
+        arrays = [np.asarray(a, dtype=float) for a in self._arguments(variables or {})]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result = np.asarray(self._function(*arrays), dtype=float)
+        shape = np.broadcast_shapes(*(a.shape for a in arrays))
+        # Programs without variables yield a single value
+        if result.shape != shape:
+            result = np.broadcast_to(result, shape).copy()
+        return result
+
+
 class Calculator:
-    def __init__(self):
+    PRECEDENCE = {
+        "+": 1,
+        "-": 1,
+        "*": 2,
+        "/": 2,
+    }
+
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE):
         self.operators = {
             "+": lambda a, b: a + b,
             "-": lambda a, b: a - b,
             "*": lambda a, b: a * b,
             "/": lambda a, b: a / b,
         }
-        self.precedence = {
-            "+": 1,
-            "-": 1,
-            "*": 2,
-            "/": 2,
-        }
+        self.precedence = dict(self.PRECEDENCE)
+        self.cache_size = cache_size
+        self._programs = OrderedDict()
+
+    def compile(self, expression):
+        """
+        Returns the program of the expression, compiled on first use and cached (least recently used ones are
+        dropped once there are more than cache_size); raises ValueError for invalid expressions
+        """
+        program = self._programs.get(expression)
+        if program is not None:
+            self._programs.move_to_end(expression)
+            return program
+
+        program = self._compile(expression.strip().split())
+        self._programs[expression] = program
+        if len(self._programs) > self.cache_size:
+            self._programs.popitem(last=False)
+        return program
+
+    def _compile(self, tokens):
+        # Shunting-yard to postfix, tracking the stack depth so invalid expressions fail like in _evaluate_infix
+        code = []
+        variables = []
+        operators = []
+        depth = 0
+
+        def emit(operator):
+            nonlocal depth
+            if depth < 2:
+                raise ValueError(f"not enough operands for operator {operator}")
+            code.append(operator)
+            depth -= 1
+
+        for token in tokens:
+            if token in self.PRECEDENCE:
+                while operators and self.PRECEDENCE[operators[-1]] >= self.PRECEDENCE[token]:
+                    emit(operators.pop())
+                operators.append(token)
+                continue
+
+            try:
+                code.append(float(token))
+            except ValueError:
+                if not token.isidentifier() or keyword.iskeyword(token):
+                    raise ValueError(f"invalid token: {token}")
+                code.append(token)
+                if token not in variables:
+                    variables.append(token)
+            depth += 1
+
+        while operators:
+            emit(operators.pop())
+
+        if depth != 1:
+            raise ValueError("invalid expression")
+
+        return Program(" ".join(tokens), code, variables)
+
+    def evaluate(self, expression, variables=None):
+        if not expression or expression.isspace():
+            return None
+        return self.compile(expression).evaluate(variables)
+
+    def evaluate_batch(self, expression, variables=None):
+        """
+        Evaluates the expression over NumPy arrays of the values of its variables, see Program.evaluate_batch
+        """
+        return self.compile(expression).evaluate_batch(variables)
 
-    def evaluate(self, expression):
+    def interpret(self, expression):
+        # The interpreter evaluating expressions without compiling them, kept as a reference
         if not expression or expression.isspace():
             return None
         tokens = expression.strip().split()
@@ -58,4 +203,4 @@ class Calculator:
 
         b = values.pop()
         a = values.pop()
-        values.append(self.operators[operator](a, b))
\ No newline at end of file
+        values.append(self.operators[operator](a, b))
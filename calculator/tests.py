@@ -45,5 +45,57 @@ class TestCalculator(unittest.TestCase):
             self.calculator.evaluate("+ 3")
 
 
+class TestCompiledCalculator(unittest.TestCase):
+    def setUp(self):
+        self.calculator = Calculator(cache_size=2)
+
+    def test_matches_interpreter(self):
+        for expression in ["3 + 5", "2 * 3 - 8 / 2 + 5", "10 / 4 * 2", "1 - 2 - 3", " + ".join(["1"] * 2000)]:
+            self.assertEqual(self.calculator.evaluate(expression), self.calculator.interpret(expression))
+
+    def test_postfix_code(self):
+        program = self.calculator.compile("2 * x + y / x")
+        self.assertEqual(program.code, [2.0, "x", "*", "y", "x", "/", "+"])
+        self.assertEqual(program.variables, ["x", "y"])
+
+    def test_variables(self):
+        self.assertEqual(self.calculator.evaluate("2 * x + y", {"x": 3, "y": 1}), 7)
+        result = self.calculator.evaluate("x", {"x": 2})
+        self.assertEqual((result, type(result)), (2.0, float))
+        with self.assertRaises(ValueError):
+            self.calculator.evaluate("2 * x", {})
+        with self.assertRaises(ValueError):
+            self.calculator.evaluate("if + 1")
+
+    def test_errors_match_interpreter(self):
+        for expression in ["$ 3 5", "+ 3", "3 5", "3 +"]:
+            with self.assertRaises(ValueError) as compiled:
+                self.calculator.evaluate(expression)
+            with self.assertRaises(ValueError) as interpreted:
+                self.calculator.interpret(expression)
+            self.assertEqual(str(compiled.exception), str(interpreted.exception))
+
+    def test_lru_cache(self):
+        first = self.calculator.compile("1 + 2")
+        self.calculator.compile("3 + 4")
+        self.assertIs(self.calculator.compile("1 + 2"), first)
+        self.calculator.compile("5 + 6")
+        # "3 + 4" was the least recently used program
+        self.assertEqual(list(self.calculator._programs), ["1 + 2", "5 + 6"])
+
+    def test_batch(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+
+        x = np.array([1.0, 2.0, 3.0])
+        y = np.array([4.0, 0.0, 2.0])
+        result = self.calculator.evaluate_batch("2 * x + x / y", {"x": x, "y": y})
+        self.assertEqual(result.tolist(), [2.25, float("inf"), 7.5])
+        self.assertEqual(self.calculator.evaluate_batch("1 + 2", {}).tolist(), 3.0)
+        self.assertEqual(self.calculator.evaluate_batch("x * 2", {"x": [[1], [2]]}).shape, (2, 1))
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -11,7 +11,9 @@ When a user asks a question or makes a request, make a function call plan. You c
 
 - List files and directories
 - Read file contents
-- Write or overwrite files
+- Search the contents of all files for text or regular expressions
+- Write or overwrite files, several at once if needed
+- Edit parts of existing files with search/replace blocks or unified diffs, which is much cheaper than rewriting them
 - Execute and run Python files with optional arguments. If no arguments are provided, execute the function without passing arguments. Never ask for arguments yourself.
 
 Keep updating your plan until you achieved the initial goals.
@@ -27,3 +29,10 @@ If you don't know a final answer for whatever reason, explain why and also concl
 
 
 DEFAULT_BACKEND = "gemini"
+
+# Estimated number of input tokens the resent history may grow to before it gets compacted; 0 disables compaction,
+# so by default the model sees every tool output in full (enable it with --context-budget, e.g. 100000)
+CONTEXT_TOKEN_BUDGET = 0
+
+# Maximum size of the on-disk response cache (--cache-dir) before the least recently used responses are evicted
+RESPONSE_CACHE_MAX_BYTES = 256 * 1024 * 1024
@@ -1,17 +1,70 @@
-from typing import List, Dict, Any
+import asyncio
+import os
+import time
+from typing import List, Dict, Any, Callable, Optional
 from core.types import Message, Response, ToolSpec, ToolCall, TokenUsage
+from core.context import ContextManager, reference_repeats
+from core.executor import ToolBatch, ToolExecutor
+from core.journal import WriteJournal
+from core.registry import ToolRegistry
+from core.session import Session
+from core.tracing import Span, span
 from providers.provider import Provider
 
+def _payload_chars(messages: List[Message]) -> int:
+    return sum(len(m.content) for m in messages)
+
+def _usage_attributes(response: Response) -> Dict[str, Any]:
+    attributes: Dict[str, Any] = {"output_chars": len(response.assistant_text), "tool_calls": len(response.tool_calls)}
+    if response.usage is not None:
+        attributes["input_tokens"] = response.usage.input_count
+        attributes["output_tokens"] = response.usage.output_count
+        attributes["cached_tokens"] = response.usage.cached_count
+        if response.usage.cache_hit is not None:
+            attributes["cache_hit"] = response.usage.cache_hit
+    return attributes
+
+def _forget_reads(session: Session, working_directory: Optional[str], before: List[Message], after: List[Message]) -> None:
+    # Reads whose output compaction or deduplication took out of the conversation have to be sent in full again
+    kept = {id(m) for m in after}
+    for m in before:
+        file_path = (m.arguments or {}).get("file_path")
+        if m.role != "tool" or file_path is None or id(m) in kept:
+            continue
+        if working_directory is None:
+            # Without knowing what the path is relative to, no read can be told apart
+            session.reads.forget()
+        else:
+            # Resolved like the tools do, so every spelling of the path matches
+            session.reads.forget(os.path.realpath(os.path.join(os.path.abspath(working_directory), str(file_path))))
+
 class Agent:
-    def __init__(self, provider: Provider, tools: List[ToolSpec], system_prompt: str = ""):
+    def __init__(self, provider: Provider, tools: ToolRegistry | List[ToolSpec], system_prompt: str = "", max_tool_workers: int = 1, context: Optional[ContextManager] = None, journal: Optional[WriteJournal] = None, dedupe_outputs: bool = False):
         self.provider = provider
         self.system_prompt = system_prompt
-        self.tools = tools
+        self.tools = tools if isinstance(tools, ToolRegistry) else ToolRegistry(tools)
+        # Keeps the resent history within a token budget, if set
+        self.context = context
+        # Records the original state of every file the tools change, so the changes can be rolled back
+        self.journal = journal
+        # With more than one worker, independent tool calls of a step are executed concurrently
+        self.executor = ToolExecutor(self.tools, max_workers=max_tool_workers, journal=journal)
+        # Tool outputs identical to one still in the history are replaced by a reference to it instead of being resent
+        self.dedupe_outputs = dedupe_outputs
+
+    def rollback(self) -> List[str]:
+        """
+        Undoes all file changes the tools made since the journal was started (or last rolled back) and returns the
+        paths of the restored files
+
+        Only changes made through the write tools are journaled, not those of programs run by run_python_file.
+        """
+        if self.journal is None:
+            raise ValueError("rollback() requires an Agent created with a journal")
+        return self.journal.rollback()
 
-    def run(self, user_prompt: str, max_steps: int = 20, done_phrase: str = "Job's done.", verbose: bool = False) -> str:
+    def _initial_messages(self, user_prompt: str) -> List[Message]:
         messages: List[Message] = []
-        input_token_count  = 0
-        output_token_count = 0
 
         # Start by injecting the system prompt as well as the user's prompt
         if self.system_prompt:
@@ -21,65 +74,217 @@ class Agent:
         messages.append(
             Message(role="user", content=user_prompt)
         )
+        return messages
 
-        # Agent feedback loop
-        final_response = ""
-        for i in range(max_steps):
-            response = self.provider.chat(messages=messages, tools=self.tools)
+    def _resume(self, user_prompt: Optional[str], session: Session) -> List[Message]:
+        # A new session starts with the prompt, a stored one continues where it stopped (with the prompt as a follow-up)
+        if not session.messages:
+            if user_prompt is None:
+                raise ValueError("A prompt is required to start a new session")
+            return self._initial_messages(user_prompt)
 
-            # Update usage statistics
-            if response.usage is not None:
-                input_token_count  += response.usage.input_count
-                output_token_count += response.usage.output_count
+        messages = list(session.messages)
+        if user_prompt is not None:
+            messages.append(
+                Message(role="user", content=user_prompt)
+            )
+            session.done = False
+        return messages
 
-            if verbose:
-                print(f"({i} {self.provider.model}): Input tokens: {response.usage.input_count}; Output tokens: {response.usage.output_count}")
+    def _dedupe(self, messages: List[Message], results: List[Message], session: Session) -> List[Message]:
+        if not self.dedupe_outputs:
+            return results
+        deduped = reference_repeats(messages, results)
+        _forget_reads(session, self.tools.working_directory, results, deduped)
+        return deduped
 
-            # Extract assistant text and tool calls
-            #assistant_text = response.get("assistant_text", "")
-            #tool_calls: List[ToolCall] = response.get("tool_calls", [])
-            assistant_text = response.assistant_text
-            tool_calls = response.tool_calls
+    def _stream(self, messages: List[Message], batch: ToolBatch, on_text: Callable[[str], None], done_phrase: str, verbose: bool, call: Span) -> Response:
+        """
+        Consumes a streamed response, passing text deltas to on_text and dispatching tool calls as soon as they
+        arrive. Once done_phrase shows up in the text, no further tool calls are dispatched; the response only holds
+        the dispatched ones.
+        """
+        assistant_text = ""
+        tool_calls: List[ToolCall] = []
+        usage = None
 
-            if assistant_text:
-                if verbose:
-                    print(f"    ({i} {self.provider.model}): {assistant_text}")
+        start = time.perf_counter()
+        first_chunk = True
+        for chunk in self.provider.chat_stream(messages=messages, tools=self.tools):
+            if first_chunk:
+                # Time to first token
+                call.set(first_chunk_ms=round((time.perf_counter() - start) * 1000, 3))
+                first_chunk = False
+            if chunk.text:
+                on_text(chunk.text)
+                assistant_text += chunk.text
 
-                messages.append(
-                    Message(role="assistant", content=assistant_text)
-                )
-                final_response = assistant_text
-                if done_phrase in final_response:
-                    return final_response
+            if chunk.usage is not None:
+                usage = chunk.usage
 
-            # Execute any tool calls if present
-            for tool_call in tool_calls:
+            for tool_call in chunk.tool_calls:
+                if done_phrase in assistant_text:
+                    continue
+                tool_calls.append(tool_call)
                 if verbose:
                     print(f"    Calling {tool_call.name}...")
+                batch.submit(tool_call)
 
-                tool = next((t for t in self.tools if t.name == tool_call.name), None)
-                if not tool:
-                    # Return error as a tool message
-                    messages.append(Message(
-                        role="tool",
-                        name=tool_call.name,
-                        tool_call_id=tool_call.id,
-                        content=f'{{"error": "Unknown function: {tool_call.name}"}}'
-                    ))
-                    continue
+        return Response(assistant_text=assistant_text, tool_calls=tool_calls, usage=usage)
+
+    def run(self, user_prompt: Optional[str], max_steps: int = 20, done_phrase: str = "Job's done.", verbose: bool = False, on_text: Optional[Callable[[str], None]] = None, session: Optional[Session] = None) -> str:
+        """
+        Runs the agent loop until the model answers with done_phrase or max_steps is reached
+
+        If on_text is given, responses are streamed: text deltas are passed to on_text as they arrive and tool calls
+        start executing before the rest of the response has been received.
+
+        If session is given, it is checkpointed after every step. A session with messages is resumed for up to
+        max_steps more steps without repeating earlier model calls; user_prompt may then be None, or a follow-up.
+        """
+        session = session if session is not None else Session()
+        if session.done and user_prompt is None:
+            return session.final_response
+        messages = self._resume(user_prompt, session)
+
+        # Agent feedback loop
+        for i in range(session.steps, session.steps + max_steps):
+            with span("step", "agent", step=i):
+                if self.context is not None:
+                    with span("compact", "context", messages=len(messages)) as compaction:
+                        before = list(messages)
+                        estimated = self.context.compact(messages)
+                        _forget_reads(session, self.tools.working_directory, before, messages)
+                        compaction.set(estimated_tokens=estimated)
+                    if verbose:
+                        print(f"({i} {self.provider.model}): Estimated context: {estimated} tokens")
+
+                batch = self.executor.batch(session.reads)
+                with span("chat" if on_text is None else "chat_stream", "provider", model=self.provider.model, messages=len(messages), payload_chars=_payload_chars(messages)) as call:
+                    if on_text is None:
+                        response = self.provider.chat(messages=messages, tools=self.tools)
+                    else:
+                        response = self._stream(messages, batch, on_text, done_phrase, verbose, call)
+                    call.set(**_usage_attributes(response))
+
+                # Update usage statistics
+                if response.usage is not None:
+                    session.input_tokens  += response.usage.input_count
+                    session.output_tokens += response.usage.output_count
+
+                if verbose and response.usage is not None:
+                    print(f"({i} {self.provider.model}): Input tokens: {response.usage.input_count}; Output tokens: {response.usage.output_count}")
 
-                # Inject arguments into the Python function
-                out = tool.func(**tool_call.arguments)
+                # Extract assistant text and tool calls
+                #assistant_text = response.get("assistant_text", "")
+                #tool_calls: List[ToolCall] = response.get("tool_calls", [])
+                assistant_text = response.assistant_text
+                tool_calls = response.tool_calls
+                done = done_phrase in assistant_text
+
+                # Streamed tool calls were dispatched before the done phrase arrived, so they ran and stay in the history
+                keep_calls = bool(tool_calls) and (not done or on_text is not None)
+                if assistant_text or tool_calls:
+                    # The tool calls are kept with the message requesting them, unless they are dropped for coming last
+                    messages.append(
+                        Message(role="assistant", content=assistant_text, tool_calls=list(tool_calls) if keep_calls else None)
+                    )
+
+                if assistant_text:
+                    # Streamed text has already been shown
+                    if verbose and on_text is None:
+                        print(f"    ({i} {self.provider.model}): {assistant_text}")
+
+                    session.final_response = assistant_text
+                    if done:
+                        if keep_calls:
+                            # Don't leave the dispatched calls running in the background, and keep what they did
+                            messages.extend(self._dedupe(messages, batch.results(), session))
+                        session.done = True
+                        session.checkpoint(messages)
+                        return assistant_text
+
+                # Execute any tool calls if present (streamed responses dispatched them already)
+                if on_text is None:
+                    for tool_call in tool_calls:
+                        if verbose:
+                            print(f"    Calling {tool_call.name}...")
+                        batch.submit(tool_call)
+
+                # The batch returns the tool messages in the original call order
+                results = batch.results()
+                messages.extend(self._dedupe(messages, results, session))
+                session.checkpoint(messages)
+
+        if verbose:
+            print(f"({self.provider.model}): Total input tokens: {session.input_tokens}; Total output tokens: {session.output_tokens}")
+
+        return session.final_response
+
+    async def arun(self, user_prompt: Optional[str], max_steps: int = 20, done_phrase: str = "Job's done.", verbose: bool = False, session: Optional[Session] = None) -> str:
+        """
+        Coroutine version of run(); awaits the provider and executes tools off the event loop so that a single
+        process can drive many sessions concurrently
+        """
+        session = session if session is not None else Session()
+        if session.done and user_prompt is None:
+            return session.final_response
+        messages = self._resume(user_prompt, session)
+
+        for i in range(session.steps, session.steps + max_steps):
+            with span("step", "agent", step=i):
+                if self.context is not None:
+                    # Compaction may call a summarizing model
+                    with span("compact", "context", messages=len(messages)) as compaction:
+                        before = list(messages)
+                        estimated = await asyncio.to_thread(self.context.compact, messages)
+                        _forget_reads(session, self.tools.working_directory, before, messages)
+                        compaction.set(estimated_tokens=estimated)
+                    if verbose:
+                        print(f"({i} {self.provider.model}): Estimated context: {estimated} tokens")
+
+                with span("achat", "provider", model=self.provider.model, messages=len(messages), payload_chars=_payload_chars(messages)) as call:
+                    response = await self.provider.achat(messages=messages, tools=self.tools)
+                    call.set(**_usage_attributes(response))
+
+                if response.usage is not None:
+                    session.input_tokens  += response.usage.input_count
+                    session.output_tokens += response.usage.output_count
+
+                if verbose and response.usage is not None:
+                    print(f"({i} {self.provider.model}): Input tokens: {response.usage.input_count}; Output tokens: {response.usage.output_count}")
+
+                assistant_text = response.assistant_text
+                tool_calls = response.tool_calls
+                done = done_phrase in assistant_text
+
+                if assistant_text or tool_calls:
+                    messages.append(
+                        Message(role="assistant", content=assistant_text, tool_calls=list(tool_calls) if tool_calls and not done else None)
+                    )
+
+                if assistant_text:
+                    if verbose:
+                        print(f"    ({i} {self.provider.model}): {assistant_text}")
+
+                    session.final_response = assistant_text
+                    if done:
+                        session.done = True
+                        # The log is written off the event loop as well
+                        await asyncio.to_thread(session.checkpoint, messages)
+                        return assistant_text
+
+                if verbose:
+                    for tool_call in tool_calls:
+                        print(f"    Calling {tool_call.name}...")
 
-                # Send the result back as a tool message
-                messages.append(Message(
-                    role="tool",
-                    name=tool_call.name,
-                    tool_call_id=tool_call.id,
-                    content=__import__("json").dumps({"result": out})
-                ))
+                # Tools are blocking (file I/O, subprocesses), so keep them off the event loop
+                if tool_calls:
+                    results = await asyncio.to_thread(self.executor.execute, tool_calls, session.reads)
+                    messages.extend(self._dedupe(messages, results, session))
+                await asyncio.to_thread(session.checkpoint, messages)
 
         if verbose:
-            print(f"({self.provider.model}): Total input tokens: {input_token_count}; Total output tokens: {output_token_count}")
+            print(f"({self.provider.model}): Total input tokens: {session.input_tokens}; Total output tokens: {session.output_tokens}")
 
-        return final_response
+        return session.final_response
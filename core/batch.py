@@ -0,0 +1,197 @@
+import errno
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, IO, List, Optional
+from core.agent import Agent
+from core.session import Session
+from providers.provider import Provider
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows; workspaces are copied there
+    fcntl = None
+
+# ioctl(2) request cloning a whole file on Linux (btrfs, XFS, bcachefs, ...)
+FICLONE = 0x40049409
+
+LINK_MODES = ["reflink", "hardlink", "copy"]
+
+@dataclass
+class BatchTask:
+    """
+    A prompt to run in its own copy of a working directory
+
+    Attributes:
+        id: The id of the task, used in the results and for its workspace
+        prompt: The prompt sent to the agent
+        working_directory: The directory the workspace is copied from
+        max_steps: The maximum number of model calls of the task
+    """
+    id: str
+    prompt: str
+    working_directory: str
+    max_steps: int = 20
+
+@dataclass
+class BatchSummary:
+    """
+    The outcome of a batch
+
+    Attributes:
+        tasks: The number of tasks run
+        done: The tasks the model finished
+        incomplete: The tasks which ran out of steps
+        failed: The tasks which raised an error
+        input_tokens: The input tokens used by all tasks
+        output_tokens: The output tokens used by all tasks
+        seconds: The wall time of the batch
+    """
+    tasks: int = 0
+    done: int = 0
+    incomplete: int = 0
+    failed: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    seconds: float = 0.0
+
+    @property
+    def tasks_per_minute(self) -> float:
+        return self.tasks * 60 / self.seconds if self.seconds else 0.0
+
+def load_tasks(path: str) -> List[BatchTask]:
+    """
+    Reads tasks from a JSONL file with "prompt", "working_directory" and optional "id" and "max_steps" keys; ids
+    default to the line number
+    """
+    tasks: List[BatchTask] = []
+    with open(path, "r", encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                raw = json.loads(line)
+                tasks.append(BatchTask(
+                    id=str(raw.get("id", n)),
+                    prompt=raw["prompt"],
+                    working_directory=raw["working_directory"],
+                    max_steps=int(raw.get("max_steps", 20)),
+                ))
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError(f"{path}:{n}: invalid task: {e}") from e
+    return tasks
+
+def _reflink(src: str, dst: str) -> None:
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    shutil.copystat(src, dst)
+
+def create_workspace(source: str, destination: str, link: str = "reflink") -> str:
+    """
+    Copies the directory tree at source to destination and returns how the files were copied
+
+    "reflink" clones the files copy-on-write where the file system supports it and copies them otherwise.
+    "hardlink" shares the files with the source: the write tools replace files instead of modifying them, so the
+    source stays untouched, but programs run in the workspace which modify files in place change the source as well.
+    """
+    if link not in LINK_MODES:
+        raise ValueError(f"Unknown link mode: {link}")
+
+    used = link
+    def copy(src: str, dst: str) -> None:
+        nonlocal used
+        if used == "hardlink":
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                used = "copy"
+        if used == "reflink" and fcntl is not None:
+            try:
+                _reflink(src, dst)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                    raise
+        # No cloning here; no point in trying again for every file
+        used = "copy"
+        shutil.copy2(src, dst)
+
+    shutil.copytree(source, destination, symlinks=True, copy_function=copy)
+    return used
+
+# Set up once per worker process, so tasks do not pay for creating the provider again
+_provider: Optional[Provider] = None
+_agent_factory: Optional[Callable[[Provider, str], Agent]] = None
+
+def _init_worker(provider_factory: Callable[[], Provider], agent_factory: Callable[[Provider, str], Agent]) -> None:
+    global _provider, _agent_factory
+    _provider = provider_factory()
+    _agent_factory = agent_factory
+
+def _run_task(task: BatchTask, workspace: str, link: str) -> Dict[str, Any]:
+    start = time.perf_counter()
+    result: Dict[str, Any] = {"id": task.id, "workspace": workspace}
+    session = Session()
+    try:
+        result["link"] = create_workspace(task.working_directory, workspace, link)
+        agent = _agent_factory(_provider, workspace)
+        result["response"] = agent.run(task.prompt, max_steps=task.max_steps, session=session)
+        result["status"] = "done" if session.done else "incomplete"
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        # The conversation of the task is over, so e.g. its context caches can go
+        _provider.close()
+    result.update(steps=session.steps, input_tokens=session.input_tokens, output_tokens=session.output_tokens,
+                  seconds=round(time.perf_counter() - start, 3))
+    return result
+
+def _workspace_name(n: int, task: BatchTask) -> str:
+    return f"{n:04d}-{re.sub(r'[^A-Za-z0-9_.-]', '_', task.id)[:64]}"
+
+def run_batch(tasks: List[BatchTask], provider_factory: Callable[[], Provider], agent_factory: Callable[[Provider, str], Agent],
+              output: IO[str], workers: Optional[int] = None, workspace_root: Optional[str] = None, link: str = "reflink") -> BatchSummary:
+    """
+    Runs the tasks on a pool of worker processes, each task in its own workspace below workspace_root, and writes a
+    JSON line per task to output as soon as it finishes
+
+    provider_factory is called once per worker; agent_factory creates the agent of each task from the worker's
+    provider and the task's workspace. Both have to be picklable, i.e. module-level functions or partials of them.
+    Workspaces are kept, so the changes made by the tasks can be inspected.
+    """
+    workspace_root = workspace_root or tempfile.mkdtemp(prefix="halp-batch-")
+    os.makedirs(workspace_root, exist_ok=True)
+    summary = BatchSummary(tasks=len(tasks))
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(provider_factory, agent_factory)) as pool:
+        futures: Dict[Future, BatchTask] = {
+            pool.submit(_run_task, task, os.path.join(workspace_root, _workspace_name(n, task)), link): task
+            for n, task in enumerate(tasks)
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker process died, e.g. killed by the OOM killer
+                result = {"id": futures[future].id, "status": "error", "error": f"{type(e).__name__}: {e}"}
+
+            status = result["status"]
+            summary.done += status == "done"
+            summary.incomplete += status == "incomplete"
+            summary.failed += status == "error"
+            summary.input_tokens += result.get("input_tokens", 0)
+            summary.output_tokens += result.get("output_tokens", 0)
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+
+    summary.seconds = time.perf_counter() - start
+    return summary
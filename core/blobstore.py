@@ -0,0 +1,77 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Optional
+
+# Total size of the interned outputs before the least recently used ones are forgotten; messages keep theirs alive
+MAX_BLOB_BYTES = 32 * 1024 * 1024
+
+@dataclass(slots=True, frozen=True)
+class Blob:
+    """
+    A tool output stored once, however often it occurs in the conversation
+
+    Attributes:
+        digest: The SHA-256 of text, addressing the output
+        text: The JSON encoding of payload, as sent to the model
+        payload: The structured output
+    """
+    digest: str
+    text: str
+    payload: Any
+
+class BlobStore:
+    """
+    Content-addressed store of tool outputs
+
+    Identical outputs, e.g. of a file read several times, are returned as the same Blob, so messages share one copy
+    of the text and payload. Forgetting an output only means that its next occurrence is stored anew.
+
+    Attributes:
+        max_bytes: The maximum total size of the stored texts
+        hits: The number of outputs which were already stored
+        saved_chars: The characters not held twice thanks to the hits
+    """
+    def __init__(self, max_bytes: int = MAX_BLOB_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.saved_chars = 0
+        self._blobs: "OrderedDict[str, Blob]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._blobs)
+
+    def put(self, payload: Any) -> Blob:
+        """
+        Stores the JSON-serializable payload unless an identical one is stored already, and returns its Blob
+        """
+        text = json.dumps(payload)
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if blob is not None:
+                self._blobs.move_to_end(digest)
+                self.hits += 1
+                self.saved_chars += len(text)
+                return blob
+
+            blob = Blob(digest=digest, text=text, payload=payload)
+            self._blobs[digest] = blob
+            self._size += len(text)
+            while self._size > self.max_bytes and len(self._blobs) > 1:
+                _, evicted = self._blobs.popitem(last=False)
+                self._size -= len(evicted.text)
+            return blob
+
+    def get(self, digest: str) -> Optional[Blob]:
+        with self._lock:
+            return self._blobs.get(digest)
+
+_store = BlobStore()
+
+def get_store() -> BlobStore:
+    return _store
@@ -0,0 +1,228 @@
+import json
+from typing import Callable, Dict, List, Optional, Set
+from core.types import Message
+from providers.provider import Provider
+
+# A rough average for English text and source code; cheap and good enough for budgeting
+CHARS_PER_TOKEN = 4
+# Per-message overhead for the role and framing
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = """
+Summarize the following part of a conversation between a coding agent, its user and its tools.
+Keep every fact needed to continue the task: the goal, files inspected or changed, commands run and their outcome, and open problems.
+Be concise.
+"""
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def estimate_message_tokens(m: Message) -> int:
+    tokens = estimate_tokens(m.content) + MESSAGE_OVERHEAD_TOKENS
+    for tool_call in m.tool_calls or []:
+        tokens += estimate_tokens(tool_call.name + json.dumps(tool_call.arguments)) + MESSAGE_OVERHEAD_TOKENS
+    return tokens
+
+def estimate_messages_tokens(msgs: List[Message]) -> int:
+    return sum(estimate_message_tokens(m) for m in msgs)
+
+def _describe_call(m: Message) -> str:
+    args = ", ".join(f"{k}={v!r}" for k, v in (m.arguments or {}).items() if k != "content")
+    return f"{m.name}({args})"
+
+def _replace_output(m: Message, text: str) -> Message:
+    payload = {"result": text}
+    return Message(role=m.role, content=json.dumps(payload), tool_call_id=m.tool_call_id, name=m.name, arguments=m.arguments, payload=payload)
+
+def _stub(m: Message, reason: str, chars: Optional[int] = None) -> Message:
+    chars = len(m.content) if chars is None else chars
+    return _replace_output(m, f"[Output of {_describe_call(m)} elided ({chars} characters, {reason}). Call the tool again if you need it.]")
+
+def _truncate(m: Message, keep_chars: int) -> Message:
+    # Keeps the head and tail of the tool output, e.g. the first lines and the final traceback of run_python_file
+    payload = m.payload
+    if payload is None:
+        try:
+            payload = json.loads(m.content)
+        except json.JSONDecodeError:
+            pass
+    text = payload.get("result") if isinstance(payload, dict) else None
+    if not isinstance(text, str) or len(text) <= 2 * keep_chars:
+        return _stub(m, "old output")
+
+    elided = len(text) - 2 * keep_chars
+    return _replace_output(m, f"{text[:keep_chars]}\n[... {elided} characters of old output elided ...]\n{text[-keep_chars:]}")
+
+def reference_repeats(history: List[Message], results: List[Message]) -> List[Message]:
+    """
+    Replaces tool results identical to an output still in the history (or earlier in results) by a short reference
+    to it, so the same output is not sent again
+
+    Outputs are identified by their blob store digest; results without one are kept as they are.
+    """
+    earlier: Dict[str, List[Message]] = {}
+    for m in history:
+        if m.digest is not None:
+            earlier.setdefault(m.digest, []).append(m)
+
+    out: List[Message] = []
+    for m in results:
+        # Compaction replaces outputs by messages without a digest, and references do not carry the output
+        original = next((e for e in earlier.get(m.digest, []) if e.content == m.content), None) if m.digest is not None else None
+        if original is None:
+            if m.digest is not None:
+                earlier.setdefault(m.digest, []).append(m)
+            out.append(m)
+            continue
+
+        reference = _replace_output(m, f"[Same output as the earlier call {_describe_call(original)} ({len(m.content)} characters).]")
+        if len(reference.content) >= len(m.content):
+            out.append(m)
+            continue
+        reference.digest = m.digest
+        out.append(reference)
+    return out
+
+def _originals(messages: List[Message]) -> Dict[str, Message]:
+    # The first message with a digest carries the output, later ones with other content are references to it
+    originals: Dict[str, Message] = {}
+    for m in messages:
+        if m.digest is not None:
+            originals.setdefault(m.digest, m)
+    return originals
+
+def _stub_orphaned_references(messages: List[Message], originals: Dict[str, Message]) -> bool:
+    # References to an output compaction took away are stubbed as well, so they do not point at nothing
+    kept: Set[str] = {m.digest for m in messages if m.digest in originals and m.content == originals[m.digest].content}
+    stubbed = False
+    for i, m in enumerate(messages):
+        if m.digest is None or m.digest not in originals or m.digest in kept:
+            continue
+        messages[i] = _stub(m, "old output", chars=len(originals[m.digest].content))
+        stubbed = True
+    return stubbed
+
+def provider_summarizer(provider: Provider) -> Callable[[List[Message]], str]:
+    """
+    Returns a summarizer asking the given provider (without tools) to summarize a list of messages
+    """
+    def _summarize(msgs: List[Message]) -> str:
+        transcript = "\n\n".join(
+            f"[{m.role}{' ' + _describe_call(m) if m.role == 'tool' else ''}]\n{m.content}" for m in msgs
+        )
+        response = provider.chat(
+            messages=[Message(role="system", content=SUMMARY_PROMPT), Message(role="user", content=transcript)],
+            tools=[],
+        )
+        return response.assistant_text
+
+    return _summarize
+
+class ContextManager:
+    """
+    Keeps the conversation resent on every step within a token budget
+
+    Once the estimated size exceeds token_budget, the history is compacted down to target_ratio * token_budget:
+    1. tool outputs superseded by a later call (the same call repeated, or another call on the same file) are stubbed
+    2. the remaining large tool outputs are truncated to their first and last keep_chars characters, oldest first
+    3. if a summarizer is set, the oldest messages are replaced by a single summary message
+
+    System messages, the first user message and the keep_recent most recent messages are never touched. Compaction
+    replaces Message objects instead of modifying them, so providers caching converted messages stay consistent.
+    References to an output compaction took away (see reference_repeats) are stubbed along with it.
+
+    Attributes:
+        token_budget: The estimated number of input tokens the history may grow to
+        keep_recent: The number of most recent messages which are never compacted
+        target_ratio: The fraction of the budget compaction aims for, leaving room for the next few steps
+        min_stub_chars: Tool outputs shorter than this are not worth stubbing
+        keep_chars: The number of characters kept from both ends of truncated tool outputs
+        summarizer: Optional callable summarizing a list of messages
+    """
+    def __init__(
+        self,
+        token_budget: int,
+        keep_recent: int = 6,
+        target_ratio: float = 0.75,
+        min_stub_chars: int = 1000,
+        keep_chars: int = 200,
+        summarizer: Optional[Callable[[List[Message]], str]] = None,
+    ):
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.target_ratio = target_ratio
+        self.min_stub_chars = min_stub_chars
+        self.keep_chars = keep_chars
+        self.summarizer = summarizer
+
+    def _protected(self, messages: List[Message]) -> int:
+        # Index of the first message that may be compacted: everything up to and including the first user message
+        # is kept
+        first_user = next((i for i, m in enumerate(messages) if m.role == "user"), -1)
+        return first_user + 1
+
+    def _superseded(self, messages: List[Message], i: int) -> bool:
+        m = messages[i]
+        path = (m.arguments or {}).get("file_path")
+        for later in messages[i + 1:]:
+            if later.role != "tool":
+                continue
+            # A reference to this output does not carry it
+            if later.digest is not None and later.digest == m.digest and later.content != m.content:
+                continue
+            if later.name == m.name and later.arguments == m.arguments:
+                return True
+            # Reading another part of a file does not make an earlier read of it stale
+            if later.name == m.name == "get_file_content":
+                continue
+            if path is not None and (later.arguments or {}).get("file_path") == path:
+                return True
+        return False
+
+    def compact(self, messages: List[Message]) -> int:
+        """
+        Compacts messages in place if they exceed the budget and returns their estimated token count
+        """
+        total = estimate_messages_tokens(messages)
+        if total <= self.token_budget:
+            return total
+
+        originals = _originals(messages)
+        total = self._compact(messages, total)
+        if _stub_orphaned_references(messages, originals):
+            total = estimate_messages_tokens(messages)
+        return total
+
+    def _compact(self, messages: List[Message], total: int) -> int:
+        target = int(self.token_budget * self.target_ratio)
+        start = self._protected(messages)
+        end = max(start, len(messages) - self.keep_recent)
+
+        candidates = [
+            i for i in range(start, end)
+            if messages[i].role == "tool" and len(messages[i].content) >= self.min_stub_chars
+        ]
+
+        # Superseded outputs first, then everything else oldest first
+        superseded = [i for i in candidates if self._superseded(messages, i)]
+        remaining = sorted(set(candidates) - set(superseded))
+        for superseding, indices in ((True, superseded), (False, remaining)):
+            for i in indices:
+                if total <= target:
+                    return total
+                stub = _stub(messages[i], "superseded by a later call") if superseding else _truncate(messages[i], self.keep_chars)
+                if len(stub.content) >= len(messages[i].content):
+                    continue
+                total -= estimate_message_tokens(messages[i]) - estimate_message_tokens(stub)
+                messages[i] = stub
+
+        # Tool results stay with the assistant message requesting them
+        while end > start and end < len(messages) and messages[end].role == "tool":
+            end -= 1
+        if total > target and self.summarizer is not None and end - start > 1:
+            summary = self.summarizer(messages[start:end])
+            summary_message = Message(role="user", content=f"Summary of the earlier conversation:\n{summary}")
+            messages[start:end] = [summary_message]
+            total = estimate_messages_tokens(messages)
+
+        return total
@@ -0,0 +1,161 @@
+import contextvars
+import json
+import os
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Iterable, List, Optional, Tuple
+from core.blobstore import BlobStore, get_store
+from core.journal import WriteJournal, current_journal
+from core.reads import ReadLog, current_reads
+from core.registry import ToolRegistry
+from core.tracing import span
+from core.types import Message, ToolSpec, ToolCall
+
+def run_tool_call(tools: ToolRegistry, tool_call: ToolCall, blobs: Optional[BlobStore] = None) -> Message:
+    # Errors (unknown tools, invalid arguments, exceptions) are sent back as structured tool results as well
+    with span(tool_call.name, "tool", arguments_chars=len(json.dumps(tool_call.arguments))) as call:
+        result = tools.dispatch(tool_call)
+        if blobs is not None:
+            # Identical outputs share one copy
+            blob = blobs.put(result)
+            content, result, digest = blob.text, blob.payload, blob.digest
+        else:
+            content, digest = json.dumps(result), None
+        call.set(result_chars=len(content), failed="error" in result)
+    return Message(
+        role="tool",
+        name=tool_call.name,
+        tool_call_id=tool_call.id,
+        content=content,
+        arguments=tool_call.arguments,
+        payload=result,
+        digest=digest,
+    )
+
+def _paths_overlap(a: str, b: str) -> bool:
+    # "." is the working directory itself and therefore contains every relative path
+    if a == "." or b == ".":
+        return not (os.path.isabs(a) or os.path.isabs(b)) or a == b
+    return a == b or a.startswith(b + os.sep) or b.startswith(a + os.sep)
+
+class ToolBatch:
+    """
+    The tool calls of a single agent step
+
+    Calls start running as soon as they are submitted. A call only waits for the earlier calls of the same batch it
+    conflicts with:
+    - read-only calls never conflict with each other
+    - a modifying call conflicts with every call touching the same path (or a parent/child of it)
+    - a modifying call without a known path acts as a barrier and conflicts with everything
+
+    Results are returned in the original call order. If a journal is given, file changes made by the calls are
+    recorded in it; if a read log is given, the file reads of the calls are.
+    """
+    def __init__(self, tools: ToolRegistry, pool: Optional[ThreadPoolExecutor], journal: Optional[WriteJournal] = None, blobs: Optional[BlobStore] = None, reads: Optional[ReadLog] = None):
+        self.tools = tools
+        self._pool = pool
+        self.journal = journal
+        self.reads = reads
+        self.blobs = blobs
+        self._entries: List[Tuple[bool, Optional[str], Future]] = []
+        # The calls run in the context the batch was created in, e.g. within the span of its step, even when they
+        # are submitted while a streamed response is still being received
+        self._context = contextvars.copy_context()
+
+    def _access(self, tool_call: ToolCall) -> Tuple[bool, Optional[str]]:
+        tool = self.tools.get(tool_call.name)
+        if not tool:
+            # Unknown tools only produce an error message and touch nothing
+            return True, "."
+
+        path = None
+        if tool.path_arg and tool.path_arg in tool_call.arguments:
+            path = self._normalize(str(tool_call.arguments[tool.path_arg]))
+        elif tool.path_arg and tool.read_only:
+            # Path arguments are optional for e.g. get_files_info which then defaults to the working directory
+            path = self._normalize(".")
+
+        return tool.read_only, path
+
+    def _normalize(self, path: str) -> str:
+        # Relative and absolute paths of the same file only compare equal once both are absolute
+        working_directory = self.tools.working_directory
+        if working_directory is None:
+            return os.path.normpath(path)
+        return os.path.normpath(os.path.join(os.path.abspath(working_directory), path))
+
+    def _conflicts(self, read_only: bool, path: Optional[str], other_read_only: bool, other_path: Optional[str]) -> bool:
+        if read_only and other_read_only:
+            return False
+        if path is None or other_path is None:
+            return True
+        return _paths_overlap(path, other_path)
+
+    def _run(self, tool_call: ToolCall, deps: List[Future]) -> Message:
+        # Dependencies were submitted earlier, so they are already running or done (the pool is FIFO)
+        wait(deps)
+        return run_tool_call(self.tools, tool_call, self.blobs)
+
+    def submit(self, tool_call: ToolCall) -> Future:
+        read_only, path = self._access(tool_call)
+
+        # Tools find the journal and read log through context variables, which pool threads do not inherit on their own
+        context = self._context.copy()
+        if self.journal is not None:
+            context.run(current_journal.set, self.journal)
+        if self.reads is not None:
+            context.run(current_reads.set, self.reads)
+
+        if self._pool is None:
+            future: Future = Future()
+            try:
+                future.set_result(context.run(run_tool_call, self.tools, tool_call, self.blobs))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            deps = [
+                f for (ro, p, f) in self._entries
+                if self._conflicts(read_only, path, ro, p)
+            ]
+            future = self._pool.submit(context.run, self._run, tool_call, deps)
+
+        self._entries.append((read_only, path, future))
+        return future
+
+    def results(self) -> List[Message]:
+        return [f.result() for (_, _, f) in self._entries]
+
+    def wait(self) -> None:
+        # Waits for all submitted calls without collecting their results (or exceptions)
+        wait([f for (_, _, f) in self._entries])
+
+class ToolExecutor:
+    """
+    Executes tool calls, optionally in parallel on a bounded thread pool
+
+    Attributes:
+        tools: The tools available to the agent
+        max_workers: The maximum number of concurrently running tool calls; 1 runs every call sequentially in the
+                     calling thread
+        journal: The journal recording the file changes made by the tools, if any
+        blobs: The store the tool outputs are interned in (by default the one shared by all executors)
+    """
+    def __init__(self, tools: Iterable[ToolSpec], max_workers: int = 1, journal: Optional[WriteJournal] = None, blobs: Optional[BlobStore] = None):
+        self.tools = tools if isinstance(tools, ToolRegistry) else ToolRegistry(tools)
+        self.max_workers = max_workers
+        self.journal = journal
+        self.blobs = blobs if blobs is not None else get_store()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool") if max_workers > 1 else None
+
+    def batch(self, reads: Optional[ReadLog] = None) -> ToolBatch:
+        # The read log belongs to the session the calls are made in
+        return ToolBatch(self.tools, self._pool, journal=self.journal, blobs=self.blobs, reads=reads)
+
+    def execute(self, tool_calls: List[ToolCall], reads: Optional[ReadLog] = None) -> List[Message]:
+        batch = self.batch(reads)
+        for tool_call in tool_calls:
+            batch.submit(tool_call)
+        return batch.results()
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
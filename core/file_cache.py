@@ -0,0 +1,149 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
+
+# Total size of the cached file contents before the least recently used ones are evicted
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+# Larger files are always read from disk (through mmap by get_file_content)
+MAX_ENTRY_BYTES = 4 * 1024 * 1024
+MAX_CACHED_LISTINGS = 256
+
+Signature = Tuple[int, int, int]
+
+class ListingEntry(NamedTuple):
+    name: str
+    is_dir: bool
+    is_symlink: bool
+    size: int
+    mtime_ns: int
+
+def stat_signature(st: os.stat_result) -> Signature:
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def scan_directory(directory: str) -> List[ListingEntry]:
+    """
+    Lists a directory with one stat per entry (none for the type, which os.scandir gets for free on most platforms)
+    """
+    entries: List[ListingEntry] = []
+    with os.scandir(directory) as it:
+        for e in it:
+            try:
+                st = e.stat()
+            except OSError:
+                # A dangling symlink
+                st = e.stat(follow_symlinks=False)
+            entries.append(ListingEntry(e.name, e.is_dir(), e.is_symlink(), st.st_size, st.st_mtime_ns))
+    return entries
+
+class FileCache:
+    """
+    An in-memory cache of file contents and directory listings shared by the file tools
+
+    Contents are keyed by resolved path and validated against (mtime_ns, size, inode) on every access, so changes
+    made outside of our tools are picked up as well. Listings are validated against the signature of the directory
+    itself, which does not change when a file in it merely changes size; writes through our tools therefore
+    invalidate them explicitly.
+
+    Attributes:
+        max_bytes: The maximum total size of the cached contents
+        max_entry_bytes: The size of the largest file that is cached
+        hits: The number of reads answered from the cache
+        misses: The number of reads which had to go to disk
+    """
+    def __init__(self, max_bytes: int = MAX_CACHE_BYTES, max_entry_bytes: int = MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+        self._contents: "OrderedDict[str, Tuple[Signature, bytes]]" = OrderedDict()
+        self._listings: "OrderedDict[str, Tuple[Signature, List[ListingEntry]]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _drop(self, path: str) -> None:
+        # Expects the lock to be held
+        old = self._contents.pop(path, None)
+        if old is not None:
+            self._size -= len(old[1])
+
+    def _store(self, path: str, signature: Signature, data: bytes) -> None:
+        # Expects the lock to be held
+        self._drop(path)
+        if len(data) > self.max_entry_bytes:
+            return
+        self._contents[path] = (signature, data)
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, (_, evicted) = self._contents.popitem(last=False)
+            self._size -= len(evicted)
+
+    def read(self, path: str) -> Optional[Tuple[bytes, os.stat_result]]:
+        """
+        Returns the content of the file at the resolved path together with the stat it is valid for, or None if the
+        file is too large to be cached
+        """
+        st = os.stat(path)
+        if st.st_size > self.max_entry_bytes:
+            return None
+
+        with self._lock:
+            entry = self._contents.get(path)
+            if entry is not None and entry[0] == stat_signature(st):
+                self._contents.move_to_end(path)
+                self.hits += 1
+                return entry[1], st
+            self.misses += 1
+
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+
+        # Only cache what is known to match the signature; the file may have changed while it was read
+        if len(data) == st.st_size:
+            with self._lock:
+                self._store(path, stat_signature(st), data)
+        return data, st
+
+    def put(self, path: str, data: bytes) -> None:
+        """
+        Records data which has just been written to the file at the resolved path
+        """
+        st = os.stat(path)
+        with self._lock:
+            self._listings.pop(os.path.dirname(path), None)
+            if st.st_size == len(data):
+                self._store(path, stat_signature(st), data)
+            else:
+                self._drop(path)
+
+    def listing(self, directory: str) -> List[ListingEntry]:
+        """
+        Returns the entries of the directory at the resolved path
+        """
+        signature = stat_signature(os.stat(directory))
+        with self._lock:
+            entry = self._listings.get(directory)
+            if entry is not None and entry[0] == signature:
+                self._listings.move_to_end(directory)
+                return entry[1]
+
+        entries = scan_directory(directory)
+        with self._lock:
+            self._listings[directory] = (signature, entries)
+            self._listings.move_to_end(directory)
+            while len(self._listings) > MAX_CACHED_LISTINGS:
+                self._listings.popitem(last=False)
+        return entries
+
+    def invalidate_listings(self) -> None:
+        """
+        Forgets all listings, e.g. after running a program which may have changed files in place
+        """
+        with self._lock:
+            self._listings.clear()
+
+_cache = FileCache()
+
+def get_cache() -> FileCache:
+    return _cache
@@ -0,0 +1,139 @@
+import bisect
+import mmap
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple, Union
+from core.file_cache import Signature, stat_signature
+
+# Granularity of the line index; locating a line scans at most one block
+BLOCK_BYTES = 64 * 1024
+MAX_CACHED_INDEXES = 32
+
+@dataclass
+class LineIndex:
+    """
+    A sparse line index of a file, valid as long as the file is unchanged
+
+    Attributes:
+        size: The size of the file in bytes
+        lines: The number of lines in the file, counting a final line without a trailing newline
+        newlines: The number of newlines in the file
+        block_newlines: The number of newlines before each block of BLOCK_BYTES bytes
+    """
+    size: int
+    lines: int
+    newlines: int
+    block_newlines: array
+
+def build_index(data: Union[bytes, mmap.mmap]) -> LineIndex:
+    size = len(data)
+    block_newlines = array("Q")
+    newlines = 0
+    for start in range(0, size, BLOCK_BYTES):
+        block_newlines.append(newlines)
+        newlines += data[start:start + BLOCK_BYTES].count(b"\n")
+
+    lines = newlines + (1 if size and data[size - 1:size] != b"\n" else 0)
+    return LineIndex(size=size, lines=lines, newlines=newlines, block_newlines=block_newlines)
+
+_cache: "OrderedDict[str, Tuple[Signature, LineIndex]]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+def _cached_index(path: str, st: os.stat_result, data: Union[bytes, mmap.mmap]) -> LineIndex:
+    key = stat_signature(st)
+    with _cache_lock:
+        entry = _cache.get(path)
+        if entry is not None and entry[0] == key:
+            _cache.move_to_end(path)
+            return entry[1]
+
+    index = build_index(data)
+    with _cache_lock:
+        _cache[path] = (key, index)
+        _cache.move_to_end(path)
+        while len(_cache) > MAX_CACHED_INDEXES:
+            _cache.popitem(last=False)
+    return index
+
+class IndexedFile:
+    """
+    A read-only, memory-mapped file together with its line index
+
+    Line indexes are cached across instances and rebuilt when the file changes, so paging through a large file only
+    scans it once. Use as a context manager.
+
+    Content which has already been read (e.g. from a FileCache) can be passed as data along with the stat it is
+    valid for, in which case the file is not opened at all.
+
+    Attributes:
+        data: The content of the file
+        index: The line index of the file
+        signature: The (mtime_ns, size, inode) of the file the content belongs to
+    """
+    def __init__(self, path: str, data: Optional[bytes] = None, st: Optional[os.stat_result] = None):
+        self._file = None
+        if data is not None and st is not None:
+            self.data = data
+            self.signature = stat_signature(st)
+            self.index = _cached_index(os.path.realpath(path), st, data)
+            return
+
+        self._file = open(path, "rb")
+        try:
+            st = os.fstat(self._file.fileno())
+            self.signature = stat_signature(st)
+            # Empty files cannot be mapped
+            self.data: Union[bytes, mmap.mmap] = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b""
+            self.index = _cached_index(os.path.realpath(path), st, self.data)
+        except Exception:
+            self._file.close()
+            raise
+
+    @property
+    def size(self) -> int:
+        return self.index.size
+
+    @property
+    def lines(self) -> int:
+        return self.index.lines
+
+    def line_offset(self, line: int) -> int:
+        """
+        Returns the byte offset at which the given (0-based) line starts, or the file size past the last line
+        """
+        if line <= 0:
+            return 0
+        if line > self.index.newlines:
+            return self.index.size
+
+        # The block containing the line-th newline
+        block = bisect.bisect_left(self.index.block_newlines, line) - 1
+        pos = block * BLOCK_BYTES
+        for _ in range(line - self.index.block_newlines[block]):
+            pos = self.data.find(b"\n", pos) + 1
+        return pos
+
+    def line_at(self, offset: int) -> int:
+        """
+        Returns the (1-based) number of the line containing the byte at the given offset
+        """
+        block = min(offset // BLOCK_BYTES, len(self.index.block_newlines) - 1)
+        if block < 0:
+            return 1
+        start = block * BLOCK_BYTES
+        return self.index.block_newlines[block] + self.data[start:offset].count(b"\n") + 1
+
+    def close(self) -> None:
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self) -> "IndexedFile":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
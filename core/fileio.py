@@ -0,0 +1,63 @@
+import os
+import stat
+import tempfile
+
+# Read once at import; os.umask can only be queried by setting it, which is not thread-safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def fsync_directory(directory: str) -> None:
+    # Makes renames and new entries in the directory durable
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Not supported by every file system
+        pass
+    finally:
+        os.close(fd)
+
+def stage_write(path: str, data: bytes) -> str:
+    """
+    Writes data to a temporary file next to path, flushed to disk and with the permissions the file at path will
+    need, and returns the path of the temporary file
+
+    Permissions of an existing file are kept; new files get the usual permissions for the current umask.
+    """
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(tmp_path, mode)
+    except BaseException:
+        discard_staged(tmp_path)
+        raise
+    return tmp_path
+
+def discard_staged(tmp_path: str) -> None:
+    try:
+        os.unlink(tmp_path)
+    except FileNotFoundError:
+        pass
+
+def commit_staged(tmp_path: str, path: str) -> None:
+    os.replace(tmp_path, path)
+    fsync_directory(os.path.dirname(path))
+
+def atomic_write(path: str, data: bytes) -> None:
+    """
+    Replaces the file at path with data, so that readers see either the old or the new content but never a mix
+    """
+    tmp_path = stage_write(path, data)
+    try:
+        commit_staged(tmp_path, path)
+    except BaseException:
+        discard_staged(tmp_path)
+        raise
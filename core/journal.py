@@ -0,0 +1,174 @@
+import contextvars
+import json
+import os
+import shutil
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional
+from core.fileio import atomic_write, fsync_directory
+
+JOURNAL_FILE = "journal.jsonl"
+
+class WriteJournal:
+    """
+    Records the original state of every file changed by the write tools, so all changes of a session can be rolled
+    back
+
+    Before a file is changed for the first time, a copy of it (or the fact that it did not exist, along with the
+    directories created for it) is written to the journal directory and fsynced. A journal left behind by a crashed
+    or aborted run can therefore still be rolled back by opening its directory again.
+
+    Attributes:
+        directory: The directory holding the journal and the copies of the original files
+    """
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or tempfile.mkdtemp(prefix="halp-journal-")
+        os.makedirs(self.directory, exist_ok=True)
+        self._records: List[Dict[str, Any]] = []
+        # Numbers the copies of the original files; records can be dropped, so their count is not enough
+        self._next_backup = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    @property
+    def _journal_path(self) -> str:
+        return os.path.join(self.directory, JOURNAL_FILE)
+
+    def _load(self) -> None:
+        try:
+            with open(self._journal_path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                self._records.append(json.loads(line))
+            except ValueError:
+                # A record cut short by a crash; the change it was about to describe was not made yet
+                break
+        self._next_backup = 1 + max((int(r["backup"].split(".")[0]) for r in self._records if r["backup"] is not None), default=-1)
+
+    @property
+    def paths(self) -> List[str]:
+        """
+        The files changed in this session, in the order they were first changed
+        """
+        with self._lock:
+            return [r["path"] for r in self._records]
+
+    def record(self, path: str, root: str) -> bool:
+        """
+        Records the current state of the file at the resolved path before it is changed and returns True; later
+        calls for the same path are no-ops returning False. Directories between root and the file which do not exist
+        yet are recorded as created.
+        """
+        with self._lock:
+            if any(r["path"] == path for r in self._records):
+                return False
+
+            created_dirs = []
+            directory = os.path.dirname(path)
+            while not os.path.isdir(directory) and os.path.commonpath([root, directory]) == root and directory != root:
+                created_dirs.insert(0, directory)
+                directory = os.path.dirname(directory)
+
+            backup = None
+            if os.path.lexists(path):
+                backup = f"{self._next_backup}.orig"
+                self._next_backup += 1
+                backup_path = os.path.join(self.directory, backup)
+                shutil.copy2(path, backup_path, follow_symlinks=False)
+                with open(backup_path, "rb") as f:
+                    os.fsync(f.fileno())
+
+            record = {"path": path, "backup": backup, "created_dirs": created_dirs}
+            with open(self._journal_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            fsync_directory(self.directory)
+            self._records.append(record)
+            return True
+
+    def rollback(self) -> List[str]:
+        """
+        Restores every recorded file to its original state, newest first, and returns their paths
+
+        The journal is cleared afterwards, so a new session can start recording right away.
+        """
+        with self._lock:
+            restored = []
+            for record in reversed(self._records):
+                self._restore(record)
+                restored.append(record["path"])
+
+            self._clear()
+            return restored
+
+    def restore(self, paths: List[str]) -> None:
+        """
+        Restores the recorded files at the given resolved paths and forgets them, keeping the other records
+        """
+        with self._lock:
+            records = [r for r in self._records if r["path"] in paths]
+            for record in reversed(records):
+                self._restore(record)
+
+            kept = [r for r in self._records if r["path"] not in paths]
+            if not kept:
+                self._clear()
+                return
+            atomic_write(self._journal_path, "".join(json.dumps(r) + "\n" for r in kept).encode("utf-8"))
+            self._records = kept
+            for record in records:
+                if record["backup"] is not None:
+                    os.remove(os.path.join(self.directory, record["backup"]))
+
+    def _restore(self, record: Dict[str, Any]) -> None:
+        path = record["path"]
+        if record["backup"] is not None:
+            # Copied next to the file first, so the file is replaced in one step
+            tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.rollback")
+            shutil.copy2(os.path.join(self.directory, record["backup"]), tmp_path, follow_symlinks=False)
+            os.replace(tmp_path, path)
+        elif os.path.lexists(path):
+            os.remove(path)
+        for directory in reversed(record["created_dirs"]):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # Not empty (or already gone); it holds files we did not create
+                pass
+
+    def clear(self) -> None:
+        """
+        Forgets all records, keeping the changes
+        """
+        with self._lock:
+            self._clear()
+
+    def _clear(self) -> None:
+        for record in self._records:
+            if record["backup"] is not None:
+                try:
+                    os.remove(os.path.join(self.directory, record["backup"]))
+                except FileNotFoundError:
+                    pass
+        try:
+            os.remove(self._journal_path)
+        except FileNotFoundError:
+            pass
+        self._records = []
+
+# The journal of the session the current tool call belongs to; set by Agent while it runs
+current_journal: contextvars.ContextVar[Optional[WriteJournal]] = contextvars.ContextVar("current_journal", default=None)
+
+def record_write(path: str, root: str) -> bool:
+    """
+    Records the file at the resolved path in the journal of the current session, if there is one, and returns
+    whether its state was recorded just now (see WriteJournal.record)
+    """
+    journal = current_journal.get()
+    if journal is not None:
+        return journal.record(path, os.path.realpath(root))
+    return False
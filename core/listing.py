@@ -0,0 +1,205 @@
+import os
+import re
+from dataclasses import dataclass
+from typing import Iterator, List, Optional
+from core.file_cache import FileCache, ListingEntry, scan_directory
+
+SORT_KEYS = ["name", "size", "mtime"]
+
+@dataclass
+class Entry:
+    """
+    An entry found by list_tree
+
+    Attributes:
+        path: The path of the entry relative to the listed directory, separated by "/"
+        is_dir: Whether the entry is a directory (or a symlink to one)
+        size: The size of the entry in bytes
+        mtime_ns: The modification time of the entry
+    """
+    path: str
+    is_dir: bool
+    size: int
+    mtime_ns: int
+
+def glob_to_regex(pattern: str) -> "re.Pattern[str]":
+    """
+    Translates a glob as used in .gitignore files into a regex matching "/"-separated relative paths
+
+    "*" and "?" do not match "/", "**" matches across directories, and [...] is a character class.
+    """
+    i, out = 0, []
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            body = pattern[i + 1:end]
+            out.append("[^" + body[1:] + "]" if body[0] in "!^" else "[" + body + "]")
+            i = end
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return re.compile("".join(out))
+
+@dataclass
+class IgnoreRule:
+    """
+    A single pattern of a .gitignore file
+
+    Attributes:
+        base: The directory of the .gitignore file, relative to the root of the listing ("" for the root itself)
+        regex: The compiled pattern
+        negate: Whether the pattern re-includes entries ("!pattern")
+        dir_only: Whether the pattern only matches directories ("pattern/")
+        anchored: Whether the pattern is matched against the path relative to base instead of the name alone
+    """
+    base: str
+    regex: "re.Pattern[str]"
+    negate: bool
+    dir_only: bool
+    anchored: bool
+
+    def matches(self, path: str, is_dir: bool) -> bool:
+        if self.dir_only and not is_dir:
+            return False
+        if self.base:
+            if not path.startswith(self.base + "/"):
+                return False
+            path = path[len(self.base) + 1:]
+        subject = path if self.anchored else path.rsplit("/", 1)[-1]
+        return self.regex.fullmatch(subject) is not None
+
+def parse_gitignore(text: str, base: str) -> List[IgnoreRule]:
+    rules = []
+    for line in text.splitlines():
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        if line.startswith("\\"):
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            continue
+        # A slash anywhere but at the end anchors the pattern to the directory of the .gitignore file
+        anchored = "/" in line
+        rules.append(IgnoreRule(base=base, regex=glob_to_regex(line.lstrip("/")), negate=negate, dir_only=dir_only, anchored=anchored))
+    return rules
+
+def is_ignored(rules: List[IgnoreRule], path: str, is_dir: bool) -> bool:
+    # The last matching rule decides
+    for rule in reversed(rules):
+        if rule.matches(path, is_dir):
+            return not rule.negate
+    return False
+
+class _Walker:
+    def __init__(self, root: str, cache: Optional[FileCache]):
+        self.root = root
+        self.cache = cache
+
+    def entries(self, directory: str) -> List[ListingEntry]:
+        return self.cache.listing(directory) if self.cache is not None else scan_directory(directory)
+
+    def read_text(self, path: str) -> str:
+        cached = self.cache.read(path) if self.cache is not None else None
+        if cached is not None:
+            return cached[0].decode("utf-8", errors="replace")
+        with open(path, "r", errors="replace") as f:
+            return f.read()
+
+    def gitignore_rules(self, directory: str, relative: str, entries: List[ListingEntry]) -> List[IgnoreRule]:
+        if not any(e.name == ".gitignore" and not e.is_dir for e in entries):
+            return []
+        try:
+            return parse_gitignore(self.read_text(os.path.join(directory, ".gitignore")), relative)
+        except OSError:
+            return []
+
+def list_tree(directory: str, root: Optional[str] = None, max_depth: int = 0, glob: Optional[str] = None,
+              gitignore: bool = True, sort: str = "name", after: Optional[str] = None,
+              cache: Optional[FileCache] = None) -> Iterator[Entry]:
+    """
+    Lists the resolved directory and, up to max_depth levels deep, its subdirectories
+
+    Entries are yielded lazily in tree order with the entries of every directory sorted by name; for the other sort
+    keys the whole tree is listed first and ordered largest or newest first. Symlinked directories are listed but never
+    descended into, so the walk cannot leave the tree. With gitignore set, .git directories and everything matched by
+    the .gitignore files between root (the working directory) and the listed entries is skipped, ignored directories
+    without descending into them. glob only filters what is yielded: patterns with a "/" are matched against the
+    relative path, others against the name.
+
+    With after (a relative path, for sort "name" only), only the entries following it in tree order are yielded, and
+    only directories containing later entries are read, so a listing can be continued without walking it again.
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError(f"Unknown sort key {sort!r}, expected one of {SORT_KEYS}")
+    if after is not None and sort != "name":
+        raise ValueError("after requires sort \"name\"")
+    # Tree order is the order of the paths as tuples of their parts
+    after_parts = tuple(after.split("/")) if after is not None else None
+
+    walker = _Walker(root or directory, cache)
+    pattern = glob_to_regex(glob) if glob else None
+    glob_anchored = glob is not None and "/" in glob
+
+    rules: List[IgnoreRule] = []
+    # Path of the listed directory relative to root, which the .gitignore rules are relative to
+    prefix = os.path.relpath(directory, walker.root).replace(os.sep, "/") if root else "."
+    prefix = "" if prefix == "." else prefix
+    if gitignore and prefix:
+        # .gitignore files of the ancestors of the listed directory
+        parts = prefix.split("/")
+        for i in range(len(parts)):
+            ancestor_rel = "/".join(parts[:i])
+            ancestor = os.path.join(walker.root, *parts[:i])
+            rules += walker.gitignore_rules(ancestor, ancestor_rel, walker.entries(ancestor))
+
+    def walk(current: str, relative: str, depth: int, rules: List[IgnoreRule]) -> Iterator[Entry]:
+        entries = walker.entries(current)
+        if gitignore:
+            rules = rules + walker.gitignore_rules(current, "/".join(p for p in (prefix, relative) if p), entries)
+
+        relative_parts = tuple(relative.split("/")) if relative else ()
+        for e in sorted(entries, key=lambda e: e.name):
+            path = f"{relative}/{e.name}" if relative else e.name
+            parts = relative_parts + (e.name,)
+            if after_parts is not None and parts <= after_parts and after_parts[:len(parts)] != parts:
+                # The entry and everything below it come before the cursor
+                continue
+            if gitignore:
+                if e.is_dir and e.name == ".git":
+                    continue
+                if is_ignored(rules, f"{prefix}/{path}" if prefix else path, e.is_dir):
+                    continue
+
+            if (after_parts is None or parts > after_parts) and (pattern is None or pattern.fullmatch(path if glob_anchored else e.name)):
+                yield Entry(path=path, is_dir=e.is_dir, size=e.size, mtime_ns=e.mtime_ns)
+            if e.is_dir and not e.is_symlink and depth < max_depth:
+                try:
+                    yield from walk(os.path.join(current, e.name), path, depth + 1, rules)
+                except OSError:
+                    # Unreadable directories are listed but not descended into
+                    pass
+
+    found = walk(directory, "", 0, rules)
+    if sort == "name":
+        yield from found
+    else:
+        key = (lambda e: e.size) if sort == "size" else (lambda e: e.mtime_ns)
+        yield from sorted(found, key=key, reverse=True)
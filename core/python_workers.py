@@ -0,0 +1,193 @@
+import atexit
+import json
+import os
+import subprocess
+import threading
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple
+
+# Modules imported by every warm worker ahead of time; this is where most of the interpreter startup time goes
+PRELOAD_MODULES = [
+    "argparse", "collections", "dataclasses", "datetime", "functools", "itertools", "json", "math", "os", "pathlib",
+    "random", "re", "string", "subprocess", "typing", "unittest",
+]
+
+PRELOAD = f"""
+import sys
+for _name in {PRELOAD_MODULES!r}:
+    try:
+        __import__(_name)
+    except ImportError:
+        pass
+"""
+
+# Waits for a single job on the pipe passed as its argument, then runs the target file like "python3 <file> <args>"
+# would: in a fresh __main__ module, with the inherited stdin, and with tracebacks starting at the file. Every worker
+# runs exactly one job, so each script starts with fresh module state.
+WORKER_BOOTSTRAP = PRELOAD + """
+import builtins, importlib.machinery, json, os, types
+with open(int(sys.argv[1]), "rb") as _pipe:
+    _line = _pipe.readline()
+if not _line:
+    sys.exit(0)
+_job = json.loads(_line)
+sys.argv = [_job["file"], *_job["args"]]
+sys.path.insert(0, os.path.dirname(_job["file"]))
+_main = types.ModuleType("__main__")
+_main.__file__ = _job["file"]
+_main.__cached__ = None
+_main.__builtins__ = builtins
+_main.__loader__ = importlib.machinery.SourceFileLoader("__main__", _job["file"])
+sys.modules["__main__"] = _main
+try:
+    with open(_job["file"], "rb") as _source:
+        exec(compile(_source.read(), _job["file"], "exec", dont_inherit=True), _main.__dict__)
+except SystemExit:
+    raise
+except BaseException as _e:
+    # Leave out the frame of this bootstrap
+    _e.__traceback__ = _e.__traceback__.tb_next
+    sys.excepthook(type(_e), _e, _e.__traceback__)
+    sys.exit(1)
+"""
+
+# Lists the top-level modules imported by PRELOAD
+PROBE = PRELOAD + """
+print(" ".join(sorted({m.split(".")[0] for m in sys.modules})))
+"""
+
+class PythonWorkerPool:
+    """
+    A pool of pre-started Python interpreters with their common imports already done
+
+    Each worker executes a single file and exits; a replacement is started right away so it has booted by the time
+    the next file is run. Files are executed by a cold interpreter instead whenever a warm one could behave
+    differently: if the directory of the file contains a module shadowing one the workers have already imported.
+
+    Attributes:
+        working_directory: The directory the executed files are confined to
+        size: The number of idle workers kept around
+    """
+    def __init__(self, working_directory: str, size: int):
+        self.working_directory = os.path.abspath(working_directory)
+        self.size = size
+        # Every idle worker with the pipe its job is sent through
+        self._idle: List[Tuple[subprocess.Popen, BinaryIO]] = []
+        self._lock = threading.Lock()
+        self._preloaded: Optional[Set[str]] = None
+        self._closed = False
+        # Started right away so the answer is ready by the first run
+        self._probe = subprocess.Popen(["python3", "-P", "-c", PROBE], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self._fill()
+
+    def _spawn(self) -> Tuple[subprocess.Popen, BinaryIO]:
+        # The job goes through a pipe of its own, so the script inherits stdin like a cold one does
+        read_fd, write_fd = os.pipe()
+        try:
+            process = subprocess.Popen(
+                # -P: preloading must not pick up modules from our own working directory
+                ["python3", "-P", "-c", WORKER_BOOTSTRAP, str(read_fd)],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                pass_fds=(read_fd,),
+            )
+        except BaseException:
+            os.close(write_fd)
+            raise
+        finally:
+            os.close(read_fd)
+        return process, os.fdopen(write_fd, "wb")
+
+    def _fill(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._idle = [w for w in self._idle if w[0].poll() is None]
+            while len(self._idle) < self.size:
+                self._idle.append(self._spawn())
+
+    def preloaded_modules(self) -> Set[str]:
+        # The top-level modules a warm worker has imported before running a file
+        if self._preloaded is None:
+            stdout, _ = self._probe.communicate(timeout=30)
+            self._preloaded = set(stdout.decode("utf-8").split())
+        return self._preloaded
+
+    def _shadows_preloaded(self, file_path_abs: str) -> bool:
+        directory = os.path.dirname(file_path_abs)
+        try:
+            with os.scandir(directory) as entries:
+                local = {e.name[:-3] if e.name.endswith(".py") else e.name for e in entries}
+        except OSError:
+            return True
+        return not local.isdisjoint(self.preloaded_modules())
+
+    def start(self, file_path_abs: str, args: List[str]) -> Optional[subprocess.Popen]:
+        """
+        Hands the file to an idle worker and returns the running process, or None if it must be run cold
+        """
+        if self._shadows_preloaded(file_path_abs):
+            return None
+
+        with self._lock:
+            worker = None
+            while self._idle and worker is None:
+                candidate = self._idle.pop(0)
+                if candidate[0].poll() is None:
+                    worker = candidate
+
+        # Replace the worker before waiting on this one
+        self._fill()
+        if worker is None:
+            return None
+
+        process, pipe = worker
+        try:
+            with pipe:
+                pipe.write(json.dumps({"file": file_path_abs, "args": list(args)}).encode("utf-8") + b"\n")
+        except BrokenPipeError:
+            return None
+        return process
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+
+        # Idle workers exit on their own once their job pipe is closed
+        for process, pipe in idle:
+            try:
+                pipe.close()
+                process.wait(timeout=5)
+            except Exception:
+                process.kill()
+            process.stdout.close()
+            process.stderr.close()
+
+_pool_size = 0
+_pools: Dict[str, PythonWorkerPool] = {}
+_pools_lock = threading.Lock()
+
+def configure(size: int) -> None:
+    """
+    Sets the number of warm workers kept per working directory; 0 disables warm workers
+    """
+    global _pool_size
+    _pool_size = size
+
+def get_pool(working_directory: str) -> Optional[PythonWorkerPool]:
+    if _pool_size <= 0:
+        return None
+
+    key = os.path.abspath(working_directory)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = PythonWorkerPool(key, _pool_size)
+        return pool
+
+@atexit.register
+def _close_pools() -> None:
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
@@ -0,0 +1,39 @@
+import contextvars
+import threading
+from typing import Dict, Optional, Tuple
+from core.file_cache import Signature
+
+class ReadLog:
+    """
+    The file reads whose output was sent to the model in one session, so rereading an unchanged file only needs a
+    notice
+
+    Every read is keyed by the resolved path of the file and the range it returned, and remembers the version of the
+    file it returned. Once the conversation no longer holds the output of a read (compaction elided it, or it was
+    replaced by a reference), the reads of that file have to be forgotten, however its path was spelled.
+    """
+    def __init__(self):
+        self._reads: Dict[Tuple, Signature] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._reads)
+
+    def get(self, key: Tuple) -> Optional[Signature]:
+        with self._lock:
+            return self._reads.get(key)
+
+    def record(self, key: Tuple, signature: Signature) -> None:
+        # key starts with the resolved path of the file
+        with self._lock:
+            self._reads[key] = signature
+
+    def forget(self, path: Optional[str] = None) -> None:
+        """
+        Forgets every read of the file at the resolved path, or every read at all if no path is given
+        """
+        with self._lock:
+            self._reads = {k: v for k, v in self._reads.items() if path is not None and k[0] != path}
+
+# The reads of the session the current tool call belongs to; set by the executor for every call
+current_reads: contextvars.ContextVar[Optional[ReadLog]] = contextvars.ContextVar("current_reads", default=None)
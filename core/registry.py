@@ -1,16 +1,282 @@
+import hashlib
 import importlib
-import pkgutil
-from typing import List
-from core.types import ToolSpec
+import json
+import os
+import sys
+import tempfile
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from core.types import ToolSpec, ToolCall
 
-def load_tools(working_directory: str) -> List[ToolSpec]:
-    tools: List[ToolSpec] = []
+# The tool schemas of the last start, so they are known without importing the tools
+DEFAULT_MANIFEST_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "halp-me", "tools")
+MANIFEST_VERSION = 1
+
+# A compiled validator checks (and normalizes) a value, returning the normalized value and a list of errors
+Validator = Callable[[Any, str], Tuple[Any, List[str]]]
+
+_TYPE_CHECKS: Dict[str, Callable[[Any], bool]] = {
+    "string": lambda v: isinstance(v, str),
+    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "boolean": lambda v: isinstance(v, bool),
+    "array": lambda v: isinstance(v, list),
+    "object": lambda v: isinstance(v, dict),
+    "null": lambda v: v is None,
+}
+
+def compile_schema(schema: Dict[str, Any]) -> Validator:
+    """
+    Compiles the subset of JSON schema used by our tool specs (type, enum, properties, required,
+    additionalProperties, items, minimum, maximum) into a validator function
+
+    Integral floats are accepted for integers and converted, as some providers deliver every number as a float.
+    """
+    types = schema.get("type")
+    if isinstance(types, str):
+        types = [types]
+    enum = schema.get("enum")
+    minimum = schema.get("minimum")
+    maximum = schema.get("maximum")
+    properties = {name: compile_schema(s) for name, s in schema.get("properties", {}).items()}
+    required = schema.get("required", [])
+    additional = schema.get("additionalProperties", True)
+    items = compile_schema(schema["items"]) if "items" in schema else None
+
+    def validate(value: Any, path: str) -> Tuple[Any, List[str]]:
+        if types is not None:
+            if "integer" in types and isinstance(value, float) and value.is_integer():
+                value = int(value)
+            if not any(_TYPE_CHECKS[t](value) for t in types if t in _TYPE_CHECKS):
+                return value, [f"{path}: expected {' or '.join(types)}, got {type(value).__name__}"]
+
+        errors: List[str] = []
+        if enum is not None and value not in enum:
+            errors.append(f"{path}: must be one of {enum}")
+        if minimum is not None and isinstance(value, (int, float)) and value < minimum:
+            errors.append(f"{path}: must be >= {minimum}")
+        if maximum is not None and isinstance(value, (int, float)) and value > maximum:
+            errors.append(f"{path}: must be <= {maximum}")
+
+        if isinstance(value, dict):
+            value = dict(value)
+            for name in required:
+                if name not in value:
+                    errors.append(f"{path}.{name}: is required")
+            for name in list(value):
+                if name in properties:
+                    value[name], errs = properties[name](value[name], f"{path}.{name}")
+                    errors.extend(errs)
+                elif additional is False:
+                    errors.append(f"{path}.{name}: unexpected argument")
+
+        if isinstance(value, list) and items is not None:
+            normalized = []
+            for i, item in enumerate(value):
+                item, errs = items(item, f"{path}[{i}]")
+                normalized.append(item)
+                errors.extend(errs)
+            value = normalized
+
+        return value, errors
+
+    return validate
+
+class ToolRegistry:
+    """
+    The tools available to the agent, indexed by name
+
+    Iterating over the registry yields the ToolSpecs in registration order, so it can be used wherever a list of
+    tools is expected.
+
+    Attributes:
+        working_directory: The directory relative path arguments of the tools refer to, if known
+        calls: The number of dispatched calls per tool name
+        errors: The number of calls per tool name which returned an error
+    """
+    def __init__(self, tools: Iterable[ToolSpec] = (), working_directory: Optional[str] = None):
+        self.working_directory = working_directory
+        self._tools: Dict[str, ToolSpec] = {}
+        self._validators: Dict[str, Validator] = {}
+        self.calls: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        for tool in tools:
+            self.register(tool)
+
+    def register(self, tool: ToolSpec) -> None:
+        self._tools[tool.name] = tool
+        self._validators[tool.name] = compile_schema(tool.parameters)
+
+    def get(self, name: str) -> Optional[ToolSpec]:
+        return self._tools.get(name)
+
+    def __iter__(self) -> Iterator[ToolSpec]:
+        return iter(self._tools.values())
+
+    def __len__(self) -> int:
+        return len(self._tools)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._tools
+
+    def _count(self, name: str, error: bool) -> None:
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if error:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def dispatch(self, tool_call: ToolCall) -> Dict[str, Any]:
+        """
+        Validates the arguments of a tool call and executes it
+
+        Returns {"result": ...} on success or {"error": ...} (with optional "details") on failure; exceptions raised
+        by the tool are reported the same way instead of being propagated.
+        """
+        tool = self._tools.get(tool_call.name)
+        if tool is None:
+            self._count(tool_call.name, error=True)
+            return {"error": f"Unknown function: {tool_call.name}"}
+
+        arguments, errors = self._validators[tool.name](tool_call.arguments, "arguments")
+        if errors:
+            self._count(tool.name, error=True)
+            return {"error": f"Invalid arguments for {tool.name}", "details": errors}
+
+        try:
+            # Inject arguments into the Python function
+            out = tool.func(**arguments)
+        except Exception as e:
+            self._count(tool.name, error=True)
+            return {"error": f"{tool.name} raised {type(e).__name__}: {e}"}
+
+        self._count(tool.name, error=False)
+        return {"result": out}
+
+class _LazyTool:
+    """
+    Stands in for the function of a tool loaded from the manifest: its module is imported and the tool built on the
+    first call
+    """
+    def __init__(self, module: str, working_directory: str):
+        self.module = module
+        self.working_directory = working_directory
+        self._func: Optional[Callable[..., Any]] = None
+        self._lock = threading.Lock()
+
+    def __call__(self, **kwargs: Any) -> Any:
+        if self._func is None:
+            # Calls of a step may run concurrently
+            with self._lock:
+                if self._func is None:
+                    self._func = importlib.import_module(self.module).build_tool(self.working_directory).func
+        return self._func(**kwargs)
+
+def _tool_modules(directory: str) -> List[str]:
+    with os.scandir(directory) as it:
+        return sorted(
+            name for name, ext in (os.path.splitext(entry.name) for entry in it if entry.is_file())
+            if ext == ".py" and name.isidentifier()
+        )
+
+def _signature(path: str) -> Optional[List[int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+def _local_sources(root: str) -> Dict[str, List[int]]:
+    # The signatures of the modules of this project loaded so far; schemas may use constants of any of them
+    sources: Dict[str, List[int]] = {}
+    for mod in list(sys.modules.values()):
+        path = getattr(mod, "__file__", None)
+        if not path:
+            continue
+        path = os.path.realpath(path)
+        rel = os.path.relpath(path, root)
+        if rel.startswith(os.pardir) or "site-packages" in rel.split(os.sep):
+            continue
+        signature = _signature(path)
+        if signature is not None:
+            sources[rel] = signature
+    return sources
+
+def default_manifest_path(directory: str) -> str:
+    digest = hashlib.sha256(os.path.realpath(directory).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(DEFAULT_MANIFEST_DIR, f"{digest}.json")
+
+def _read_manifest(path: str, directory: str, modules: List[str]) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get("version") != MANIFEST_VERSION or data.get("directory") != os.path.realpath(directory):
+        return None
+    # Any added, removed or changed module invalidates the whole manifest
+    if sorted(data["tools"]) != modules:
+        return None
+    root = os.path.dirname(data["directory"])
+    for rel, signature in data["sources"].items():
+        if _signature(os.path.join(root, rel)) != signature:
+            return None
+    return data["tools"]
+
+def _write_manifest(path: str, directory: str, tools: Dict[str, Any]) -> None:
+    directory = os.path.realpath(directory)
+    data = {
+        "version": MANIFEST_VERSION,
+        "directory": directory,
+        "sources": _local_sources(os.path.dirname(directory)),
+        "tools": tools,
+    }
+    manifest_dir = os.path.dirname(path)
+    try:
+        os.makedirs(manifest_dir, exist_ok=True)
+        # Write atomically, as other agents may start at the same time
+        fd, tmp_path = tempfile.mkstemp(dir=manifest_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    except OSError:
+        # Only a cache; the next start imports the tools again
+        pass
+
+def load_tools(working_directory: str, manifest_path: Optional[str] = None) -> ToolRegistry:
+    """
+    Registers the tool built by every module of the functions package which has a build_tool(working_directory)
+
+    The tool schemas are cached in a manifest (by default below DEFAULT_MANIFEST_DIR), which stays valid until a
+    module is added to or removed from the package, or one of the project's modules loaded while building the tools
+    changes (by mtime and size). With a valid manifest no tool module is imported until its tool is first called,
+    so schemas must not depend on the working directory.
+    """
+    tools = ToolRegistry(working_directory=working_directory)
     pkg = "functions"
+    modules = _tool_modules(pkg)
+    manifest_path = manifest_path or default_manifest_path(pkg)
+
+    cached = _read_manifest(manifest_path, pkg, modules)
+    if cached is not None:
+        for modname in modules:
+            entry = cached[modname]
+            if entry is not None:
+                tools.register(ToolSpec(func=_LazyTool(f"{pkg}.{modname}", working_directory), **entry))
+        return tools
 
-    for _, modname, _ in pkgutil.iter_modules([pkg]):
+    manifest: Dict[str, Any] = {}
+    for modname in modules:
         mod = importlib.import_module(f"{pkg}.{modname}")
 
         if hasattr(mod, "build_tool"):
-            tools.append(mod.build_tool(working_directory))
+            tool = mod.build_tool(working_directory)
+            tools.register(tool)
+            manifest[modname] = {"name": tool.name, "description": tool.description, "parameters": tool.parameters,
+                                 "read_only": tool.read_only, "path_arg": tool.path_arg}
+        else:
+            manifest[modname] = None
 
+    _write_manifest(manifest_path, pkg, manifest)
     return tools
@@ -0,0 +1,328 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from core.file_cache import FileCache
+from core.listing import list_tree
+
+INDEX_VERSION = 1
+# Larger files are neither indexed nor searched
+MAX_INDEXED_BYTES = 1024 * 1024
+MAX_DEPTH = 64
+DEFAULT_INDEX_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "halp-me", "search")
+# Escapes standing for one fixed character; other letters escape classes, anchors and backreferences
+_CHAR_ESCAPES = {"a": "\a", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+_HEX_ESCAPES = {"x": 2, "u": 4, "U": 8}
+_QUANTIFIER = re.compile(r"[*+?]|\{([0-9]*)(,[0-9]*)?\}")
+_GLOBAL_FLAGS = re.compile(r"\(\?[aiLmsux]+\)")
+_SCOPED_FLAGS = re.compile(r"\(\?([aiLmsux]*)(?:-([imsx]*))?:")
+_LOOKAROUNDS = ("(?=", "(?!", "(?<=", "(?<!")
+
+def trigrams(text: str) -> Set[str]:
+    # Case-folded, so the index also serves case-insensitive queries
+    text = text.lower()
+    return set(map("".join, zip(text, text[1:], text[2:])))
+
+def _skip_ignored(pattern: str, i: int, verbose: bool) -> int:
+    # Skips the whitespace and comments of verbose patterns
+    while verbose and i < len(pattern) and (pattern[i].isspace() or pattern[i] == "#"):
+        if pattern[i] == "#":
+            end = pattern.find("\n", i)
+            i = len(pattern) if end < 0 else end
+        i += 1
+    return i
+
+def _escape(pattern: str, i: int) -> Tuple[Optional[str], int]:
+    # Reads the escape at i, returning the character it stands for (None if it matches no fixed text) and its end
+    e = pattern[i + 1]
+    if e in _HEX_ESCAPES:
+        end = i + 2 + _HEX_ESCAPES[e]
+        return chr(int(pattern[i + 2:end], 16)), end
+    if e == "N":
+        end = pattern.index("}", i)
+        return unicodedata.lookup(pattern[i + 3:end]), end + 1
+    if e == "0":
+        end = i + 2
+        while end < min(i + 4, len(pattern)) and pattern[end] in "01234567":
+            end += 1
+        return chr(int(pattern[i + 1:end], 8)), end
+    if e in _CHAR_ESCAPES:
+        return _CHAR_ESCAPES[e], i + 2
+    if e.isdigit():
+        # A backreference or octal escape; both are left out
+        end = i + 2
+        while end < min(i + 4, len(pattern)) and pattern[end].isdigit():
+            end += 1
+        return None, end
+    return (None if e.isalnum() else e), i + 2
+
+def _group(pattern: str, i: int, verbose: bool) -> Tuple[List[str], int]:
+    # Reads the group at i, returning the literal runs every match of it passes through and its end
+    required = True
+    if pattern.startswith("(?#", i):
+        return [], pattern.index(")", i) + 1
+    if pattern.startswith("(?P=", i):
+        return [], pattern.index(")", i) + 1
+    if pattern.startswith("(?P<", i):
+        i = pattern.index(">", i) + 1
+    elif pattern.startswith("(?(", i):
+        # The condition picks between branches, so nothing is required
+        i = pattern.index(")", i + 3) + 1
+        required = False
+    elif pattern.startswith(_LOOKAROUNDS, i):
+        i += 4 if pattern.startswith("(?<", i) else 3
+        required = False
+    elif pattern.startswith(("(?:", "(?>"), i):
+        i += 3
+    elif (m := _SCOPED_FLAGS.match(pattern, i)) is not None:
+        verbose = (verbose or "x" in m.group(1)) and "x" not in (m.group(2) or "")
+        i = m.end()
+    else:
+        i += 1
+    literals, i = _sequence(pattern, i, verbose)
+    return (literals if required else []), i + 1
+
+def _sequence(pattern: str, i: int, verbose: bool) -> Tuple[List[str], int]:
+    # Reads the pattern from i up to the closing parenthesis of its group (or the end), returning the literal runs
+    # every match passes through and where it ends
+    literals: List[str] = []
+    run = ""
+    alternation = False
+    while True:
+        i = _skip_ignored(pattern, i, verbose)
+        if i >= len(pattern) or pattern[i] == ")":
+            break
+        c = pattern[i]
+        char, inner = None, []
+        if c == "|":
+            alternation = True
+            i += 1
+        elif c == "\\":
+            char, i = _escape(pattern, i)
+        elif c == "[":
+            # Character classes match no fixed text; a "]" right after the opening bracket is part of the class
+            i += 2 if pattern.startswith("[^", i) else 1
+            if pattern[i] == "]":
+                i += 1
+            while pattern[i] != "]":
+                i += 2 if pattern[i] == "\\" else 1
+            i += 1
+        elif (m := _GLOBAL_FLAGS.match(pattern, i)) is not None:
+            i = m.end()
+        elif c == "(":
+            inner, i = _group(pattern, i, verbose)
+        elif c in ".^$":
+            i += 1
+        else:
+            char, i = c, i + 1
+
+        i = _skip_ignored(pattern, i, verbose)
+        m = _QUANTIFIER.match(pattern, i)
+        if m is not None and m.group(0) == "{}":
+            # "{" only starts a quantifier if a bound follows
+            m = None
+        minimum = 1
+        if m is not None:
+            minimum = 0 if m.group(0) in ("*", "?") else 1 if m.group(0) == "+" else int(m.group(1) or 0)
+            i = m.end()
+            if i < len(pattern) and pattern[i] in "?+":
+                i += 1
+        if char is not None and minimum > 0:
+            run += char
+        if char is None or m is not None:
+            # Repeats end the run, as what follows them is not adjacent to a single copy
+            if run:
+                literals.append(run)
+            run = ""
+        if minimum > 0:
+            literals.extend(inner)
+    if run:
+        literals.append(run)
+    return ([] if alternation else literals), i
+
+def required_literals(pattern: str) -> List[str]:
+    """
+    Returns substrings every match of the regex must contain
+
+    Only sequences of plain characters count; alternations, lookarounds, character classes and anything optional
+    are left out. An empty list means no file can be ruled out, which is also the answer for anything the scanner does
+    not understand.
+    """
+    try:
+        re.compile(pattern)
+        flags = _GLOBAL_FLAGS.match(pattern)
+        literals, _ = _sequence(pattern, 0, flags is not None and "x" in flags.group(0))
+    except (re.error, RecursionError, IndexError, KeyError, ValueError):
+        return []
+    return [l for l in literals if len(l) >= 3]
+
+def default_index_path(root: str) -> str:
+    digest = hashlib.sha256(os.path.realpath(root).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(DEFAULT_INDEX_DIR, f"{digest}.json")
+
+class SearchIndex:
+    """
+    A trigram index of the text files in a directory tree, persisted between runs
+
+    Every query is narrowed down to the files containing all trigrams of its literal parts, which are then searched
+    for real. The index is refreshed incrementally before each search: only files whose (mtime_ns, size) changed are
+    read again. Files ignored by .gitignore, binary files and files larger than MAX_INDEXED_BYTES are skipped.
+
+    The postings lists are persisted as they are used, so loading the index is a single JSON parse. Changed files
+    are indexed under a new id instead of being removed from the postings; the ids they leave behind are skipped at
+    query time and dropped by rebuilding the index once there are more of them than live ones.
+
+    Attributes:
+        root: The indexed directory
+        index_path: The file the index is persisted to
+        files: The (mtime_ns, size, id) of every indexed file by path relative to root, the id being None for files
+            which cannot be searched (binary or unreadable) so they are not read again until they change
+    """
+    def __init__(self, root: str, index_path: Optional[str] = None, cache: Optional[FileCache] = None):
+        self.root = os.path.realpath(root)
+        self.index_path = index_path or default_index_path(self.root)
+        self.cache = cache
+        self.files: Dict[str, List] = {}
+        self._paths: Dict[int, str] = {}
+        self._postings: Dict[str, List[int]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") != INDEX_VERSION or data.get("root") != self.root:
+            return
+        self.files = data["files"]
+        self._postings = data["postings"]
+        self._next_id = data["next_id"]
+        self._paths = {entry[2]: path for path, entry in self.files.items() if entry[2] is not None}
+
+    def save(self) -> None:
+        data = {
+            "version": INDEX_VERSION,
+            "root": self.root,
+            "next_id": self._next_id,
+            "files": self.files,
+            "postings": self._postings,
+        }
+        directory = os.path.dirname(self.index_path)
+        os.makedirs(directory, exist_ok=True)
+        # Write atomically, as other agents may share the index
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp_path, self.index_path)
+
+    def _index(self, path: str, signature: Tuple[int, int]) -> None:
+        self._remove(path)
+        text = self.read(path)
+        if text is None:
+            self.files[path] = [*signature, None]
+            return
+
+        file_id = self._next_id
+        self._next_id += 1
+        self.files[path] = [*signature, file_id]
+        self._paths[file_id] = path
+        for gram in trigrams(text):
+            self._postings.setdefault(gram, []).append(file_id)
+
+    def _remove(self, path: str) -> None:
+        entry = self.files.pop(path, None)
+        if entry is not None and entry[2] is not None:
+            del self._paths[entry[2]]
+
+    def read(self, path: str) -> Optional[str]:
+        """
+        Returns the text of the file at the path relative to root, or None if it is not a searchable text file
+        """
+        path_abs = os.path.realpath(os.path.join(self.root, path))
+        # Symlinks could point outside of the tree
+        if os.path.commonpath([self.root, path_abs]) != self.root:
+            return None
+        try:
+            cached = self.cache.read(path_abs) if self.cache is not None else None
+            if cached is not None:
+                data = cached[0]
+            else:
+                with open(path_abs, "rb") as f:
+                    data = f.read(MAX_INDEXED_BYTES + 1)
+        except OSError:
+            return None
+        if len(data) > MAX_INDEXED_BYTES or b"\0" in data[:8192]:
+            return None
+        return data.decode("utf-8", errors="replace")
+
+    def refresh(self) -> int:
+        """
+        Brings the index up to date with the files on disk and returns the number of files (re)indexed or removed
+        """
+        with self._lock:
+            current: Dict[str, Tuple[int, int]] = {}
+            for entry in list_tree(self.root, root=self.root, max_depth=MAX_DEPTH, cache=self.cache):
+                if not entry.is_dir and entry.size <= MAX_INDEXED_BYTES:
+                    current[entry.path] = (entry.mtime_ns, entry.size)
+
+            changed = 0
+            for path in [p for p in self.files if p not in current]:
+                self._remove(path)
+                changed += 1
+            for path, signature in current.items():
+                entry = self.files.get(path)
+                if entry is None or (entry[0], entry[1]) != signature:
+                    self._index(path, signature)
+                    changed += 1
+
+            dead = self._next_id - len(self._paths)
+            if dead > max(1000, len(self._paths)):
+                self._rebuild()
+
+            if changed:
+                try:
+                    self.save()
+                except OSError:
+                    # Searching works without persistence
+                    pass
+            return changed
+
+    def _rebuild(self) -> None:
+        files = self.files
+        self.files, self._paths, self._postings, self._next_id = {}, {}, {}, 0
+        for path, entry in files.items():
+            self._index(path, (entry[0], entry[1]))
+
+    def candidates(self, literals: Iterable[str]) -> List[str]:
+        """
+        Returns the indexed files which may contain all of the literals, sorted by path
+        """
+        with self._lock:
+            result: Optional[Set[int]] = None
+            for literal in literals:
+                for gram in trigrams(literal):
+                    ids = self._postings.get(gram, [])
+                    result = set(ids) if result is None else result.intersection(ids)
+                    if not result:
+                        return []
+            ids = self._paths if result is None else result
+            return sorted(self._paths[i] for i in ids if i in self._paths)
+
+
+_indexes: Dict[str, SearchIndex] = {}
+_indexes_lock = threading.Lock()
+
+def get_index(root: str, cache: Optional[FileCache] = None) -> SearchIndex:
+    key = os.path.realpath(root)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = SearchIndex(key, cache=cache)
+        return index
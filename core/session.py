@@ -0,0 +1,170 @@
+import dataclasses
+import json
+import os
+import secrets
+import time
+from typing import Any, Dict, List, Optional
+from core.blobstore import get_store
+from core.reads import ReadLog
+from core.types import Message, ToolCall
+
+def _dump_message(m: Message) -> Dict[str, Any]:
+    # Unset optional fields are left out to keep the log compact, and the payload is the content once more
+    record = {f.name: getattr(m, f.name) for f in dataclasses.fields(m) if f.name != "payload"}
+    if m.tool_calls is not None:
+        record["tool_calls"] = [dataclasses.asdict(t) for t in m.tool_calls]
+    return {k: v for k, v in record.items() if v is not None}
+
+def _load_message(record: Dict[str, Any]) -> Message:
+    tool_calls = record.pop("tool_calls", None)
+    m = Message(**record, tool_calls=[ToolCall(**t) for t in tool_calls] if tool_calls is not None else None)
+    if m.role == "tool":
+        try:
+            m.payload = json.loads(m.content)
+        except ValueError:
+            return m
+        if m.digest is not None:
+            # Repeated outputs share one copy again; references to an output keep its digest but not its content
+            blob = get_store().put(m.payload)
+            if blob.digest == m.digest:
+                m.content, m.payload = blob.text, blob.payload
+    return m
+
+class Session:
+    """
+    The state of one agent conversation, checkpointed to an append-only JSONL log after every step
+
+    The log holds "message" records for new messages (including the tool calls of assistant messages), a "history"
+    record with the full message list whenever compaction has rewritten earlier messages, and a "step" record closing
+    every step. Only steps which were closed count; the records of a step cut short by a crash are dropped on load. A
+    session without a path is kept in memory only.
+
+    Attributes:
+        id: The id of the session
+        path: The log file of the session, if it is persisted
+        messages: The conversation as of the last completed step
+        steps: The number of completed steps
+        input_tokens: The input tokens used by all steps
+        output_tokens: The output tokens used by all steps
+        final_response: The last assistant text
+        done: Whether the model has finished the task
+        reads: The file reads whose output the conversation holds (not persisted, so a resumed session reads afresh)
+    """
+    def __init__(self, id: Optional[str] = None, path: Optional[str] = None):
+        self.id = id
+        self.path = path
+        self.messages: List[Message] = []
+        self.steps = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.final_response = ""
+        self.done = False
+        self.reads = ReadLog()
+        # The messages as last written to the log, to tell appended messages from rewritten ones
+        self._saved: List[Message] = []
+
+    def _load(self) -> None:
+        with open(self.path, "rb") as f:
+            lines = f.readlines()
+
+        messages: List[Message] = []
+        # The end of the last step record in bytes
+        end = 0
+        offset = 0
+        for line in lines:
+            offset += len(line)
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A checkpoint cut short by a crash
+                break
+            kind = record["type"]
+            if kind == "message":
+                messages.append(_load_message(record["message"]))
+            elif kind == "history":
+                messages = [_load_message(m) for m in record["messages"]]
+            elif kind == "step":
+                self.messages = list(messages)
+                self.steps = record["steps"]
+                self.input_tokens = record["input_tokens"]
+                self.output_tokens = record["output_tokens"]
+                self.final_response = record["final_response"]
+                self.done = record["done"]
+                end = offset
+        self._saved = list(self.messages)
+
+        if end < sum(map(len, lines)):
+            # Drop the records of the interrupted step, so the next checkpoint neither continues a torn line nor
+            # follows messages it would append once more
+            with open(self.path, "r+b") as f:
+                f.truncate(end)
+                os.fsync(f.fileno())
+
+    def checkpoint(self, messages: List[Message]) -> None:
+        """
+        Closes a step: takes over the current messages and writes everything that changed since the previous step to
+        the log in a single fsynced append
+        """
+        self.steps += 1
+        self.messages = list(messages)
+        if self.path is None:
+            return
+
+        saved = len(self._saved)
+        if len(messages) >= saved and all(a is b for a, b in zip(messages, self._saved)):
+            records = [{"type": "message", "message": _dump_message(m)} for m in messages[saved:]]
+        else:
+            records = [{"type": "history", "messages": [_dump_message(m) for m in messages]}]
+        records.append({
+            "type": "step",
+            "steps": self.steps,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "final_response": self.final_response,
+            "done": self.done,
+        })
+
+        data = "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._saved = list(messages)
+
+class SessionStore:
+    """
+    A directory of session logs, one "<id>.jsonl" file per session
+
+    Attributes:
+        directory: The directory holding the logs
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, session_id: str) -> str:
+        return os.path.join(self.directory, f"{session_id}.jsonl")
+
+    def create(self) -> Session:
+        # Sortable by creation time
+        session_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}"
+        path = self._path(session_id)
+        open(path, "x").close()
+        return Session(id=session_id, path=path)
+
+    def load(self, session_id: str) -> Session:
+        """
+        Loads the session with the given id as of its last completed step; raises KeyError if there is none
+        """
+        path = self._path(session_id)
+        if os.path.basename(path) != f"{session_id}.jsonl" or not os.path.isfile(path):
+            raise KeyError(f"No session {session_id!r} in {self.directory}")
+        session = Session(id=session_id, path=path)
+        session._load()
+        return session
+
+    def list(self) -> List[str]:
+        """
+        The ids of all sessions, oldest first
+        """
+        return sorted(e.name[:-len(".jsonl")] for e in os.scandir(self.directory) if e.name.endswith(".jsonl"))
@@ -0,0 +1,206 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+@dataclass
+class Span:
+    """
+    A timed operation, e.g. a model call or a tool execution
+
+    Attributes:
+        name: The name of the operation
+        category: The kind of operation ("agent", "provider", "convert", "context" or "tool")
+        span_id: The id of the span, unique within the process
+        parent_id: The id of the span this one was started in, if any
+        start_ns: The wall clock time the span started at, in nanoseconds since the epoch
+        duration_ns: The wall time the span took, in nanoseconds
+        thread_id: The id of the thread the span ran on
+        attributes: Token counts, payload sizes and other details of the operation
+    """
+    name: str
+    category: str
+    span_id: int
+    parent_id: Optional[int]
+    start_ns: int
+    duration_ns: int = 0
+    thread_id: int = 0
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+class _NullSpan:
+    # Handed out while tracing is disabled, so instrumented code does not have to check
+    def set(self, **attributes: Any) -> None:
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class Exporter(ABC):
+    """
+    Receives every finished span
+    """
+    @abstractmethod
+    def export(self, span: Span) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+class MemoryExporter(Exporter):
+    """
+    Collects the finished spans in a list, e.g. for tests
+
+    Attributes:
+        spans: The finished spans, in the order they finished
+    """
+    def __init__(self):
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def find(self, name: str) -> List[Span]:
+        with self._lock:
+            return [s for s in self.spans if s.name == name]
+
+class JsonlExporter(Exporter):
+    """
+    Appends every span as a JSON object to a file, one per line
+    """
+    def __init__(self, path: str):
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(asdict(span), separators=(",", ":"), default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+class ChromeTraceExporter(Exporter):
+    """
+    Writes the spans as complete ("X") events of the Chrome trace event format, to be opened in chrome://tracing or
+    Perfetto
+
+    The JSON array is left unterminated, which the format allows, so a trace of a run that was killed is still
+    readable.
+    """
+    def __init__(self, path: str):
+        self._file = open(path, "w", encoding="utf-8")
+        self._file.write("[\n")
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        event = {
+            "name": span.name,
+            "cat": span.category,
+            "ph": "X",
+            "ts": span.start_ns / 1000,
+            "dur": span.duration_ns / 1000,
+            "pid": self._pid,
+            "tid": span.thread_id,
+            "args": span.attributes,
+        }
+        line = json.dumps(event, separators=(",", ":"), default=str) + ",\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+# The innermost open span of the current thread or task; tool threads get it through the copied context
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+class Tracer:
+    """
+    Creates spans and passes them to the exporters once they are finished; without exporters tracing is disabled
+    and costs next to nothing
+
+    Attributes:
+        exporters: The exporters receiving the finished spans
+    """
+    def __init__(self, exporters: Iterable[Exporter] = ()):
+        self.exporters = list(exporters)
+        self._ids = iter(range(1, 2**63))
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.exporters)
+
+    @contextmanager
+    def span(self, name: str, category: str, **attributes: Any) -> Iterator[Span]:
+        """
+        Times the enclosed block; attributes can be added to the yielded span while it runs. An exception leaving the
+        block is recorded in the "error" attribute.
+        """
+        if not self.exporters:
+            yield _NULL_SPAN
+            return
+
+        with self._lock:
+            span_id = next(self._ids)
+        parent = _current_span.get()
+        span = Span(
+            name=name,
+            category=category,
+            span_id=span_id,
+            parent_id=parent.span_id if parent is not None else None,
+            start_ns=time.time_ns(),
+            thread_id=threading.get_ident(),
+            attributes=attributes,
+        )
+        token = _current_span.set(span)
+        start = time.perf_counter_ns()
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            span.duration_ns = time.perf_counter_ns() - start
+            _current_span.reset(token)
+            for exporter in self.exporters:
+                exporter.export(span)
+
+    def close(self) -> None:
+        for exporter in self.exporters:
+            exporter.close()
+
+_tracer = Tracer()
+
+def get_tracer() -> Tracer:
+    """
+    The tracer used by the agent, the providers and the tools
+    """
+    return _tracer
+
+def set_tracer(tracer: Tracer) -> Tracer:
+    """
+    Replaces the tracer and returns the previous one
+    """
+    global _tracer
+    previous, _tracer = _tracer, tracer
+    return previous
+
+def span(name: str, category: str, **attributes: Any) -> Any:
+    """
+    Shorthand for get_tracer().span(...)
+    """
+    return _tracer.span(name, category, **attributes)
@@ -1,23 +1,35 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Any, Dict, List, Literal, Optional, Callable
 
 Role = Literal["system", "user", "assistant", "tool"]
 
-@dataclass
+@dataclass(slots=True)
 class Message:
     """
     A class that represents a message in the conversation with the LLM
 
+    Messages are slotted, as long sessions hold thousands of them; the content and payload of identical tool outputs
+    are shared through the blob store.
+
     Attributes:
         role: The role this message belongs to
         content: The content of the message
         tool_call_id: (OpenAI): the tool call's id if there is any tool call in this message
         name: Optional tool/function name
+        arguments: Optional arguments the tool was called with (tool results only)
+        tool_calls: Optional tool calls requested by the model (assistant messages only)
+        payload: Optional structured output of the tool, content being its JSON encoding (tool results only)
+        digest: Optional address of the tool output in the blob store; a message with the digest of an earlier one but
+            different content refers to the earlier output instead of repeating it (tool results only)
     """
     role: Role
     content: str
     tool_call_id: Optional[str] = None
     name: Optional[str] = None
+    arguments: Optional[Dict[str, Any]] = None
+    tool_calls: Optional[List[ToolCall]] = None
+    payload: Optional[Any] = None
+    digest: Optional[str] = None
 
 @dataclass
 class ToolSpec:
@@ -29,11 +41,15 @@ class ToolSpec:
         description: The description of the tool
         parameters: A Dict describing the parameters of the tool
         func: The actual Python implementation of the tool
+        read_only: Whether the tool never modifies the working directory; read-only calls may run concurrently
+        path_arg: Optional name of the argument holding the path the tool operates on
     """
     name: str
     description: str
     parameters: Dict[str, Any]
     func: Callable[..., Any]
+    read_only: bool = False
+    path_arg: Optional[str] = None
 
 @dataclass
 class ToolCall:
@@ -63,6 +79,20 @@ class Response:
     tool_calls: List[ToolCall]
     usage: TokenUsage | None
 
+@dataclass
+class ResponseChunk:
+    """
+    A class describing a part of a streamed response from the LLM
+
+    Attributes:
+        text: The text generated since the previous chunk
+        tool_calls: The tool calls completed in this chunk
+        usage: Token usage statistics for the whole response; usually only set on the last chunk
+    """
+    text: str = ""
+    tool_calls: List[ToolCall] = field(default_factory=list)
+    usage: TokenUsage | None = None
+
 @dataclass
 class TokenUsage:
     """
@@ -71,6 +101,11 @@ class TokenUsage:
     Attributes:
         input_count: The count of input tokens
         output_count: The count of output tokens
+        cached_count: The part of the input tokens served from a (context or prompt) cache
+        cache_hit: Whether the request used an existing explicit context cache; False if one had to be created for
+            it, None if it used none
     """
     input_count: int
     output_count: int
+    cached_count: int = 0
+    cache_hit: Optional[bool] = None
@@ -0,0 +1,221 @@
+import difflib
+import os
+import re
+from dataclasses import dataclass
+from typing import Dict, Any, List, Optional, Tuple
+from core.file_cache import FileCache, get_cache
+from core.fileio import atomic_write
+from core.journal import record_write
+from core.types import ToolSpec
+
+_HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@")
+
+@dataclass
+class _Hunk:
+    """
+    A hunk of a unified diff
+
+    Attributes:
+        header: The "@@ ... @@" line of the hunk
+        old_start: The line the hunk starts at in the original file (1-based; 0 for an insertion at the very top)
+        old_count: The number of lines the header says the hunk expects in the file
+        old: The lines the hunk expects in the file (context and removed lines)
+        new: The lines replacing them (context and added lines)
+    """
+    header: str
+    old_start: int
+    old_count: int
+    old: List[str]
+    new: List[str]
+
+def _parse_unified_diff(patch: str) -> List[_Hunk]:
+    """
+    Raises ValueError if the patch changes more than one file
+    """
+    hunks: List[_Hunk] = []
+    lines = patch.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    for n, line in enumerate(lines):
+        match = _HUNK_HEADER.match(line)
+        # Once a hunk has all the lines its header counts, what follows may be the header of another file
+        complete = bool(hunks) and len(hunks[-1].old) >= hunks[-1].old_count
+        if match:
+            old_count = int(match.group(2)) if match.group(2) is not None else 1
+            hunks.append(_Hunk(header=line[:match.end()], old_start=int(match.group(1)), old_count=old_count, old=[], new=[]))
+        elif complete and (line.startswith("diff ") or (line.startswith("--- ") and n + 1 < len(lines) and lines[n + 1].startswith("+++ "))):
+            raise ValueError("the patch changes more than one file; pass a separate patch for each file")
+        elif not hunks or line.startswith("\\") or (complete and line == ""):
+            # File headers before the first hunk, "\ No newline at end of file" markers, blank lines after a hunk
+            continue
+        elif line.startswith("-"):
+            hunks[-1].old.append(line[1:])
+        elif line.startswith("+"):
+            hunks[-1].new.append(line[1:])
+        else:
+            # Context; some editors strip the leading space of empty context lines
+            hunks[-1].old.append(line[1:])
+            hunks[-1].new.append(line[1:])
+    return hunks
+
+def _find_block(lines: List[str], block: List[str], expected: int, start: int) -> Optional[int]:
+    # The match closest to where the hunk says it is, as patch(1) does when earlier parts of the file have changed
+    positions = sorted(range(start, len(lines) - len(block) + 1), key=lambda pos: abs(pos - expected))
+    for pos in positions:
+        if lines[pos:pos + len(block)] == block:
+            return pos
+    return None
+
+def _describe_mismatch(lines: List[str], block: List[str], expected: int) -> str:
+    for k, wanted in enumerate(block):
+        if expected + k >= len(lines):
+            return f"the file ends at line {len(lines)}, the hunk expects {wanted!r} at line {expected + k + 1}"
+        if lines[expected + k] != wanted:
+            return f"line {expected + k + 1} is {lines[expected + k]!r}, the hunk expects {wanted!r}"
+    return "its lines were not found"
+
+def _apply_unified_diff(content: str, patch: str) -> Tuple[Optional[str], str]:
+    try:
+        hunks = _parse_unified_diff(patch.replace("\r\n", "\n"))
+    except ValueError as e:
+        return None, str(e)
+    if not hunks:
+        return None, "the patch contains no hunks (\"@@ -start,count +start,count @@\" lines)"
+
+    # Files with Windows line endings are matched and patched by their lines and written back with the same endings
+    crlf = "\r\n" in content and content.count("\r\n") == content.count("\n")
+    lines = content.replace("\r\n", "\n").split("\n") if crlf else content.split("\n")
+    # How far the hunks have to be moved because of the hunks before them, and where the next one may start
+    offset = 0
+    start = 0
+    for n, hunk in enumerate(hunks, 1):
+        if not hunk.old:
+            pos = min(max(hunk.old_start + offset, start), len(lines))
+        else:
+            expected = max(hunk.old_start - 1 + offset, 0)
+            pos = _find_block(lines, hunk.old, expected, start)
+            if pos is None:
+                return None, f"hunk {n} ({hunk.header}) does not match: {_describe_mismatch(lines, hunk.old, expected)}"
+            offset = pos - (hunk.old_start - 1)
+
+        lines[pos:pos + len(hunk.old)] = hunk.new
+        offset += len(hunk.new) - len(hunk.old)
+        start = pos + len(hunk.new)
+
+    return ("\r\n" if crlf else "\n").join(lines), f"{len(hunks)} hunks applied"
+
+def _apply_edits(content: str, edits: List[Dict[str, str]]) -> Tuple[Optional[str], str]:
+    for n, edit in enumerate(edits, 1):
+        search, replace = edit["search"], edit["replace"]
+        count = content.count(search) if search else 0
+        if count == 1:
+            content = content.replace(search, replace, 1)
+            continue
+
+        if not search:
+            return None, f"edit {n} has an empty search text"
+        if count > 1:
+            return None, f"the search text of edit {n} occurs {count} times; include more surrounding lines to make it unique"
+
+        reason = f"the search text of edit {n} was not found"
+        first_line = next((l for l in search.split("\n") if l.strip()), "")
+        lines = content.split("\n")
+        close = difflib.get_close_matches(first_line, lines, n=1, cutoff=0.6)
+        if close:
+            reason += f"; the most similar line is {lines.index(close[0]) + 1}: {close[0]!r} (check whitespace and indentation)"
+        return None, reason
+
+    return content, f"{len(edits)} edits applied"
+
+def edit_file(working_directory: str, file_path: str, edits: Optional[List[Dict[str, str]]] = None,
+              patch: Optional[str] = None, cache: Optional[FileCache] = None) -> str:
+    working_directory_abs = os.path.abspath(working_directory)
+
+    if not os.path.isabs(file_path):
+        file_path_abs = os.path.realpath(os.path.abspath(os.path.join(working_directory_abs, file_path)))
+    else:
+        file_path_abs = os.path.realpath(os.path.abspath(file_path))
+
+    if os.path.commonpath([working_directory_abs, file_path_abs]) != working_directory_abs:
+        return f'Error: Cannot edit "{file_path}" as it is outside the permitted working directory'
+
+    if not os.path.isfile(file_path_abs):
+        return f'Error: File not found or is not a regular file: "{file_path}"; use write_file to create new files'
+
+    if (edits is None) == (patch is None):
+        return 'Error: Pass either edits (search/replace blocks) or patch (a unified diff)'
+
+    try:
+        with open(file_path_abs, "rb") as f:
+            content = f.read().decode("utf-8")
+    except UnicodeDecodeError:
+        return f'Error: "{file_path}" is not a UTF-8 text file'
+
+    # Nothing is written unless every edit or hunk applies
+    if patch is not None:
+        new_content, summary = _apply_unified_diff(content, patch)
+    else:
+        new_content, summary = _apply_edits(content, edits)
+    if new_content is None:
+        return f'Error: Cannot edit "{file_path}": {summary}. No changes were made.'
+
+    data = new_content.encode("utf-8")
+    try:
+        record_write(file_path_abs, working_directory_abs)
+        atomic_write(file_path_abs, data)
+    except OSError as e:
+        return f'Error: Cannot write "{file_path}"; error: {e}'
+
+    if cache is not None:
+        cache.put(file_path_abs, data)
+
+    lines_before = len(content.splitlines())
+    lines_after = len(new_content.splitlines())
+    return f'Successfully edited "{file_path}" ({summary}, {lines_before} -> {lines_after} lines)'
+
+def build_tool(working_directory: str) -> ToolSpec:
+    def _fn(file_path: str, edits: Optional[List[Dict[str, str]]] = None, patch: Optional[str] = None) -> str:
+        return edit_file(working_directory=working_directory, file_path=file_path, edits=edits, patch=patch, cache=get_cache())
+
+    schema: Dict[str, Any] = {
+        "type": "object",
+        "properties": {
+            "file_path": {
+                "type": "string",
+                "description": "The path to the file to edit, relative to the working directory. Required.",
+            },
+            "edits": {
+                "type": "array",
+                "description": "Search/replace blocks applied in order. Every search text must occur exactly once in the file at the time it is applied.",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "search": {
+                            "type": "string",
+                            "description": "The exact text to replace, including whitespace and indentation.",
+                        },
+                        "replace": {
+                            "type": "string",
+                            "description": "The text to replace it with.",
+                        },
+                    },
+                    "required": ["search", "replace"],
+                    "additionalProperties": False,
+                },
+            },
+            "patch": {
+                "type": "string",
+                "description": "A unified diff of the file (\"@@ -start,count +start,count @@\" hunks with \" \", \"-\" and \"+\" lines). Use instead of edits.",
+            }
+        },
+        "required": ["file_path"],
+        "additionalProperties": False,
+    }
+
+    return ToolSpec(
+        name="edit_file",
+        description="Changes parts of an existing file, constrained to the working directory, with search/replace blocks or a unified diff. Much cheaper than rewriting the whole file with write_file. Either all changes are applied or, if one does not match, none.",
+        parameters=schema,
+        func=_fn,
+        path_arg="file_path",
+    )
@@ -1,11 +1,16 @@
 import os
-from  typing import Dict, Any
+from  typing import Dict, Any, Optional
+from core.file_cache import FileCache, get_cache
+from core.file_index import IndexedFile
+from core.reads import ReadLog, current_reads
 from core.types import ToolSpec
 
 MAX_CHARS = 10000
 
 
-def get_file_content(working_directory: str, file_path: str) -> str:
+def get_file_content(working_directory: str, file_path: str, offset: Optional[int] = None, length: Optional[int] = None,
+                     start_line: Optional[int] = None, end_line: Optional[int] = None, cache: Optional[FileCache] = None,
+                     seen: Optional[ReadLog] = None, refresh: bool = False) -> str:
     working_directory_abs = os.path.abspath(working_directory)
 
     if not os.path.isabs(file_path):
@@ -19,17 +24,68 @@ def get_file_content(working_directory: str, file_path: str) -> str:
     if not os.path.isfile(file_path_abs):
         return f'Error: File not found or is not a regular file: "{file_path}"'
 
-    with open(file_path_abs, "r") as f:
-        file_content_string = f.read(MAX_CHARS)
+    by_lines = start_line is not None or end_line is not None
+    if by_lines and (offset is not None or length is not None):
+        return 'Error: Use either offset/length or start_line/end_line, not both'
 
-        if len(file_content_string) > MAX_CHARS:
-            file_content_string += f'[...File "{file_path}" truncated at {MAX_CHARS} characters]'
+    # Small files are served from the cache, larger ones are mapped
+    data, st = (cache.read(file_path_abs) if cache is not None else None) or (None, None)
+    with IndexedFile(file_path_abs, data, st) as f:
+        # seen holds every read returned before with the version of the file it returned
+        read_key = (file_path_abs, offset, length, start_line, end_line)
+        if seen is not None and not refresh and seen.get(read_key) == f.signature:
+            return (f'File "{file_path}" is unchanged since you last read it ({f.size} bytes and {f.lines} lines in total), '
+                    'so its content was not sent again. Read it with refresh=true if you no longer have that output.')
+
+        if by_lines:
+            first = start_line or 1
+            last = f.lines if end_line is None else min(end_line, f.lines)
+            if first > max(f.lines, 1) or last < first:
+                return f'Error: Invalid line range {first}-{last} for "{file_path}" ({f.lines} lines)'
+            start = f.line_offset(first - 1)
+            end = f.line_offset(last)
+        else:
+            start = offset or 0
+            if start > f.size:
+                return f'Error: Offset {start} is past the end of "{file_path}" ({f.size} bytes)'
+            end = f.size if length is None else min(f.size, start + length)
+
+        truncated = end - start > MAX_CHARS
+        # Whether a truncated read can be continued with start_line
+        on_line = False
+        if truncated:
+            end = start + MAX_CHARS
+            cut = f.data.rfind(b"\n", start, end) + 1 if by_lines else 0
+            if cut > start:
+                # Line reads end on a line boundary so they can be continued with start_line
+                end = cut
+                on_line = True
+            else:
+                # A single line longer than MAX_CHARS is cut inside the line, and continued by offset
+                # Do not split a multi-byte UTF-8 character
+                while end > start and f.data[end] & 0xC0 == 0x80:
+                    end -= 1
+
+        file_content_string = f.data[start:end].decode("utf-8", errors="replace")
+        shown_lines = f'lines {f.line_at(start)}-{f.line_at(end - 1)}' if end > start else 'no lines'
+        summary = f'{f.size} bytes and {f.lines} lines in total, showing {shown_lines} (offset {start}, {end - start} bytes)'
+
+        if seen is not None:
+            seen.record(read_key, f.signature)
+
+        if truncated:
+            next_read = f'start_line={f.line_at(end)}' if on_line else f'offset={end}'
+            file_content_string += f'\n[...File "{file_path}" truncated at {MAX_CHARS} characters; {summary}. Continue with {next_read}]'
+        else:
+            file_content_string += f'\n[File "{file_path}": {summary}]'
 
         return file_content_string
 
 def build_tool(working_directory: str) -> ToolSpec:
-    def _fn(file_path: str) -> str:
-        return get_file_content(working_directory=working_directory, file_path=file_path)
+    def _fn(file_path: str, offset: Optional[int] = None, length: Optional[int] = None,
+            start_line: Optional[int] = None, end_line: Optional[int] = None, refresh: bool = False) -> str:
+        return get_file_content(working_directory=working_directory, file_path=file_path, offset=offset, length=length,
+                                start_line=start_line, end_line=end_line, cache=get_cache(), seen=current_reads.get(), refresh=refresh)
 
     schema: Dict[str, Any] = {
         "type": "object",
@@ -37,6 +93,30 @@ def build_tool(working_directory: str) -> ToolSpec:
             "file_path": {
                 "type": "string",
                 "description": "The path to the file to read from, relative to the working directory. Required.",
+            },
+            "offset": {
+                "type": "integer",
+                "minimum": 0,
+                "description": "The byte offset to start reading at. Defaults to 0.",
+            },
+            "length": {
+                "type": "integer",
+                "minimum": 0,
+                "description": "The number of bytes to read. Defaults to the rest of the file.",
+            },
+            "start_line": {
+                "type": "integer",
+                "minimum": 1,
+                "description": "The first line to read (1-based). Cannot be combined with offset/length.",
+            },
+            "end_line": {
+                "type": "integer",
+                "minimum": 1,
+                "description": "The last line to read (inclusive). Defaults to the last line of the file.",
+            },
+            "refresh": {
+                "type": "boolean",
+                "description": "Return the content even if it is unchanged since it was last read. Defaults to false.",
             }
         },
         "required": ["file_path"],
@@ -45,7 +125,9 @@ def build_tool(working_directory: str) -> ToolSpec:
 
     return ToolSpec(
         name="get_file_content",
-        description=f"Reads the content from the file located at the given file_path, constrained to the working directory, as a string truncated to {MAX_CHARS} characters.",
+        description=f"Reads the content from the file located at the given file_path, constrained to the working directory, as a string truncated to {MAX_CHARS} bytes of UTF-8. A byte range (offset/length) or line range (start_line/end_line) can be given to page through larger files; the total size and line count are reported after the content. Rereading an unchanged file only returns a notice unless refresh is set.",
         parameters=schema,
         func=_fn,
+        read_only=True,
+        path_arg="file_path",
     )
@@ -1,10 +1,17 @@
+import itertools
 import os
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+from core.file_cache import FileCache, get_cache
+from core.listing import SORT_KEYS, list_tree
 from core.types import ToolSpec
-from functools import reduce
 
+# Entries returned per call; more can be fetched with the cursor given at the end of the listing
+MAX_ENTRIES = 200
 
-def get_files_info(working_directory: str, directory: str =".") -> str:
+
+def get_files_info(working_directory: str, directory: str =".", max_depth: int = 0, glob: Optional[str] = None,
+                   gitignore: bool = False, sort: str = "name", limit: int = MAX_ENTRIES, cursor: Optional[str] = None,
+                   cache: Optional[FileCache] = None) -> str:
     working_directory_abs = os.path.abspath(working_directory)
 
     if not os.path.isabs(directory):
@@ -15,30 +22,36 @@ def get_files_info(working_directory: str, directory: str =".") -> str:
     if os.path.commonpath([working_directory_abs, directory_abs]) != working_directory_abs:
         return f'Error: Cannot list "{directory}" as it is outside the permitted working directory'
 
+    # Listings in tree order continue after the last path returned; the other orders need the whole tree anyway, so
+    # their cursor is the number of entries returned by the previous pages
+    by_name = sort == "name"
+    if cursor is not None and not by_name and not cursor.isdigit():
+        return f'Error: Invalid cursor "{cursor}"'
+    start = 0 if by_name else int(cursor or 0)
+
     try:
         if not os.path.isdir(directory_abs):
             return f'Error: "{directory}" is not a directory'
 
-        dir_contents = os.listdir(directory_abs)
+        entries = list_tree(directory_abs, root=os.path.realpath(working_directory_abs), max_depth=max_depth, glob=glob,
+                            gitignore=gitignore, sort=sort, after=cursor if by_name else None, cache=cache)
+        # One entry more than requested, to know whether there is another page
+        page = list(itertools.islice(entries, start, start + limit + 1))
     except Exception as e:
         return f"Error reading directory contents: {e}"
 
-    def handle_entry(acc, entry):
-        entry_path = directory_abs + "/" + entry
-        is_dir = os.path.isdir(entry_path)
-        file_size = os.path.getsize(entry_path)
-        return acc + f"- {entry}: file_size={file_size} bytes, is_dir={is_dir}\n"
+    lines = [f"- {e.path}: file_size={e.size} bytes, is_dir={e.is_dir}\n" for e in page[:limit]]
+    if len(page) > limit:
+        next_cursor = page[limit - 1].path if by_name else start + limit
+        lines.append(f'[...More entries follow; continue with cursor="{next_cursor}"]\n')
 
-    try:
-        result = reduce(handle_entry, dir_contents, "")
-    except Exception as e:
-        return f"Error reading directory contents: {e}"
-
-    return result
+    return "".join(lines)
 
 def build_tool(working_directory: str) -> ToolSpec:
-    def _fn(directory: str = ".") -> str:
-        return get_files_info(working_directory=working_directory, directory=directory)
+    def _fn(directory: str = ".", max_depth: int = 0, glob: Optional[str] = None, gitignore: bool = False,
+            sort: str = "name", limit: int = MAX_ENTRIES, cursor: Optional[str] = None) -> str:
+        return get_files_info(working_directory=working_directory, directory=directory, max_depth=max_depth, glob=glob,
+                              gitignore=gitignore, sort=sort, limit=limit, cursor=cursor, cache=get_cache())
 
     schema: Dict[str, Any] = {
         "type": "object",
@@ -46,6 +59,34 @@ def build_tool(working_directory: str) -> ToolSpec:
             "directory": {
                 "type": "string",
                 "description": "The directory to list files from, relative to the working directory. If not provided, lists files in the working directory itself.",
+            },
+            "max_depth": {
+                "type": "integer",
+                "minimum": 0,
+                "description": "How many levels of subdirectories to list as well; paths are then given relative to directory. Defaults to 0.",
+            },
+            "glob": {
+                "type": "string",
+                "description": "Only list entries matching this glob, e.g. \"*.py\" (matched against names) or \"src/**/test_*.py\" (matched against relative paths).",
+            },
+            "gitignore": {
+                "type": "boolean",
+                "description": "Skip .git directories and entries ignored by .gitignore files. Defaults to false.",
+            },
+            "sort": {
+                "type": "string",
+                "enum": SORT_KEYS,
+                "description": "Order of the entries: \"name\" (tree order), \"size\" (largest first) or \"mtime\" (newest first). Defaults to \"name\".",
+            },
+            "limit": {
+                "type": "integer",
+                "minimum": 1,
+                "maximum": 1000,
+                "description": f"The maximum number of entries to return. Defaults to {MAX_ENTRIES}.",
+            },
+            "cursor": {
+                "type": "string",
+                "description": "The cursor given at the end of a previous, incomplete listing to continue from.",
             }
         },
         "additionalProperties": False,
@@ -53,7 +94,9 @@ def build_tool(working_directory: str) -> ToolSpec:
 
     return ToolSpec(
         name="get_files_info",
-        description="Lists files in the specified directory along with their sizes, constrained to the working directory",
+        description="Lists files in the specified directory along with their sizes, constrained to the working directory. Can list a whole tree in one call (max_depth), filtered by a glob and .gitignore, sorted, and paged with a cursor.",
         parameters=schema,
         func=_fn,
+        read_only=True,
+        path_arg="directory",
     )
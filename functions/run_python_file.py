@@ -1,10 +1,103 @@
 import os
 import subprocess
-from typing import List, Dict, Any
+import threading
+from typing import List, Dict, Any, Optional, Tuple
+from core.file_cache import FileCache, get_cache
+from core.python_workers import PythonWorkerPool, get_pool
 from core.types import ToolSpec
 
+TIMEOUT_SECONDS = 30
+# Bytes of stdout and of stderr kept in the result; the middle of longer output is elided
+MAX_OUTPUT_BYTES = 32 * 1024
+# A script producing more output than this (stdout and stderr combined) is killed instead of being left to finish
+KILL_OUTPUT_BYTES = 8 * 1024 * 1024
+READ_CHUNK_BYTES = 64 * 1024
+# How long to keep draining the pipes after the script exited, in case a child process still holds them open
+DRAIN_SECONDS = 1
 
-def run_python_file(working_directory: str, file_path: str, args: List[str]=[]) -> str:
+class _BoundedOutput:
+    """
+    Keeps the first and the last max_bytes / 2 bytes written to it, only counting everything in between
+    """
+    def __init__(self, max_bytes: int):
+        self.tail_bytes = max_bytes // 2
+        self.head_bytes = max_bytes - self.tail_bytes
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def write(self, data: bytes) -> None:
+        self.total += len(data)
+        room = self.head_bytes - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if not data or self.tail_bytes == 0:
+            return
+        if len(data) >= self.tail_bytes:
+            self.tail = bytearray(data[-self.tail_bytes:])
+        else:
+            self.tail += data
+            del self.tail[:-self.tail_bytes]
+
+    def getvalue(self) -> bytes:
+        elided = self.total - len(self.head) - len(self.tail)
+        if elided == 0:
+            return bytes(self.head + self.tail)
+        return bytes(self.head) + f"\n[... {elided} bytes elided ...]\n".encode("utf-8") + bytes(self.tail)
+
+def _capture(process: subprocess.Popen, timeout: float, max_bytes: int, kill_bytes: int) -> Tuple[bytes, bytes, Optional[str]]:
+    """
+    Reads stdout and stderr of the process as they are produced, keeping at most max_bytes of each
+
+    Returns the retained stdout and stderr and, if the process had to be killed, the reason why.
+    """
+    outputs = (_BoundedOutput(max_bytes), _BoundedOutput(max_bytes))
+    lock = threading.Lock()
+    total = 0
+    reason: Optional[str] = None
+
+    def pump(pipe, output: _BoundedOutput) -> None:
+        nonlocal total, reason
+        try:
+            while chunk := pipe.read1(READ_CHUNK_BYTES):
+                with lock:
+                    output.write(chunk)
+                    total += len(chunk)
+                    if total > kill_bytes and reason is None:
+                        reason = f'Process was killed after producing more than {kill_bytes} bytes of output'
+                        process.kill()
+        except (OSError, ValueError):
+            pass
+        finally:
+            # Closed by the reader itself; closing a pipe another thread is blocked on would wait for that read
+            pipe.close()
+
+    readers = [
+        threading.Thread(target=pump, args=(process.stdout, outputs[0]), daemon=True),
+        threading.Thread(target=pump, args=(process.stderr, outputs[1]), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        with lock:
+            reason = reason or f'Process timed out after {timeout} seconds and was killed'
+        process.kill()
+        process.wait()
+
+    for reader in readers:
+        reader.join(timeout=DRAIN_SECONDS)
+
+    with lock:
+        return outputs[0].getvalue(), outputs[1].getvalue(), reason
+
+
+def run_python_file(working_directory: str, file_path: str, args: List[str]=[], pool: Optional[PythonWorkerPool] = None,
+                    timeout: float = TIMEOUT_SECONDS, max_output_bytes: int = MAX_OUTPUT_BYTES,
+                    kill_output_bytes: int = KILL_OUTPUT_BYTES, cache: Optional[FileCache] = None) -> str:
     working_directory_abs = os.path.abspath(working_directory)
 
     if not os.path.isabs(file_path):
@@ -23,18 +116,27 @@ def run_python_file(working_directory: str, file_path: str, args: List[str]=[])
 
     try:
         cmd = ['python3', file_path_abs, *args] if args else ['python3', file_path_abs]
-        completed_process = subprocess.run(
-            cmd,
-            capture_output=True,
-            timeout=30,
-        )
 
-        if len(completed_process.stdout) == 0 and len(completed_process.stderr) == 0 and completed_process.returncode == 0:
+        # Prefer a warm interpreter; the pool declines files it cannot run exactly like a cold one would
+        process = pool.start(file_path_abs, args) if pool is not None else None
+        if process is None:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        stdout, stderr, killed = _capture(process, timeout, max_output_bytes, kill_output_bytes)
+        # The script may have changed files in place; cached contents are revalidated anyway, listings are not
+        if cache is not None:
+            cache.invalidate_listings()
+        completed_process = subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+        if len(completed_process.stdout) == 0 and len(completed_process.stderr) == 0 and completed_process.returncode == 0 and killed is None:
             return f'No output produced'
 
-        return_string = f'STDOUT: {completed_process.stdout.decode('utf-8')}\n'
-        return_string += f'STDERR: {completed_process.stderr.decode('utf-8')}\n'
+        # The retained head and tail may cut a multi-byte character in half
+        return_string = f'STDOUT: {completed_process.stdout.decode('utf-8', errors='replace')}\n'
+        return_string += f'STDERR: {completed_process.stderr.decode('utf-8', errors='replace')}\n'
 
+        if killed is not None:
+            return_string += f'{killed}\n'
         if completed_process.returncode != 0:
             return_string += f'Process exited with return code {completed_process.returncode}'
 
@@ -44,7 +146,8 @@ def run_python_file(working_directory: str, file_path: str, args: List[str]=[])
 
 def build_tool(working_directory: str) -> ToolSpec:
     def _fn(file_path: str, args: List[str]=[]) -> str:
-        return run_python_file(working_directory=working_directory, file_path=file_path, args=args)
+        return run_python_file(working_directory=working_directory, file_path=file_path, args=args, pool=get_pool(working_directory),
+                               cache=get_cache())
 
     schema: Dict[str, Any] = {
         "type": "object",
@@ -54,7 +157,8 @@ def build_tool(working_directory: str) -> ToolSpec:
                 "description": "The path to the Python file which will be executed, relative to the working directory. Required.",
             },
             "args": {
-                "type": "string",
+                "type": "array",
+                "items": {"type": "string"},
                 "description": "An optional list of arguments which are passed to the Python file. Defaults to [] if not specified.",
             }
         },
@@ -67,4 +171,5 @@ def build_tool(working_directory: str) -> ToolSpec:
         description="Executes the Python file located at file_path, constrained to the working directory, passing the optional args to it.",
         parameters=schema,
         func=_fn,
+        # No path_arg: the program may read or write any file, so it waits for (and blocks) every modifying call
     )
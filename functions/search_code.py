@@ -0,0 +1,139 @@
+import os
+import re
+from typing import Dict, Any, List, Optional
+from core.file_cache import FileCache, get_cache
+from core.listing import glob_to_regex
+from core.search_index import SearchIndex, get_index, required_literals
+from core.types import ToolSpec
+
+MAX_RESULTS = 50
+# Longer lines are cut in the snippets
+MAX_LINE_CHARS = 200
+
+
+def search_code(working_directory: str, query: str, regex: bool = False, ignore_case: bool = False,
+                directory: str = ".", glob: Optional[str] = None, context: int = 0, max_results: int = MAX_RESULTS,
+                index: Optional[SearchIndex] = None, cache: Optional[FileCache] = None) -> str:
+    working_directory_abs = os.path.realpath(os.path.abspath(working_directory))
+
+    if not os.path.isabs(directory):
+        directory_abs = os.path.realpath(os.path.abspath(os.path.join(working_directory_abs, directory)))
+    else:
+        directory_abs = os.path.realpath(os.path.abspath(directory))
+
+    if os.path.commonpath([working_directory_abs, directory_abs]) != working_directory_abs:
+        return f'Error: Cannot search "{directory}" as it is outside the permitted working directory'
+
+    if not os.path.isdir(directory_abs):
+        return f'Error: "{directory}" is not a directory'
+
+    if not query:
+        return 'Error: The query must not be empty'
+
+    try:
+        pattern = re.compile(query if regex else re.escape(query), re.IGNORECASE if ignore_case else 0)
+    except re.error as e:
+        return f'Error: Invalid regular expression "{query}": {e}'
+
+    if index is None:
+        index = get_index(working_directory_abs, cache=cache)
+    index.refresh()
+
+    prefix = os.path.relpath(directory_abs, working_directory_abs).replace(os.sep, "/")
+    prefix = "" if prefix == "." else prefix + "/"
+    path_filter = glob_to_regex(glob) if glob else None
+
+    lines_out: List[str] = []
+    matches = 0
+    files = 0
+    for path in index.candidates(required_literals(query) if regex else [query]):
+        if not path.startswith(prefix):
+            continue
+        relative = path[len(prefix):]
+        if path_filter is not None and not path_filter.fullmatch(relative if "/" in glob else relative.rsplit("/", 1)[-1]):
+            continue
+
+        text = index.read(path)
+        if text is None:
+            continue
+        lines = text.splitlines()
+        hits = [i for i, line in enumerate(lines) if pattern.search(line)]
+        if not hits:
+            continue
+
+        files += 1
+        shown = -1
+        for i in hits:
+            if matches == max_results:
+                break
+            matches += 1
+            for j in range(max(i - context, shown + 1), min(i + context + 1, len(lines))):
+                line = lines[j] if len(lines[j]) <= MAX_LINE_CHARS else lines[j][:MAX_LINE_CHARS] + "..."
+                # grep style: ":" marks matching lines, "-" context lines
+                separator = ":" if j == i or pattern.search(lines[j]) else "-"
+                lines_out.append(f"{path}{separator}{j + 1}{separator} {line}\n")
+                shown = j
+        if matches == max_results:
+            lines_out.append(f"[...Stopped after {max_results} matches; narrow down the query or raise max_results]\n")
+            return "".join(lines_out)
+
+    if matches == 0:
+        return f'No matches found for "{query}"'
+
+    lines_out.append(f"[{matches} matches in {files} files]\n")
+    return "".join(lines_out)
+
+def build_tool(working_directory: str) -> ToolSpec:
+    def _fn(query: str, regex: bool = False, ignore_case: bool = False, directory: str = ".", glob: Optional[str] = None,
+            context: int = 0, max_results: int = MAX_RESULTS) -> str:
+        return search_code(working_directory=working_directory, query=query, regex=regex, ignore_case=ignore_case,
+                           directory=directory, glob=glob, context=context, max_results=max_results, cache=get_cache())
+
+    schema: Dict[str, Any] = {
+        "type": "object",
+        "properties": {
+            "query": {
+                "type": "string",
+                "description": "The text to search for. Required.",
+            },
+            "regex": {
+                "type": "boolean",
+                "description": "Treat the query as a Python regular expression instead of literal text. Defaults to false.",
+            },
+            "ignore_case": {
+                "type": "boolean",
+                "description": "Match regardless of case. Defaults to false.",
+            },
+            "directory": {
+                "type": "string",
+                "description": "Only search files below this directory, relative to the working directory. Defaults to the working directory itself.",
+            },
+            "glob": {
+                "type": "string",
+                "description": "Only search files matching this glob, e.g. \"*.py\" (matched against names) or \"src/**/*.py\" (matched against paths relative to directory).",
+            },
+            "context": {
+                "type": "integer",
+                "minimum": 0,
+                "maximum": 10,
+                "description": "The number of lines to show before and after every match. Defaults to 0.",
+            },
+            "max_results": {
+                "type": "integer",
+                "minimum": 1,
+                "maximum": 500,
+                "description": f"The maximum number of matching lines to return. Defaults to {MAX_RESULTS}.",
+            }
+        },
+        "required": ["query"],
+        "additionalProperties": False,
+    }
+
+    return ToolSpec(
+        name="search_code",
+        description="Searches the text files in the working directory (skipping those ignored by .gitignore) line by line for literal text or a regular expression, returning the matching lines as \"path:line: text\".",
+        parameters=schema,
+        func=_fn,
+        read_only=True,
+        path_arg="directory",
+    )
@@ -1,9 +1,12 @@
 import os
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+from core.file_cache import FileCache, get_cache
+from core.fileio import atomic_write
+from core.journal import record_write
 from core.types import ToolSpec
 
 
-def write_file(working_directory: str, file_path: str, content: str) -> str:
+def write_file(working_directory: str, file_path: str, content: str, cache: Optional[FileCache] = None) -> str:
     working_directory_abs = os.path.abspath(working_directory)
 
     if not os.path.isabs(file_path):
@@ -14,22 +17,26 @@ def write_file(working_directory: str, file_path: str, content: str) -> str:
     if os.path.commonpath([working_directory_abs, file_path_abs]) != working_directory_abs:
         return f'Error: Cannot write to "{file_path}" as it is outside the permitted working directory'
 
-    # Create the file path and the file if it does not exist yet
-    if not os.path.exists(file_path_abs):
-        try:
-            os.makedirs(os.path.dirname(file_path_abs), exist_ok=True)
-            open(file_path_abs, 'a').close()
-        except Exception as e:
-            return f'Error: Cannot create "{file_path}"; error: {e}'
+    data = content.encode("utf-8")
+    try:
+        # Journaled before anything changes, including the directories created for a new file
+        record_write(file_path_abs, working_directory_abs)
+        os.makedirs(os.path.dirname(file_path_abs), exist_ok=True)
+    except Exception as e:
+        return f'Error: Cannot create "{file_path}"; error: {e}'
 
-    with open(file_path_abs, 'w') as f:
-        f.write(content)
+    # Replaced in one step, so an interrupted write never leaves a truncated file behind
+    atomic_write(file_path_abs, data)
 
-        return f'Successfully wrote to "{file_path}" ({len(content)} characters written)'
+    if cache is not None:
+        # Write through, so reading the file back does not have to go to disk
+        cache.put(file_path_abs, data)
+
+    return f'Successfully wrote to "{file_path}" ({len(content)} characters written)'
 
 def build_tool(working_directory: str) -> ToolSpec:
     def _fn(file_path: str, content: str) -> str:
-        return write_file(working_directory=working_directory, file_path=file_path, content=content)
+        return write_file(working_directory=working_directory, file_path=file_path, content=content, cache=get_cache())
 
     schema: Dict[str, Any] = {
         "type": "object",
@@ -52,4 +59,5 @@ def build_tool(working_directory: str) -> ToolSpec:
         description="Writes the given content to a file located at file_path, constrained to the working directory, overwriting existing contents of the file.",
         parameters=schema,
         func=_fn,
+        path_arg="file_path",
     )
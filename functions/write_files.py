@@ -0,0 +1,153 @@
+import os
+from typing import Dict, Any, List, Optional, Set, Tuple
+from core.file_cache import FileCache, get_cache
+from core.fileio import discard_staged, fsync_directory, stage_write
+from core.journal import current_journal, record_write
+from core.types import ToolSpec
+
+
+def _make_directories(directory: str, created: List[str]) -> None:
+    # Like os.makedirs, adding the directories it creates to created, outermost first
+    missing: List[str] = []
+    while not os.path.isdir(directory):
+        missing.append(directory)
+        directory = os.path.dirname(directory)
+    for directory in reversed(missing):
+        try:
+            os.mkdir(directory)
+        except FileExistsError:
+            continue
+        created.append(directory)
+
+def _remove_directories(created: List[str]) -> None:
+    # Removes the directories created for a failed call again, unless something else was put into them meanwhile
+    for directory in reversed(created):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+
+def _undo(committed: List[Tuple[str, str, bytes]], recorded: Set[str]) -> str:
+    # Files replaced before a failed commit are restored if the journal recorded them for this call, i.e. holds
+    # their state from just before it
+    if not committed:
+        return 'No files were changed.'
+    journal = current_journal.get()
+    restored = [t for t in committed if t[1] in recorded] if journal is not None else []
+    if restored:
+        try:
+            journal.restore([t[1] for t in restored])
+        except Exception as e:
+            return f'Rolling back failed ({e}); these files were written: ' + ", ".join(f'"{t[0]}"' for t in committed)
+
+    written = [t for t in committed if t not in restored]
+    if not written:
+        return 'The files written before were rolled back, so no files were changed.'
+    return 'These files were written nonetheless: ' + ", ".join(f'"{t[0]}"' for t in written)
+
+def write_files(working_directory: str, files: List[Dict[str, str]], cache: Optional[FileCache] = None) -> str:
+    working_directory_abs = os.path.abspath(working_directory)
+
+    if not files:
+        return 'Error: No files given'
+
+    # Check every path before touching anything
+    targets: List[Tuple[str, str, bytes]] = []
+    for entry in files:
+        file_path = entry["file_path"]
+        if not os.path.isabs(file_path):
+            file_path_abs = os.path.realpath(os.path.abspath(os.path.join(working_directory_abs, file_path)))
+        else:
+            file_path_abs = os.path.realpath(os.path.abspath(file_path))
+
+        if os.path.commonpath([working_directory_abs, file_path_abs]) != working_directory_abs:
+            return f'Error: Cannot write to "{file_path}" as it is outside the permitted working directory. No files were changed.'
+        if os.path.isdir(file_path_abs):
+            return f'Error: Cannot write to "{file_path}" as it is a directory. No files were changed.'
+        if any(t[1] == file_path_abs for t in targets):
+            return f'Error: "{file_path}" is given more than once. No files were changed.'
+        targets.append((file_path, file_path_abs, entry["content"].encode("utf-8")))
+
+    # Stage every file next to its target and flush it to disk; a failure here leaves the tree untouched
+    staged: List[str] = []
+    # The files whose original state the journal recorded for this call
+    recorded: Set[str] = set()
+    # The directories created for the new files
+    created: List[str] = []
+    try:
+        for file_path, file_path_abs, data in targets:
+            if record_write(file_path_abs, working_directory_abs):
+                recorded.add(file_path_abs)
+            _make_directories(os.path.dirname(file_path_abs), created)
+            staged.append(stage_write(file_path_abs, data))
+    except Exception as e:
+        for tmp_path in staged:
+            discard_staged(tmp_path)
+        _remove_directories(created)
+        return f'Error: Cannot write "{file_path}"; error: {e}. No files were changed.'
+
+    # Commit with one atomic rename per file; an interruption in between can be undone through the journal
+    committed: List[Tuple[str, str, bytes]] = []
+    try:
+        for tmp_path, target in zip(staged, targets):
+            os.replace(tmp_path, target[1])
+            committed.append(target)
+    except Exception as e:
+        for tmp_path in staged[len(committed):]:
+            discard_staged(tmp_path)
+        message = f'Error: Cannot write "{targets[len(committed)][0]}"; error: {e}. ' + _undo(committed, recorded)
+        _remove_directories(created)
+        return message
+
+    # Every file is in place by now, so failing to make the renames durable is only worth a note
+    note = ""
+    try:
+        for directory in {os.path.dirname(t[1]) for t in targets}:
+            fsync_directory(directory)
+    except OSError as e:
+        note = f' (the directories could not be flushed to disk; error: {e})'
+
+    if cache is not None:
+        for _, file_path_abs, data in targets:
+            cache.put(file_path_abs, data)
+
+    written = sum(len(entry["content"]) for entry in files)
+    return f'Successfully wrote {len(targets)} files ({written} characters written): ' + ", ".join(f'"{t[0]}"' for t in targets) + note
+
+def build_tool(working_directory: str) -> ToolSpec:
+    def _fn(files: List[Dict[str, str]]) -> str:
+        return write_files(working_directory=working_directory, files=files, cache=get_cache())
+
+    schema: Dict[str, Any] = {
+        "type": "object",
+        "properties": {
+            "files": {
+                "type": "array",
+                "description": "The files to write. Required.",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "file_path": {
+                            "type": "string",
+                            "description": "The path to the file to write to, relative to the working directory.",
+                        },
+                        "content": {
+                            "type": "string",
+                            "description": "The content to write to the file.",
+                        },
+                    },
+                    "required": ["file_path", "content"],
+                    "additionalProperties": False,
+                },
+            }
+        },
+        "required": ["files"],
+        "additionalProperties": False,
+    }
+
+    return ToolSpec(
+        name="write_files",
+        description="Writes several files at once, constrained to the working directory, overwriting existing contents. Either all files are written or, if one of them cannot be, none. Prefer this over several write_file calls.",
+        parameters=schema,
+        func=_fn,
+    )
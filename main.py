@@ -1,50 +1,179 @@
 import argparse
+import functools
 import os
+import sys
+from typing import Optional
 from dotenv import load_dotenv
 from core.agent import Agent
+from core.batch import LINK_MODES, load_tasks, run_batch
+from core.context import ContextManager, provider_summarizer
+from core import python_workers
+from core.journal import WriteJournal
 from core.registry import load_tools
+from core.session import SessionStore
+from core.tracing import ChromeTraceExporter, JsonlExporter, Tracer, set_tracer
 from providers.provider import Provider
-from providers.gemini_provider import GeminiProvider
-from config import SYSTEM_PROMPT, DEFAULT_BACKEND
+from providers.caching_provider import CachingProvider
+from providers import scheduler
+from providers.registry import load_provider, provider_names
+from providers.scheduler import ScheduledProvider
+from config import SYSTEM_PROMPT, DEFAULT_BACKEND, CONTEXT_TOKEN_BUDGET, RESPONSE_CACHE_MAX_BYTES
 
 # Command line arguments
 cli_parser = argparse.ArgumentParser()
-cli_parser.add_argument("prompt", help="The prompt being sent to the underlying LLM")
+cli_parser.add_argument("prompt", nargs="?", help="The prompt being sent to the underlying LLM")
 cli_parser.add_argument("-v", "--verbose", help="Enable verbose output", action="store_true")
-cli_parser.add_argument("--backend", choices=["gemini", "ollama"], default=DEFAULT_BACKEND)
+cli_parser.add_argument("--backend", choices=provider_names(), default=DEFAULT_BACKEND)
 cli_parser.add_argument("-w", "--working-directory", help="The working directory to use", default="./calculator")
+cli_parser.add_argument("--no-stream", help="Wait for complete responses instead of printing them as they arrive", action="store_true")
+cli_parser.add_argument("--context-budget", help="Estimated token budget of the conversation history; once exceeded, old tool outputs are stubbed or truncated (default: 0, no compaction)", type=int, default=CONTEXT_TOKEN_BUDGET)
+cli_parser.add_argument("--summarize", help="Summarize old messages when compaction alone does not fit the context budget", action="store_true")
+cli_parser.add_argument("--cache-dir", help="Record model responses in this directory and reuse them for identical requests")
+cli_parser.add_argument("--replay", help="Only answer from the response cache and fail on requests that were not recorded", action="store_true")
+cli_parser.add_argument("--warm-workers", help="Keep this many pre-started Python interpreters for run_python_file (0 disables)", type=int, default=0)
+cli_parser.add_argument("--tool-workers", help="The number of tool calls of a single step which may run concurrently", type=int, default=1)
+cli_parser.add_argument("--journal-dir", help="Record the original state of every file changed by the agent in this directory")
+cli_parser.add_argument("--rollback", help="Undo the file changes recorded in --journal-dir (e.g. by an aborted run) and exit", action="store_true")
+cli_parser.add_argument("--max-steps", help="The maximum number of model calls of this run", type=int, default=20)
+cli_parser.add_argument("--session-dir", help="Save the conversation to this directory after every step so it can be resumed")
+cli_parser.add_argument("--resume", metavar="ID", help="Continue the session with this id from --session-dir; a prompt is sent as a follow-up")
+cli_parser.add_argument("--requests-per-minute", help="Limit the model requests per minute (0 for no limit)", type=int, default=0)
+cli_parser.add_argument("--tokens-per-minute", help="Limit the estimated model tokens per minute (0 for no limit)", type=int, default=0)
+cli_parser.add_argument("--trace", metavar="FILE", help="Write timing spans of model calls, message conversions and tool executions to this file")
+cli_parser.add_argument("--batch", metavar="TASKS", help="Run the tasks of a JSONL file (prompt, working_directory, max_steps, id) in parallel, each in its own copy of its working directory")
+cli_parser.add_argument("--batch-workers", help="The number of worker processes of --batch", type=int, default=os.cpu_count())
+cli_parser.add_argument("--batch-output", metavar="FILE", help="Write the JSONL results of --batch to this file instead of stdout")
+cli_parser.add_argument("--workspace-dir", help="The directory the task workspaces of --batch are created in (default: a new temporary directory)")
+cli_parser.add_argument("--link", help="How --batch copies working directories: copy-on-write clones (falling back to copies), hard links, or copies", choices=LINK_MODES, default="reflink")
+cli_parser.add_argument("--dedupe-outputs", help="Send tool outputs identical to an earlier one as a reference to it instead of repeating them", action="store_true")
+cli_parser.add_argument("--trace-format", help="The format of --trace: JSON lines, or Chrome trace events for chrome://tracing and Perfetto", choices=["jsonl", "chrome"], default="jsonl")
 
 # Load environment vars
 load_dotenv()
 
 def build_provider(backend: str) -> Provider:
     if backend == "gemini":
-        return GeminiProvider(
+        return load_provider("gemini")(
             api_key=os.environ.get("GEMINI_API_KEY"),
             model=os.getenv("GEMINI_MODEL", "gemini-2.5-flash"),
             system_prompt=SYSTEM_PROMPT,
+            context_cache=os.getenv("GEMINI_CONTEXT_CACHE", "") not in ("", "0"),
+        )
+    elif backend == "ollama":
+        return load_provider("ollama")(
+            base_url=os.getenv("OLLAMA_BASE_URL", "http://localhost:11434/v1"),
+            model=os.getenv("OLLAMA_MODEL", "gpt-oss-20b"),
+            system_prompt=SYSTEM_PROMPT,
+            api_key=os.getenv("OLLAMA_API_KEY"),
         )
-    #elif backend == "ollama":
-    #    return OpenAIProvider(
-    #        base_url=os.getenv("OLLAMA_BASE_URL", "http://localhost:11434/v1"),
-    #        model=os.getenv("OLLAMA_MODEL", "gpt-oss-20b"),
-    #        system_prompt=SYSTEM_PROMPT,
-    #    )
     else:
-        raise ValueError(f"Unknown backend: {backend}")
+        # Backends added with register_provider configure themselves
+        return load_provider(backend)(system_prompt=SYSTEM_PROMPT)
+
+def create_provider(backend: str, cache_dir: Optional[str] = None, replay: bool = False, requests_per_minute: int = 0, tokens_per_minute: int = 0) -> Provider:
+    # Rate limits and retries of transient errors; cached responses bypass them
+    scheduler.configure(requests_per_minute, tokens_per_minute)
+    provider: Provider = ScheduledProvider(build_provider(backend))
+    if cache_dir:
+        provider = CachingProvider(provider, cache_dir=cache_dir, max_bytes=RESPONSE_CACHE_MAX_BYTES, replay=replay)
+    return provider
+
+def create_agent(provider: Provider, working_directory: str, tool_workers: int = 1, context_budget: int = CONTEXT_TOKEN_BUDGET, summarize: bool = False, journal: Optional[WriteJournal] = None, dedupe_outputs: bool = False) -> Agent:
+    context = None
+    if context_budget > 0:
+        context = ContextManager(
+            token_budget=context_budget,
+            summarizer=provider_summarizer(provider) if summarize else None,
+        )
+
+    # Load tool specs
+    tools = load_tools(working_directory=working_directory)
+    return Agent(provider=provider, tools=tools, system_prompt=SYSTEM_PROMPT, max_tool_workers=tool_workers, context=context, journal=journal, dedupe_outputs=dedupe_outputs)
+
+def batch(args: argparse.Namespace) -> None:
+    try:
+        tasks = load_tasks(args.batch)
+    except (OSError, ValueError) as e:
+        cli_parser.error(str(e))
+
+    # The rate limits are shared out among the worker processes (rounded up, so no limit becomes 0 = unlimited)
+    workers = max(1, min(args.batch_workers, len(tasks)))
+    provider_factory = functools.partial(
+        create_provider, args.backend, args.cache_dir, args.replay,
+        -(-args.requests_per_minute // workers), -(-args.tokens_per_minute // workers),
+    )
+    agent_factory = functools.partial(create_agent, tool_workers=args.tool_workers, context_budget=args.context_budget, summarize=args.summarize, dedupe_outputs=args.dedupe_outputs)
+
+    output = open(args.batch_output, "w", encoding="utf-8") if args.batch_output else sys.stdout
+    try:
+        summary = run_batch(tasks, provider_factory, agent_factory, output, workers=workers, workspace_root=args.workspace_dir, link=args.link)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print(
+        f"{summary.tasks} tasks in {summary.seconds:.1f} s ({summary.tasks_per_minute:.1f} tasks/min): "
+        f"{summary.done} done, {summary.incomplete} out of steps, {summary.failed} failed; "
+        f"{summary.input_tokens} input and {summary.output_tokens} output tokens",
+        file=sys.stderr,
+    )
 
 def main():
     args = cli_parser.parse_args()
 
-    # Load tool specs
-    tools = load_tools(working_directory=args.working_directory)
+    if args.rollback:
+        if not args.journal_dir:
+            cli_parser.error("--rollback requires --journal-dir")
+        for path in WriteJournal(args.journal_dir).rollback():
+            print(f"Restored {path}")
+        return
+    if args.replay and not args.cache_dir:
+        cli_parser.error("--replay requires --cache-dir")
+    if args.batch:
+        batch(args)
+        return
+    if args.resume and not args.session_dir:
+        cli_parser.error("--resume requires --session-dir")
+    if args.prompt is None and not args.resume:
+        cli_parser.error("the prompt is required")
+
+    session = None
+    if args.session_dir:
+        store = SessionStore(args.session_dir)
+        try:
+            session = store.load(args.resume) if args.resume else store.create()
+        except KeyError as e:
+            cli_parser.error(e.args[0])
+        print(f"Session {session.id} (continue with --session-dir {args.session_dir} --resume {session.id})")
+
+    python_workers.configure(args.warm_workers)
 
-    provider = build_provider(args.backend)
-    agent = Agent(provider=provider, tools=tools, system_prompt=SYSTEM_PROMPT)
+    if args.trace:
+        exporter = ChromeTraceExporter(args.trace) if args.trace_format == "chrome" else JsonlExporter(args.trace)
+        set_tracer(Tracer([exporter]))
 
-    out = agent.run(args.prompt, verbose=args.verbose)
+    provider = create_provider(args.backend, args.cache_dir, args.replay, args.requests_per_minute, args.tokens_per_minute)
+    journal = WriteJournal(args.journal_dir) if args.journal_dir else None
+    agent = create_agent(provider, args.working_directory, args.tool_workers, args.context_budget, args.summarize, journal, args.dedupe_outputs)
 
-    print(f"Final Response:\n{out}")
+    try:
+        if args.no_stream:
+            out = agent.run(args.prompt, max_steps=args.max_steps, verbose=args.verbose, session=session)
+            print(f"Final Response:\n{out}")
+        else:
+            agent.run(args.prompt, max_steps=args.max_steps, verbose=args.verbose, on_text=lambda delta: print(delta, end="", flush=True), session=session)
+            print()
+        if args.verbose:
+            print(f"Requests: {scheduler.get_scheduler().metrics.snapshot()}")
+    except BaseException:
+        if journal is not None and journal.paths:
+            print(f"\nThe run was aborted; undo its changes with: --rollback --journal-dir {args.journal_dir}")
+        raise
+    finally:
+        # E.g. deletes the context caches, which would otherwise be billed until they expire
+        provider.close()
+        if args.trace:
+            set_tracer(Tracer()).close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,177 @@
+import dataclasses
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from core.types import Message, Response, ResponseChunk, ToolSpec, ToolCall, TokenUsage
+from providers.provider import Provider
+
+class CacheMissError(LookupError):
+    """
+    Raised in replay mode when a request has not been recorded before
+    """
+
+def _message_key(m: Message) -> Dict[str, Any]:
+    # The payload and digest of tool results are derived from their content (and copying every payload on every
+    # request would be a waste)
+    key = {f.name: getattr(m, f.name) for f in dataclasses.fields(m) if f.name not in ("payload", "digest")}
+    if m.tool_calls is not None:
+        key["tool_calls"] = [dataclasses.asdict(t) for t in m.tool_calls]
+    return key
+
+def request_key(model: str, system_prompt: Optional[str], messages: List[Message], tools: List[ToolSpec]) -> str:
+    # A stable hash of everything that influences the response
+    request = {
+        "model": model,
+        "system_prompt": system_prompt or "",
+        "messages": [_message_key(m) for m in messages],
+        "tools": [{"name": t.name, "description": t.description, "parameters": t.parameters} for t in tools],
+    }
+    encoded = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+def _dump_response(response: Response) -> bytes:
+    return json.dumps(dataclasses.asdict(response)).encode("utf-8")
+
+def _load_response(data: bytes) -> Response:
+    raw: Dict[str, Any] = json.loads(data)
+    usage = raw.get("usage")
+    return Response(
+        assistant_text=raw["assistant_text"],
+        tool_calls=[ToolCall(**t) for t in raw["tool_calls"]],
+        usage=TokenUsage(**usage) if usage else None,
+    )
+
+class ResponseStore:
+    """
+    An on-disk store of responses, one file per request key, evicting the least recently used entries once the
+    total size exceeds max_bytes
+
+    Recency is tracked through the file modification times, which are refreshed on every hit.
+
+    Attributes:
+        directory: The directory holding the cached responses
+        max_bytes: The maximum total size of the store
+    """
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(e.stat().st_size for e in self._entries())
+
+    def _entries(self) -> List[os.DirEntry]:
+        return [e for e in os.scandir(self.directory) if e.is_file() and e.name.endswith(".json")]
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Response]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return _load_response(data)
+
+    def put(self, key: str, response: Response) -> None:
+        data = _dump_response(response)
+        path = self._path(key)
+
+        # Write atomically so concurrent readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+
+        with self._lock:
+            try:
+                self._size -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        entries = sorted(self._entries(), key=lambda e: e.stat().st_mtime_ns)
+        self._size = sum(e.stat().st_size for e in entries)
+        for e in entries:
+            if self._size <= self.max_bytes:
+                break
+            size = e.stat().st_size
+            try:
+                os.remove(e.path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+class CachingProvider(Provider):
+    """
+    Wraps another provider and records its responses in a ResponseStore
+
+    Attributes:
+        provider: The wrapped provider answering cache misses
+        store: The store of recorded responses
+        replay: In replay mode a cache miss raises CacheMissError instead of calling the wrapped provider
+        hits: The number of requests answered from the cache
+        misses: The number of requests not found in the cache
+    """
+    def __init__(self, provider: Provider, cache_dir: str, max_bytes: int = 256 * 1024 * 1024, replay: bool = False):
+        super().__init__(model=provider.model, system_prompt=provider.system_prompt)
+        self.provider = provider
+        self.store = ResponseStore(cache_dir, max_bytes)
+        self.replay = replay
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, messages: List[Message], tools: List[ToolSpec]) -> Tuple[str, Optional[Response]]:
+        key = request_key(self.model, self.system_prompt, messages, tools)
+        response = self.store.get(key)
+        if response is not None:
+            self.hits += 1
+            return key, response
+
+        self.misses += 1
+        if self.replay:
+            raise CacheMissError(f"No recorded response for request {key}")
+        return key, None
+
+    def chat(self, messages: List[Message], tools: List[ToolSpec]) -> Response:
+        key, response = self._lookup(messages, tools)
+        if response is None:
+            response = self.provider.chat(messages, tools)
+            self.store.put(key, response)
+        return response
+
+    async def achat(self, messages: List[Message], tools: List[ToolSpec]) -> Response:
+        key, response = self._lookup(messages, tools)
+        if response is None:
+            response = await self.provider.achat(messages, tools)
+            self.store.put(key, response)
+        return response
+
+    def chat_stream(self, messages: List[Message], tools: List[ToolSpec]) -> Iterator[ResponseChunk]:
+        key, response = self._lookup(messages, tools)
+        if response is not None:
+            yield ResponseChunk(text=response.assistant_text, tool_calls=response.tool_calls, usage=response.usage)
+            return
+
+        # Pass the chunks through while assembling the response to record
+        assistant_text = ""
+        tool_calls: List[ToolCall] = []
+        usage = None
+        for chunk in self.provider.chat_stream(messages, tools):
+            assistant_text += chunk.text
+            tool_calls.extend(chunk.tool_calls)
+            usage = chunk.usage or usage
+            yield chunk
+
+        self.store.put(key, Response(assistant_text=assistant_text, tool_calls=tool_calls, usage=usage))
+
+    def close(self) -> None:
+        self.provider.close()
@@ -0,0 +1,101 @@
+import asyncio
+import json
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Iterator
+from core.types import Message, Response, ResponseChunk, ToolSpec, ToolCall, TokenUsage
+from providers.provider import Provider
+
+def _estimate_usage(messages: List[Message], response: Response) -> TokenUsage:
+    # Roughly four characters per token, good enough for offline accounting
+    input_chars = sum(len(m.content) for m in messages)
+    return TokenUsage(input_count=input_chars // 4, output_count=len(response.assistant_text) // 4)
+
+def parse_scenario(scenario: Dict[str, Any]) -> List[Response]:
+    """
+    Converts a scenario into the scripted responses of a FakeProvider
+
+    A scenario is a dict with a list of steps, each with optional text, tool calls and token usage:
+        {"steps": [
+            {"text": "Let me look around", "tool_calls": [{"name": "get_files_info", "arguments": {"directory": "pkg"}}]},
+            {"text": "Job's done.", "usage": {"input_count": 1200, "output_count": 40}}
+        ]}
+    """
+    responses: List[Response] = []
+    for i, step in enumerate(scenario["steps"]):
+        tool_calls = [
+            ToolCall(id=call.get("id", f"call_{i}_{j}"), name=call["name"], arguments=call.get("arguments", {}))
+            for j, call in enumerate(step.get("tool_calls", []))
+        ]
+        usage = step.get("usage")
+        responses.append(Response(
+            assistant_text=step.get("text", ""),
+            tool_calls=tool_calls,
+            usage=TokenUsage(**usage) if usage else None,
+        ))
+    return responses
+
+class FakeProvider(Provider):
+    """
+    An offline provider replaying a fixed script of responses, e.g. for tests and load tests
+
+    Attributes:
+        responses: The responses returned in order; the last one is repeated once the script is exhausted
+        latency: Simulated seconds per model call
+    """
+    def __init__(self, responses: List[Response], model: str = "fake", system_prompt: Optional[str] = None, latency: float = 0.0):
+        super().__init__(model=model, system_prompt=system_prompt)
+        if not responses:
+            raise ValueError("FakeProvider needs at least one response")
+        self.responses = responses
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_scenario(cls, path: str, **kwargs: Any) -> "FakeProvider":
+        """
+        Creates a provider from a JSON scenario file (see parse_scenario); "model" and "latency" keys of the file are
+        used unless overridden by kwargs
+        """
+        with open(path, "r") as f:
+            scenario = json.load(f)
+
+        kwargs.setdefault("model", scenario.get("model", "fake"))
+        kwargs.setdefault("latency", scenario.get("latency", 0.0))
+        return cls(parse_scenario(scenario), **kwargs)
+
+    def _next(self, messages: List[Message]) -> Response:
+        with self._lock:
+            scripted = self.responses[min(self.calls, len(self.responses) - 1)]
+            self.calls += 1
+
+        return Response(
+            assistant_text=scripted.assistant_text,
+            tool_calls=list(scripted.tool_calls),
+            usage=scripted.usage or _estimate_usage(messages, scripted),
+        )
+
+    def chat(self, messages: List[Message], tools: List[ToolSpec]) -> Response:
+        if self.latency:
+            time.sleep(self.latency)
+        return self._next(messages)
+
+    async def achat(self, messages: List[Message], tools: List[ToolSpec]) -> Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._next(messages)
+
+    def chat_stream(self, messages: List[Message], tools: List[ToolSpec]) -> Iterator[ResponseChunk]:
+        # Streams the scripted text word by word, spreading the latency over the chunks
+        response = self._next(messages)
+        words = re.findall(r"\S+\s*", response.assistant_text)
+        for word in words:
+            if self.latency:
+                time.sleep(self.latency / len(words))
+            yield ResponseChunk(text=word)
+
+        for tool_call in response.tool_calls:
+            yield ResponseChunk(tool_calls=[tool_call])
+        yield ResponseChunk(usage=response.usage)
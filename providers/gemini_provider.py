@@ -1,37 +1,121 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Iterator
+from collections import OrderedDict
+from dataclasses import dataclass
+import asyncio
 import json
+import threading
+import time
 from google import genai
-from google.genai import types
-from core.types import Message, Response, ToolSpec, ToolCall, TokenUsage
+from google.genai import errors, types
+from core.context import estimate_messages_tokens, estimate_tokens
+from core.tracing import span
+from core.types import Message, Response, ResponseChunk, ToolSpec, ToolCall, TokenUsage
 from providers.provider import Provider
 
-def _to_gemini_messages(msgs: List[Message]) -> List[types.Content]:
-    out: List[types.Content] = []
+# Explicit context caching: the API rejects smaller prefixes (the minimum depends on the model)
+MIN_CACHED_TOKENS = 2048
+# Caches expire this long after they were created; the margin keeps requests from racing the expiry
+CACHE_TTL_SECONDS = 600
+CACHE_EXPIRY_MARGIN_SECONDS = 30
+# The prefix is cached anew once the history sent on top of it has grown to this fraction of it
+RECACHE_RATIO = 0.5
 
-    for m in msgs:
-        # Skip system messages (Gemini uses the parameter system_instruction in generate_content()
-        if m.role == "system":
-            continue
+def _to_gemini_message(m: Message) -> Optional[types.Content]:
+    # Skip system messages (Gemini uses the parameter system_instruction in generate_content()
+    if m.role == "system":
+        return None
 
-        # Map assistant -> model
-        role = "model" if m.role == "assistant" else m.role
+    # Map assistant -> model
+    role = "model" if m.role == "assistant" else m.role
 
-        # Convert text to text parts and tool results to function_response parts
-        if role == "tool" and m.name:
-            # Parse the JSON content back to a dict (agent.py JSON-dumps it as a string)
+    # The model's own function calls precede their results
+    if role == "model" and m.tool_calls:
+        parts = [types.Part(text=m.content)] if m.content else []
+        parts += [types.Part(function_call=types.FunctionCall(id=t.id, name=t.name, args=t.arguments)) for t in m.tool_calls]
+        return types.Content(role=role, parts=parts)
+
+    # Convert text to text parts and tool results to function_response parts
+    if role == "tool" and m.name:
+        # Tool results carry their structured output; otherwise parse the JSON content back to a dict
+        response_dict = m.payload
+        if not isinstance(response_dict, dict):
             try:
                 response_dict = json.loads(m.content)
             except json.JSONDecodeError:
                 # Fallback: Wrap raw content if it's not JSON
                 response_dict = {"result": m.content}
-            part = types.Part.from_function_response(name=m.name, response=response_dict)
-            #out.append(types.Content(role="tool", parts=[part]))
-            out.append(types.Content(role="user", parts=[part]))
-        else:
-            out.append(types.Content(role=role, parts=[types.Part(text=m.content)]))
+        part = types.Part.from_function_response(name=m.name, response=response_dict)
+        #return types.Content(role="tool", parts=[part])
+        return types.Content(role="user", parts=[part])
+
+    return types.Content(role=role, parts=[types.Part(text=m.content)])
+
+def _to_gemini_messages(msgs: List[Message]) -> List[types.Content]:
+    out: List[types.Content] = []
+
+    with span("convert_messages", "convert", messages=len(msgs), converted=len(msgs)):
+        for m in msgs:
+            content = _to_gemini_message(m)
+            if content is not None:
+                out.append(content)
 
     return out
 
+class _MessageConverter:
+    """
+    Incrementally converts a growing conversation to Gemini contents
+
+    Only the messages appended since the previous call are converted; the longest prefix of Message objects that
+    are identical (by identity, not equality) to the previous call is reused. Messages are therefore treated as
+    immutable once they have been sent: replace a Message instead of modifying it.
+    """
+    def __init__(self):
+        self._sources: List[Message] = []
+        self._converted: List[Optional[types.Content]] = []
+        # The context cache of the conversation, and the estimated prefix size at which creating one last failed
+        self.prefix: Optional[_CachedPrefix] = None
+        self.failed_tokens = 0
+
+    def convert(self, msgs: List[Message]) -> List[types.Content]:
+        reused = 0
+        for old, new in zip(self._sources, msgs):
+            if old is not new:
+                break
+            reused += 1
+
+        del self._sources[reused:]
+        del self._converted[reused:]
+        with span("convert_messages", "convert", messages=len(msgs), converted=len(msgs) - reused):
+            for m in msgs[reused:]:
+                self._sources.append(m)
+                self._converted.append(_to_gemini_message(m))
+
+        return [c for c in self._converted if c is not None]
+
+    def converted_count(self, n: int) -> int:
+        # The number of contents the first n messages of the last call were converted to
+        return sum(c is not None for c in self._converted[:n])
+
+@dataclass
+class _CachedPrefix:
+    """
+    The start of a conversation cached on the server together with the system instruction and the tools
+
+    Attributes:
+        name: The resource name of the cached content
+        sources: The cached messages, compared by identity like in _MessageConverter
+        contents: The number of converted contents the messages amount to
+        tokens: The estimated size of the cached content
+        tools_key: The identities of the cached tool specs
+        expires: The time.monotonic() after which the cache is no longer used
+    """
+    name: str
+    sources: List[Message]
+    contents: int
+    tokens: int
+    tools_key: Tuple[int, ...]
+    expires: float
+
 def _to_gemini_tool(tool: ToolSpec) -> types.FunctionDeclaration:
     # Convert our provider-agnostic JSON schema from dict to a JSONSchema object
     json_schema_obj = types.JSONSchema.model_validate(tool.parameters)
@@ -42,51 +126,218 @@ def _to_gemini_tool(tool: ToolSpec) -> types.FunctionDeclaration:
         parameters=types.Schema.from_json_schema(json_schema=json_schema_obj),
     )
 
+def _from_gemini_usage(response: types.GenerateContentResponse, cache_hit: Optional[bool] = None) -> Optional[TokenUsage]:
+    usage_raw = getattr(response, "usage_metadata", None)
+    usage = None
+    if usage_raw:
+        usage = TokenUsage(
+            input_count=usage_raw.prompt_token_count or 0,
+            output_count=usage_raw.candidates_token_count or 0,
+            cached_count=usage_raw.cached_content_token_count or 0,
+            cache_hit=cache_hit,
+        )
+    return usage
+
+def _from_gemini_tool_calls(response: types.GenerateContentResponse) -> List[ToolCall]:
+    tool_calls: List[ToolCall] = []
+    if response.function_calls:
+        for f in response.function_calls:
+            tool_calls.append(ToolCall(id=None, name=f.name, arguments=dict(f.args or {})))
+    return tool_calls
+
+def _from_gemini_response(response: types.GenerateContentResponse, cache_hit: Optional[bool] = None) -> Response:
+    # Convert response back
+    return Response(
+        assistant_text=response.text or "",
+        tool_calls=_from_gemini_tool_calls(response),
+        usage=_from_gemini_usage(response, cache_hit),
+    )
+
 class GeminiProvider(Provider):
-    def __init__(self, api_key: str, model: str = "gemini-2.0-flash-001", system_prompt: Optional[str] = None):
+    """
+    A provider for the Gemini API
+
+    With context_cache set, the stable start of a conversation (the system instruction, the tools and all but the
+    newest message) is cached on the server once it is large enough, and following requests only send the messages
+    after it. The cache is created anew when compaction replaces a cached message, when the history on top of it has
+    grown by RECACHE_RATIO, and when it expires; whether a request used an existing cache is reported in its usage.
+
+    Attributes:
+        client: The genai client; another object with the same models and caches surface can be passed, e.g. an
+            offline stub
+        context_cache: Whether explicit context caching is used
+        cache_ttl: The lifetime of the caches in seconds
+    """
+    # The number of conversations whose converted history is kept around
+    MAX_CACHED_CONVERSATIONS = 64
+
+    def __init__(self, api_key: Optional[str], model: str = "gemini-2.0-flash-001", system_prompt: Optional[str] = None,
+                 client: Any = None, context_cache: bool = False, cache_ttl: int = CACHE_TTL_SECONDS):
         super().__init__(model=model, system_prompt=system_prompt)
-        self.client = genai.Client(api_key=api_key)
+        self.client = client if client is not None else genai.Client(api_key=api_key)
+        self.context_cache = context_cache
+        self.cache_ttl = cache_ttl
         #self.model = model
         #self.system_prompt = system_prompt
 
-    #def chat(self, messages: List[Message], tools: List[ToolSpec]) -> Dict[str, Any]:
-    def chat(self, messages: List[Message], tools: List[ToolSpec]) -> Response:
+        # Converted tool bundles keyed by the identity of the tool specs; the specs are kept alongside so the ids
+        # cannot be reused while the entry exists
+        self._tool_cache: Dict[Tuple[int, ...], Tuple[List[ToolSpec], types.Tool]] = {}
+        # Incremental converters keyed by the identity of the message list the agent keeps appending to
+        self._converters: OrderedDict[int, _MessageConverter] = OrderedDict()
+        self._lock = threading.Lock()
 
-        gemini_msgs  = _to_gemini_messages(messages)
-        gemini_tools = [_to_gemini_tool(t) for t in tools]
-        tool_bundle  = types.Tool(function_declarations=gemini_tools)
+    def _tool_bundle(self, tools: List[ToolSpec]) -> types.Tool:
+        key = tuple(id(t) for t in tools)
+        with self._lock:
+            cached = self._tool_cache.get(key)
+        if cached is not None:
+            return cached[1]
 
-        response = self.client.models.generate_content(
-            model=self.model,
-            contents=gemini_msgs,
-            config=types.GenerateContentConfig(
-                system_instruction=self.system_prompt or "",
-                tools=[tool_bundle],
-            )
+        tool_bundle = types.Tool(function_declarations=[_to_gemini_tool(t) for t in tools])
+        with self._lock:
+            self._tool_cache[key] = (list(tools), tool_bundle)
+        return tool_bundle
+
+    def _converter(self, messages: List[Message]) -> _MessageConverter:
+        key = id(messages)
+        evicted: List[_MessageConverter] = []
+        with self._lock:
+            converter = self._converters.pop(key, None) or _MessageConverter()
+            self._converters[key] = converter
+            while len(self._converters) > self.MAX_CACHED_CONVERSATIONS:
+                evicted.append(self._converters.popitem(last=False)[1])
+        for old in evicted:
+            if old.prefix is not None:
+                self._delete_cache(old.prefix.name)
+
+        # A reused id of a garbage-collected list is harmless: none of its Message objects match the new list
+        return converter
+
+    def _contents(self, messages: List[Message]) -> List[types.Content]:
+        return self._converter(messages).convert(messages)
+
+    def _delete_cache(self, name: str) -> None:
+        try:
+            self.client.caches.delete(name=name)
+        except errors.APIError:
+            # It expires on its own
+            pass
+
+    def _cached_prefix(self, converter: _MessageConverter, messages: List[Message], contents: List[types.Content],
+                       tools: List[ToolSpec], tool_bundle: Optional[types.Tool]) -> Tuple[Optional[_CachedPrefix], Optional[bool]]:
+        """
+        Returns the context cache to use for the request, if any, and whether it existed before (None without one)
+        """
+        prefix = converter.prefix
+        tools_key = tuple(id(t) for t in tools)
+        valid = (
+            prefix is not None
+            and time.monotonic() < prefix.expires
+            and prefix.tools_key == tools_key
+            and len(prefix.sources) < len(messages)
+            and all(old is new for old, new in zip(prefix.sources, messages))
         )
 
-        # Convert response back
-        assistant_text = response.text or ""
-        tool_calls: List[ToolCall] = []
-        if response.function_calls:
-            for f in response.function_calls:
-                tool_calls.append(ToolCall(id=None, name=f.name, arguments=dict(f.args or {})))
+        # Everything but the newest message stays the same in the next request
+        stable = len(messages) - 1
+        tokens = (estimate_tokens(self.system_prompt or "") + estimate_messages_tokens(messages[:stable])
+                  + sum(estimate_tokens(t.description + json.dumps(t.parameters)) for t in tools))
+        if valid and tokens - prefix.tokens < RECACHE_RATIO * prefix.tokens:
+            return prefix, True
+        if tokens < max(MIN_CACHED_TOKENS, 2 * converter.failed_tokens) or converter.converted_count(stable) == 0:
+            return (prefix, True) if valid else (None, None)
 
-        usage_raw = getattr(response, "usage_metadata", None)
-        usage = None
-        if usage_raw:
-            usage = TokenUsage(
-                input_count=usage_raw.prompt_token_count or 0,
-                output_count=usage_raw.candidates_token_count or 0,
-            )
-        return Response(
-            assistant_text=assistant_text,
-            tool_calls=tool_calls,
-            usage=usage,
+        count = converter.converted_count(stable)
+        with span("create_cache", "provider", model=self.model, contents=count, estimated_tokens=tokens):
+            try:
+                cached = self.client.caches.create(model=self.model, config=types.CreateCachedContentConfig(
+                    contents=contents[:count],
+                    system_instruction=self.system_prompt or None,
+                    tools=[tool_bundle] if tool_bundle else None,
+                    ttl=f"{self.cache_ttl}s",
+                ))
+            except errors.APIError:
+                # E.g. a prefix below the minimum of the model, or a model without caching; retried once the prefix
+                # has doubled
+                converter.failed_tokens = tokens
+                return (prefix, True) if valid else (None, None)
+
+        if prefix is not None:
+            self._delete_cache(prefix.name)
+        converter.prefix = _CachedPrefix(
+            name=cached.name,
+            sources=messages[:stable],
+            contents=count,
+            tokens=tokens,
+            tools_key=tools_key,
+            expires=time.monotonic() + self.cache_ttl - CACHE_EXPIRY_MARGIN_SECONDS,
         )
-        #return {
-        #    "assistant_text": assistant_text,
-        #    "tool_calls": tool_calls,
-        #    "raw": response,
-        #    "usage": usage,
-        #}
+        return converter.prefix, False
+
+    def _prepare(self, messages: List[Message], tools: List[ToolSpec]) -> Tuple[Dict[str, Any], Optional[bool]]:
+        # Returns the request and whether it uses an existing context cache (None if it uses none)
+        converter = self._converter(messages)
+        gemini_msgs = converter.convert(messages)
+        # Gemini rejects a tool without any function declarations, e.g. for summarization requests
+        tool_bundle = self._tool_bundle(tools) if tools else None
+
+        if self.context_cache:
+            prefix, hit = self._cached_prefix(converter, messages, gemini_msgs, tools, tool_bundle)
+            if prefix is not None:
+                # The system instruction and the tools are part of the cache and must not be sent again
+                return {
+                    "model": self.model,
+                    "contents": gemini_msgs[prefix.contents:],
+                    "config": types.GenerateContentConfig(cached_content=prefix.name),
+                }, hit
+
+        return {
+            "model": self.model,
+            "contents": gemini_msgs,
+            "config": types.GenerateContentConfig(
+                system_instruction=self.system_prompt or "",
+                tools=[tool_bundle] if tool_bundle else None,
+            ),
+        }, None
+
+    def _request(self, messages: List[Message], tools: List[ToolSpec]) -> Dict[str, Any]:
+        return self._prepare(messages, tools)[0]
+
+    #def chat(self, messages: List[Message], tools: List[ToolSpec]) -> Dict[str, Any]:
+    def chat(self, messages: List[Message], tools: List[ToolSpec]) -> Response:
+        request, cache_hit = self._prepare(messages, tools)
+        response = self.client.models.generate_content(**request)
+        return _from_gemini_response(response, cache_hit)
+
+    async def achat(self, messages: List[Message], tools: List[ToolSpec]) -> Response:
+        # Creating a context cache is a blocking call
+        if self.context_cache:
+            request, cache_hit = await asyncio.to_thread(self._prepare, messages, tools)
+        else:
+            request, cache_hit = self._prepare(messages, tools)
+        # Uses the native async surface of the genai client instead of a worker thread
+        response = await self.client.aio.models.generate_content(**request)
+        return _from_gemini_response(response, cache_hit)
+
+    def chat_stream(self, messages: List[Message], tools: List[ToolSpec]) -> Iterator[ResponseChunk]:
+        request, cache_hit = self._prepare(messages, tools)
+        usage = None
+        for chunk in self.client.models.generate_content_stream(**request):
+            # Function calls are never split across chunks; usage metadata is cumulative, so only the last one counts
+            usage = _from_gemini_usage(chunk, cache_hit) or usage
+            text = chunk.text or ""
+            tool_calls = _from_gemini_tool_calls(chunk)
+            if text or tool_calls:
+                yield ResponseChunk(text=text, tool_calls=tool_calls)
+
+        yield ResponseChunk(usage=usage)
+
+    def close(self) -> None:
+        # Deletes the context caches instead of paying for them until they expire
+        with self._lock:
+            converters = list(self._converters.values())
+            self._converters.clear()
+        for converter in converters:
+            if converter.prefix is not None:
+                self._delete_cache(converter.prefix.name)
@@ -0,0 +1,262 @@
+import http.client
+import json
+import threading
+import urllib.parse
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from core.types import Message, Response, ResponseChunk, ToolSpec, ToolCall, TokenUsage
+from providers.provider import Provider
+
+# Local models can take minutes for a long answer
+TIMEOUT_SECONDS = 600
+# Idle keep-alive connections kept per provider; concurrent sessions beyond that open short-lived extra ones
+MAX_IDLE_CONNECTIONS = 8
+
+class OpenAIError(Exception):
+    """
+    An error response of the server
+
+    Attributes:
+        code: The HTTP status code
+        headers: The response headers, e.g. with a retry-after hint
+        body: The response body
+    """
+    def __init__(self, code: int, headers: Any, body: bytes):
+        self.code = code
+        self.headers = headers
+        self.body = body
+        try:
+            message = json.loads(body)["error"]["message"]
+        except (ValueError, KeyError, TypeError):
+            message = body.decode("utf-8", errors="replace")
+        super().__init__(f"{code}: {message}")
+
+class _ConnectionPool:
+    """
+    Idle keep-alive connections to one server, most recently used first
+    """
+    def __init__(self, base_url: str, max_idle: int, timeout: float):
+        parts = urllib.parse.urlsplit(base_url)
+        self._connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path.rstrip("/")
+        self.max_idle = max_idle
+        self.timeout = timeout
+        # The number of connections opened so far
+        self.created = 0
+        self._idle: List[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+
+    def get(self) -> Tuple[http.client.HTTPConnection, bool]:
+        # Returns a connection and whether it has been used before
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+            self.created += 1
+        return self._connection_class(self.host, self.port, timeout=self.timeout), False
+
+    def put(self, connection: http.client.HTTPConnection, response: http.client.HTTPResponse) -> None:
+        # The response has to be read completely before its connection can be reused
+        if response.will_close:
+            connection.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self) -> None:
+        with self._lock:
+            for connection in self._idle:
+                connection.close()
+            self._idle.clear()
+
+def _to_openai_tool(tool: ToolSpec) -> Dict[str, Any]:
+    return {
+        "type": "function",
+        "function": {"name": tool.name, "description": tool.description, "parameters": tool.parameters},
+    }
+
+def _to_openai_messages(msgs: List[Message], system_prompt: Optional[str]) -> List[Dict[str, Any]]:
+    out: List[Dict[str, Any]] = []
+    if system_prompt and not any(m.role == "system" for m in msgs):
+        out.append({"role": "system", "content": system_prompt})
+
+    # Providers like Gemini do not assign ids, but the protocol needs them to pair tool results with their calls;
+    # results come in the order of the calls
+    pending: List[str] = []
+    generated = 0
+    for m in msgs:
+        if m.role == "assistant" and m.tool_calls:
+            calls = []
+            pending = []
+            for t in m.tool_calls:
+                call_id = t.id
+                if call_id is None:
+                    call_id = f"call_{generated}"
+                    generated += 1
+                pending.append(call_id)
+                calls.append({"id": call_id, "type": "function", "function": {"name": t.name, "arguments": json.dumps(t.arguments)}})
+            out.append({"role": "assistant", "content": m.content or None, "tool_calls": calls})
+        elif m.role == "tool":
+            call_id = m.tool_call_id
+            if call_id is None:
+                call_id = pending[0] if pending else f"call_{generated}"
+            if call_id in pending:
+                pending.remove(call_id)
+            out.append({"role": "tool", "tool_call_id": call_id, "name": m.name, "content": m.content})
+        else:
+            out.append({"role": m.role, "content": m.content})
+
+    return out
+
+def _parse_arguments(arguments: Any) -> Dict[str, Any]:
+    # Arguments are a JSON string by the spec; some servers send an object. Malformed arguments end up as missing
+    # ones, which the tool registry reports back to the model.
+    if isinstance(arguments, dict):
+        return arguments
+    try:
+        parsed = json.loads(arguments or "{}")
+    except ValueError:
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+def _from_openai_usage(usage: Optional[Dict[str, Any]]) -> Optional[TokenUsage]:
+    if not usage:
+        return None
+    # Servers with prompt caching report the reused prefix in the details
+    details = usage.get("prompt_tokens_details") or {}
+    return TokenUsage(input_count=usage.get("prompt_tokens") or 0, output_count=usage.get("completion_tokens") or 0,
+                      cached_count=details.get("cached_tokens") or 0)
+
+def _from_streamed_calls(calls: Dict[int, Dict[str, Any]]) -> List[ToolCall]:
+    return [ToolCall(id=e["id"], name=e["name"], arguments=_parse_arguments(e["arguments"])) for _, e in sorted(calls.items())]
+
+def _from_openai_response(data: Dict[str, Any]) -> Response:
+    message = data["choices"][0]["message"]
+    return Response(
+        assistant_text=message.get("content") or "",
+        tool_calls=[
+            ToolCall(id=c.get("id"), name=c["function"]["name"], arguments=_parse_arguments(c["function"].get("arguments")))
+            for c in message.get("tool_calls") or []
+        ],
+        usage=_from_openai_usage(data.get("usage")),
+    )
+
+class OpenAIProvider(Provider):
+    """
+    A provider for servers speaking the OpenAI chat completions protocol, e.g. Ollama, llama.cpp or vLLM
+
+    Requests reuse keep-alive HTTP connections from a small pool instead of connecting for every step.
+
+    Attributes:
+        base_url: The URL the API paths are appended to, e.g. "http://localhost:11434/v1"
+        api_key: An optional bearer token
+        pool: The idle keep-alive connections to the server
+    """
+    def __init__(self, base_url: str, model: str, system_prompt: Optional[str] = None, api_key: Optional[str] = None,
+                 timeout: float = TIMEOUT_SECONDS, max_idle_connections: int = MAX_IDLE_CONNECTIONS):
+        super().__init__(model=model, system_prompt=system_prompt)
+        self.base_url = base_url
+        self.api_key = api_key
+        self.pool = _ConnectionPool(base_url, max_idle_connections, timeout)
+        self._headers = {"Content-Type": "application/json"}
+        if api_key:
+            self._headers["Authorization"] = f"Bearer {api_key}"
+
+    def _body(self, messages: List[Message], tools: List[ToolSpec], stream: bool) -> bytes:
+        body: Dict[str, Any] = {"model": self.model, "messages": _to_openai_messages(messages, self.system_prompt)}
+        if tools:
+            body["tools"] = [_to_openai_tool(t) for t in tools]
+        if stream:
+            body["stream"] = True
+            body["stream_options"] = {"include_usage": True}
+        return json.dumps(body).encode("utf-8")
+
+    def _post(self, path: str, body: bytes) -> Tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        while True:
+            connection, reused = self.pool.get()
+            try:
+                connection.request("POST", self.pool.path + path, body=body, headers=self._headers)
+                response = connection.getresponse()
+            except (ConnectionError, http.client.BadStatusLine):
+                connection.close()
+                # The server closed the idle connection before it got the request; errors of new ones are for the
+                # caller (or the scheduler) to handle
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+
+            if response.status >= 400:
+                data = response.read()
+                self.pool.put(connection, response)
+                raise OpenAIError(response.status, response.headers, data)
+            return connection, response
+
+    def chat(self, messages: List[Message], tools: List[ToolSpec]) -> Response:
+        connection, response = self._post("/chat/completions", self._body(messages, tools, stream=False))
+        try:
+            data = response.read()
+        except BaseException:
+            connection.close()
+            raise
+        self.pool.put(connection, response)
+        return _from_openai_response(json.loads(data))
+
+    def chat_stream(self, messages: List[Message], tools: List[ToolSpec]) -> Iterator[ResponseChunk]:
+        connection, response = self._post("/chat/completions", self._body(messages, tools, stream=True))
+
+        # Tool calls arrive in pieces keyed by their index and are passed on once complete
+        calls: Dict[int, Dict[str, Any]] = {}
+        usage = None
+        completed = False
+        try:
+            for line in response:
+                # Server-sent events: "data: {...}" lines, ending with "data: [DONE]"
+                if not line.startswith(b"data:"):
+                    continue
+                payload = line[len(b"data:"):].strip()
+                if payload == b"[DONE]":
+                    break
+                chunk = json.loads(payload)
+                usage = _from_openai_usage(chunk.get("usage")) or usage
+
+                for choice in chunk.get("choices") or []:
+                    delta = choice.get("delta") or {}
+                    for c in delta.get("tool_calls") or []:
+                        entry = calls.setdefault(c.get("index", len(calls)), {"id": None, "name": "", "arguments": ""})
+                        function = c.get("function") or {}
+                        entry["id"] = c.get("id") or entry["id"]
+                        entry["name"] = function.get("name") or entry["name"]
+                        arguments = function.get("arguments")
+                        if isinstance(arguments, dict):
+                            entry["arguments"] = json.dumps(arguments)
+                        elif arguments:
+                            entry["arguments"] += arguments
+
+                    if delta.get("content"):
+                        yield ResponseChunk(text=delta["content"])
+                    if choice.get("finish_reason") and calls:
+                        yield ResponseChunk(tool_calls=_from_streamed_calls(calls))
+                        calls = {}
+
+            # Drain the end of the body so the connection can be reused
+            response.read()
+            completed = True
+        finally:
+            # A stream abandoned halfway leaves the connection in an unknown state
+            if completed:
+                self.pool.put(connection, response)
+            else:
+                connection.close()
+
+        if calls:
+            yield ResponseChunk(tool_calls=_from_streamed_calls(calls))
+        yield ResponseChunk(usage=usage)
+
+    def close(self) -> None:
+        self.pool.close()
@@ -1,6 +1,7 @@
+import asyncio
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any, Optional
-from core.types import Message, Response, ToolSpec, ToolCall, TokenUsage
+from typing import List, Dict, Any, Optional, Iterator
+from core.types import Message, Response, ResponseChunk, ToolSpec, ToolCall, TokenUsage
 
 class Provider(ABC):
     @abstractmethod
@@ -12,3 +13,15 @@ class Provider(ABC):
     def chat(self, messages: List[Message], tools: List[ToolSpec]) -> Response:
         pass
 
+    async def achat(self, messages: List[Message], tools: List[ToolSpec]) -> Response:
+        # Providers without a native async client run their blocking chat() in a worker thread
+        return await asyncio.to_thread(self.chat, messages, tools)
+
+    def chat_stream(self, messages: List[Message], tools: List[ToolSpec]) -> Iterator[ResponseChunk]:
+        # Providers without streaming support deliver the whole response as a single chunk
+        response = self.chat(messages, tools)
+        yield ResponseChunk(text=response.assistant_text, tool_calls=response.tool_calls, usage=response.usage)
+
+    def close(self) -> None:
+        # Releases what the provider holds between requests (connections, server-side caches); it stays usable
+        pass
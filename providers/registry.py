@@ -0,0 +1,31 @@
+import importlib
+from typing import Callable, Dict, List
+from providers.provider import Provider
+
+# The provider class of every backend as a "module:attribute" reference (like a package entry point), resolved on
+# first use so that only the SDK of the chosen backend is imported
+PROVIDERS: Dict[str, str] = {
+    "gemini": "providers.gemini_provider:GeminiProvider",
+    "ollama": "providers.openai_provider:OpenAIProvider",
+}
+
+def register_provider(name: str, reference: str) -> None:
+    """
+    Adds (or replaces) a backend; reference is a "module:attribute" string of a Provider class or factory
+    """
+    if ":" not in reference:
+        raise ValueError(f"Invalid provider reference (expected module:attribute): {reference}")
+    PROVIDERS[name] = reference
+
+def provider_names() -> List[str]:
+    return list(PROVIDERS)
+
+def load_provider(name: str) -> Callable[..., Provider]:
+    """
+    Imports the module of a backend and returns its provider class
+    """
+    reference = PROVIDERS.get(name)
+    if reference is None:
+        raise ValueError(f"Unknown backend: {name}")
+    module, _, attribute = reference.partition(":")
+    return getattr(importlib.import_module(module), attribute)
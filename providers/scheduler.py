@@ -0,0 +1,409 @@
+import asyncio
+import heapq
+import itertools
+import random
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, Tuple, TypeVar
+from core.context import estimate_messages_tokens, estimate_tokens
+from core.tracing import span
+from core.types import Message, Response, ResponseChunk, ToolSpec, TokenUsage
+from providers.provider import Provider
+
+T = TypeVar("T")
+
+# Attempts after the first one for transient errors
+MAX_RETRIES = 5
+# Backoff before the n-th retry is drawn from [0, min(MAX_DELAY, BASE_DELAY * 2**n)] ("full jitter")
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+# HTTP status codes worth retrying: timeouts, rate limits and server errors
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+# The number of recent queueing delays kept for percentiles
+DELAY_SAMPLES = 1024
+
+def _retry_after_header(headers: Any) -> Optional[float]:
+    value = headers.get("retry-after") if headers is not None else None
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    # An HTTP date
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def _retry_info(details: Any) -> Optional[float]:
+    # Google APIs put the hint into the error details: {"error": {"details": [{"@type": "...RetryInfo", "retryDelay": "31s"}]}}
+    error = details.get("error", details) if isinstance(details, dict) else None
+    for detail in (error.get("details") or []) if isinstance(error, dict) else []:
+        match = re.fullmatch(r"([\d.]+)s", str(detail.get("retryDelay", ""))) if isinstance(detail, dict) else None
+        if match:
+            return float(match.group(1))
+    return None
+
+def classify_error(e: BaseException) -> Tuple[bool, Optional[float]]:
+    """
+    Tells whether a failed request is worth retrying, and after how many seconds the server asked to be retried
+    (None without a hint)
+
+    Works on exceptions carrying an HTTP status as code, status_code or status (urllib, the genai client, most SDKs)
+    and on connection errors and timeouts.
+    """
+    if isinstance(e, (ConnectionError, TimeoutError)) or any(c.__name__ == "TransportError" for c in type(e).__mro__):
+        # TransportError: connection problems and timeouts of httpx, which the genai client uses
+        return True, None
+
+    status = next((s for s in (getattr(e, a, None) for a in ("code", "status_code", "status")) if isinstance(s, int)), None)
+    if status not in RETRYABLE_STATUS:
+        return False, None
+
+    response = getattr(e, "response", None)
+    hint = _retry_after_header(getattr(e, "headers", None) or getattr(response, "headers", None))
+    if hint is None:
+        hint = _retry_info(getattr(e, "details", None))
+    return True, hint
+
+class TokenBucket:
+    """
+    A token bucket refilled at a constant rate, e.g. for requests or tokens per minute
+
+    Attributes:
+        per_minute: The refill rate
+        capacity: The largest burst; defaults to a minute's worth
+        level: The tokens currently available; negative after a request turned out to be bigger than estimated
+    """
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.per_minute = per_minute
+        self.capacity = capacity if capacity is not None else per_minute
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.per_minute / 60)
+        self._updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """
+        The seconds until amount tokens are available; amounts above the capacity only wait for a full bucket
+        """
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(missing, 0.0) * 60 / self.per_minute
+
+    def consume(self, amount: float, now: float) -> None:
+        # A negative amount returns tokens that were reserved but not used
+        self._refill(now)
+        self.level = min(self.capacity, self.level - amount)
+
+@dataclass
+class SchedulerMetrics:
+    """
+    Statistics of a RequestScheduler
+
+    Attributes:
+        requests: The number of attempts sent, including retries
+        retries: The number of attempts repeated after a transient error
+        failures: The number of calls that failed for good
+        queue_delay_total: The seconds attempts spent waiting for their turn, in total
+        queue_delay_max: The longest wait of a single attempt
+        recent_delays: The waits of the most recent attempts
+    """
+    requests: int = 0
+    retries: int = 0
+    failures: int = 0
+    queue_delay_total: float = 0.0
+    queue_delay_max: float = 0.0
+    recent_delays: Deque[float] = field(default_factory=lambda: deque(maxlen=DELAY_SAMPLES))
+
+    def snapshot(self) -> Dict[str, float]:
+        delays = sorted(self.recent_delays)
+        def percentile(p: float) -> float:
+            return delays[min(int(p * len(delays)), len(delays) - 1)] if delays else 0.0
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            "queue_delay_mean": self.queue_delay_total / self.requests if self.requests else 0.0,
+            "queue_delay_p50": percentile(0.5),
+            "queue_delay_p95": percentile(0.95),
+            "queue_delay_max": self.queue_delay_max,
+        }
+
+class _Ticket:
+    # A request waiting for its turn; async waiters are woken through their event loop
+    def __init__(self, tokens: int):
+        self.tokens = tokens
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.future: Optional[asyncio.Future] = None
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+class RequestScheduler:
+    """
+    Admits model requests in priority order within request and token rate limits, and retries transient failures
+    with jittered exponential backoff
+
+    Lower priority values go first; requests of equal priority are served in arrival order. A rate limit response
+    with a retry-after hint pauses all requests for that long, since they share the exhausted quota. Token counts
+    are estimated up front and corrected with settle() once the actual usage is known.
+
+    Attributes:
+        requests: The bucket of requests per minute, if limited
+        tokens: The bucket of tokens per minute, if limited
+        max_retries: The number of retries of a transient failure
+        base_delay: The backoff before the first retry is drawn from [0, base_delay]; it doubles with every retry
+        max_delay: The upper bound of the backoff
+        metrics: Request, retry and queueing delay statistics
+    """
+    def __init__(self, requests: Optional[TokenBucket] = None, tokens: Optional[TokenBucket] = None, max_retries: int = MAX_RETRIES,
+                 base_delay: float = BASE_DELAY, max_delay: float = MAX_DELAY):
+        self.requests = requests
+        self.tokens = tokens
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = SchedulerMetrics()
+        self._queue: List[Tuple[int, int, _Ticket]] = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def _grant(self, ticket: _Ticket) -> Optional[float]:
+        # Called with the lock held: 0 once the ticket is admitted, otherwise the seconds to wait (None: until woken)
+        if self._queue[0][2] is not ticket:
+            return None
+
+        now = time.monotonic()
+        wait = self._paused_until - now
+        if self.requests is not None:
+            wait = max(wait, self.requests.delay(1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.delay(ticket.tokens, now))
+        if wait > 0:
+            return wait
+
+        heapq.heappop(self._queue)
+        if self.requests is not None:
+            self.requests.consume(1, now)
+        if self.tokens is not None:
+            self.tokens.consume(ticket.tokens, now)
+        self._notify()
+        return 0.0
+
+    def _notify(self) -> None:
+        # Called with the lock held, whenever another request may have become admissible
+        self._cond.notify_all()
+        for _, _, ticket in self._queue:
+            if ticket.future is not None:
+                ticket.loop.call_soon_threadsafe(_resolve, ticket.future)
+
+    def _enqueue(self, priority: int, tokens: int) -> _Ticket:
+        ticket = _Ticket(tokens)
+        with self._cond:
+            heapq.heappush(self._queue, (priority, next(self._seq), ticket))
+        return ticket
+
+    def _abandon(self, ticket: _Ticket) -> None:
+        with self._cond:
+            entries = [e for e in self._queue if e[2] is not ticket]
+            if len(entries) != len(self._queue):
+                self._queue = entries
+                heapq.heapify(self._queue)
+                self._notify()
+
+    def _admitted(self, waited: float) -> None:
+        with self._cond:
+            self.metrics.requests += 1
+            self.metrics.queue_delay_total += waited
+            self.metrics.queue_delay_max = max(self.metrics.queue_delay_max, waited)
+            self.metrics.recent_delays.append(waited)
+
+    def _acquire(self, priority: int, tokens: int) -> None:
+        start = time.monotonic()
+        with span("queue", "provider", priority=priority, tokens=tokens):
+            ticket = self._enqueue(priority, tokens)
+            try:
+                with self._cond:
+                    while (wait := self._grant(ticket)) != 0:
+                        self._cond.wait(timeout=wait)
+            except BaseException:
+                self._abandon(ticket)
+                raise
+        self._admitted(time.monotonic() - start)
+
+    async def _aacquire(self, priority: int, tokens: int) -> None:
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        with span("queue", "provider", priority=priority, tokens=tokens):
+            ticket = self._enqueue(priority, tokens)
+            try:
+                while True:
+                    with self._cond:
+                        wait = self._grant(ticket)
+                        if wait == 0:
+                            ticket.future = None
+                            break
+                        ticket.loop, ticket.future = loop, loop.create_future()
+                    try:
+                        await asyncio.wait_for(ticket.future, timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                self._abandon(ticket)
+                raise
+        self._admitted(time.monotonic() - start)
+
+    def _backoff(self, e: Exception, attempt: int, tokens: int) -> Optional[float]:
+        # The seconds to wait before retrying, or None if the error is final
+        with self._cond:
+            # A failed request was not processed, so its tokens are given back
+            if self.tokens is not None:
+                self.tokens.consume(-tokens, time.monotonic())
+                self._notify()
+
+        retryable, hint = classify_error(e)
+        if not retryable or attempt >= self.max_retries:
+            with self._cond:
+                self.metrics.failures += 1
+            return None
+
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        with self._cond:
+            self.metrics.retries += 1
+            if hint is not None:
+                # Everyone shares the exhausted quota; the jitter spreads the requests out again afterwards
+                delay += hint
+                self._paused_until = max(self._paused_until, time.monotonic() + hint)
+        return delay
+
+    def call(self, fn: Callable[[], T], priority: int = 0, tokens: int = 0) -> T:
+        """
+        Runs fn once admitted, retrying it after transient errors; tokens is the estimated size of the request
+        """
+        for attempt in itertools.count():
+            self._acquire(priority, tokens)
+            try:
+                return fn()
+            except Exception as e:
+                delay = self._backoff(e, attempt, tokens)
+                if delay is None:
+                    raise
+                with span("backoff", "provider", attempt=attempt + 1, delay=delay, error=f"{type(e).__name__}: {e}"):
+                    time.sleep(delay)
+
+    async def acall(self, fn: Callable[[], Awaitable[T]], priority: int = 0, tokens: int = 0) -> T:
+        """
+        Coroutine version of call() for a function returning an awaitable
+        """
+        for attempt in itertools.count():
+            await self._aacquire(priority, tokens)
+            try:
+                return await fn()
+            except Exception as e:
+                delay = self._backoff(e, attempt, tokens)
+                if delay is None:
+                    raise
+                with span("backoff", "provider", attempt=attempt + 1, delay=delay, error=f"{type(e).__name__}: {e}"):
+                    await asyncio.sleep(delay)
+
+    def stream(self, fn: Callable[[], Iterator[T]], priority: int = 0, tokens: int = 0) -> Iterator[T]:
+        """
+        Version of call() for a streaming request; it is only retried until the first item has arrived, as items
+        already passed on cannot be taken back
+        """
+        for attempt in itertools.count():
+            self._acquire(priority, tokens)
+            iterator = iter(fn())
+            try:
+                first = next(iterator)
+                break
+            except StopIteration:
+                return
+            except Exception as e:
+                delay = self._backoff(e, attempt, tokens)
+                if delay is None:
+                    raise
+                with span("backoff", "provider", attempt=attempt + 1, delay=delay, error=f"{type(e).__name__}: {e}"):
+                    time.sleep(delay)
+
+        yield first
+        yield from iterator
+
+    def settle(self, estimated: int, usage: Optional[TokenUsage]) -> None:
+        """
+        Corrects the token bucket by the difference between the estimated and the actual size of a request
+        """
+        if self.tokens is None or usage is None:
+            return
+        with self._cond:
+            self.tokens.consume(usage.input_count + usage.output_count - estimated, time.monotonic())
+            self._notify()
+
+_scheduler = RequestScheduler()
+
+def configure(requests_per_minute: int = 0, tokens_per_minute: int = 0) -> None:
+    """
+    Sets the rate limits of the shared scheduler; 0 means unlimited
+    """
+    global _scheduler
+    _scheduler = RequestScheduler(
+        requests=TokenBucket(requests_per_minute) if requests_per_minute > 0 else None,
+        tokens=TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None,
+    )
+
+def get_scheduler() -> RequestScheduler:
+    """
+    The scheduler shared by all providers of the process
+    """
+    return _scheduler
+
+class ScheduledProvider(Provider):
+    """
+    Wraps another provider so that its requests go through a RequestScheduler
+
+    Attributes:
+        provider: The wrapped provider
+        scheduler: The scheduler admitting and retrying the requests; the shared one by default
+        priority: The priority of this provider's requests (lower values go first)
+    """
+    def __init__(self, provider: Provider, scheduler: Optional[RequestScheduler] = None, priority: int = 0):
+        super().__init__(model=provider.model, system_prompt=provider.system_prompt)
+        self.provider = provider
+        self.scheduler = scheduler if scheduler is not None else get_scheduler()
+        self.priority = priority
+
+    def _estimate(self, messages: List[Message]) -> int:
+        return estimate_messages_tokens(messages) + estimate_tokens(self.system_prompt or "")
+
+    def chat(self, messages: List[Message], tools: List[ToolSpec]) -> Response:
+        estimated = self._estimate(messages)
+        response = self.scheduler.call(lambda: self.provider.chat(messages, tools), self.priority, estimated)
+        self.scheduler.settle(estimated, response.usage)
+        return response
+
+    async def achat(self, messages: List[Message], tools: List[ToolSpec]) -> Response:
+        estimated = self._estimate(messages)
+        response = await self.scheduler.acall(lambda: self.provider.achat(messages, tools), self.priority, estimated)
+        self.scheduler.settle(estimated, response.usage)
+        return response
+
+    def chat_stream(self, messages: List[Message], tools: List[ToolSpec]) -> Iterator[ResponseChunk]:
+        estimated = self._estimate(messages)
+        usage = None
+        for chunk in self.scheduler.stream(lambda: self.provider.chat_stream(messages, tools), self.priority, estimated):
+            usage = chunk.usage or usage
+            yield chunk
+        self.scheduler.settle(estimated, usage)
+
+    def close(self) -> None:
+        self.provider.close()
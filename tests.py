@@ -1,8 +1,51 @@
+import asyncio
+import http.server
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
+import urllib.error
+import urllib.request
+
+# Tool manifests and search indexes go to a throwaway cache instead of ~/.cache, so the tests neither leave files
+# behind nor pick up stale manifests; set before the modules computing their default paths are imported
+_cache_home = tempfile.TemporaryDirectory(prefix="halp-tests-")
+os.environ["XDG_CACHE_HOME"] = _cache_home.name
+
+from google.genai import errors as genai_errors, types as genai_types
+from core.agent import Agent
+from core.batch import BatchTask, create_workspace, load_tasks, run_batch
+from core.blobstore import BlobStore
+from core.context import ContextManager, estimate_messages_tokens, reference_repeats
+from core.executor import ToolExecutor
+from core.file_cache import FileCache
+from core.journal import WriteJournal, current_journal
+from core.python_workers import PythonWorkerPool
+from core.registry import ToolRegistry, _LazyTool, load_tools
+from core.reads import ReadLog, current_reads
+from core.search_index import SearchIndex, required_literals
+from core.session import Session, SessionStore
+from core.tracing import ChromeTraceExporter, JsonlExporter, MemoryExporter, Tracer, set_tracer
+from core.types import Message, Response, ResponseChunk, TokenUsage, ToolCall, ToolSpec
+from providers.caching_provider import CacheMissError, CachingProvider
+from providers.fake_provider import FakeProvider
+from providers.gemini_provider import GeminiProvider, _to_gemini_messages
+from providers.openai_provider import OpenAIError, OpenAIProvider
+from providers.registry import load_provider
+from providers.scheduler import RequestScheduler, ScheduledProvider, TokenBucket, classify_error
 from functions.get_files_info import *
 from functions.get_file_content import *
 from functions.write_file import *
+from functions.edit_file import *
+from functions.write_files import *
 from functions.run_python_file import *
+from functions.search_code import *
 
 # TODO: Use actual assertions
 # TODO: Write tests for every function the LLM might call
@@ -34,6 +77,142 @@ class TestGetFilesInfo(unittest.TestCase):
         print("Result for '../' directory:")
         print(result)
 
+class TestListTree(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.TemporaryDirectory()
+        files = {
+            ".gitignore": "*.log\nbuild/\n!keep.log\n",
+            "main.py": "x" * 30,
+            "app.log": "",
+            "keep.log": "",
+            "build/out.bin": "",
+            "src/.gitignore": "/generated.py\n",
+            "src/lib.py": "x" * 10,
+            "src/generated.py": "",
+            "src/sub/generated.py": "",
+            "src/sub/deep/leaf.py": "",
+            ".git/HEAD": "",
+        }
+        for name, content in files.items():
+            path = os.path.join(self.working_dir.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(content)
+
+    def tearDown(self):
+        self.working_dir.cleanup()
+
+    def paths(self, result):
+        return [line[2:].split(":")[0] for line in result.splitlines() if line.startswith("- ")]
+
+    def test_recursive_with_gitignore(self):
+        result = get_files_info(self.working_dir.name, max_depth=10, gitignore=True)
+        self.assertEqual(self.paths(result), [
+            ".gitignore", "keep.log", "main.py", "src", "src/.gitignore", "src/lib.py", "src/sub",
+            "src/sub/deep", "src/sub/deep/leaf.py", "src/sub/generated.py",
+        ])
+
+    def test_depth_and_ignore_disabled(self):
+        result = get_files_info(self.working_dir.name, max_depth=1, gitignore=False)
+        self.assertIn("build/out.bin", self.paths(result))
+        self.assertIn(".git/HEAD", self.paths(result))
+        self.assertNotIn("src/sub/deep", self.paths(result))
+        # Filtering is opt-in
+        self.assertEqual(get_files_info(self.working_dir.name, max_depth=1), result)
+
+    def test_subdirectory_uses_ancestor_gitignore(self):
+        with open(os.path.join(self.working_dir.name, "src", "debug.log"), "w") as f:
+            f.write("")
+        self.assertEqual(self.paths(get_files_info(self.working_dir.name, "src", gitignore=True)), [".gitignore", "lib.py", "sub"])
+
+    def test_glob_and_sort(self):
+        result = get_files_info(self.working_dir.name, max_depth=10, glob="*.py", sort="size")
+        self.assertEqual(self.paths(result)[:2], ["main.py", "src/lib.py"])
+        result = get_files_info(self.working_dir.name, max_depth=10, glob="src/**/*.py", gitignore=True)
+        self.assertEqual(self.paths(result), ["src/lib.py", "src/sub/deep/leaf.py", "src/sub/generated.py"])
+
+    def test_pagination(self):
+        for sort in ("name", "size"):
+            for gitignore in (False, True):
+                everything = self.paths(get_files_info(self.working_dir.name, max_depth=10, gitignore=gitignore, sort=sort))
+                pages, cursor = [], None
+                while True:
+                    result = get_files_info(self.working_dir.name, max_depth=10, gitignore=gitignore, sort=sort, limit=3, cursor=cursor)
+                    pages += self.paths(result)
+                    if 'cursor="' not in result:
+                        break
+                    cursor = result.split('cursor="')[1].split('"')[0]
+                self.assertEqual(pages, everything)
+        # In tree order the cursor is the last path returned
+        self.assertEqual(self.paths(get_files_info(self.working_dir.name, max_depth=10, cursor="src/sub")), ["src/sub/deep", "src/sub/deep/leaf.py", "src/sub/generated.py"])
+        self.assertTrue(get_files_info(self.working_dir.name, sort="size", cursor="abc").startswith("Error:"))
+
+class TestSearchCode(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.TemporaryDirectory()
+        self.index_dir = tempfile.TemporaryDirectory()
+        self.index_path = os.path.join(self.index_dir.name, "index.json")
+        self.write("pkg/calc.py", "class Calculator:\n    def evaluate(self, expression):\n        return self._evaluate_infix(expression)\n")
+        self.write("main.py", "from pkg.calc import Calculator\n\ncalculator = Calculator()\nprint(calculator.evaluate('1 + 2'))\n")
+        self.write("notes.txt", "TODO: handle division by zero\n")
+        self.write("ignored.log", "Calculator log\n")
+        self.write(".gitignore", "*.log\n")
+        with open(os.path.join(self.working_dir.name, "data.bin"), "wb") as f:
+            f.write(b"\0Calculator")
+
+    def tearDown(self):
+        self.working_dir.cleanup()
+        self.index_dir.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.working_dir.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def search(self, query, **kwargs):
+        return search_code(self.working_dir.name, query, index=SearchIndex(self.working_dir.name, index_path=self.index_path), **kwargs)
+
+    def test_literal(self):
+        self.assertEqual(self.search("Calculator()"), "main.py:3: calculator = Calculator()\n[1 matches in 1 files]\n")
+
+    def test_regex_and_case(self):
+        result = self.search(r"def \w+\(self", regex=True)
+        self.assertEqual(result, "pkg/calc.py:2:     def evaluate(self, expression):\n[1 matches in 1 files]\n")
+        self.assertIn("[4 matches in 2 files]", self.search("calculator", ignore_case=True))
+        self.assertTrue(self.search("(", regex=True).startswith("Error: Invalid regular expression"))
+
+    def test_regex_literals(self):
+        # Escapes, classes and flags must not be mistaken for text the match has to contain
+        self.write("odd.txt", "Abcdef ]yz Qxyz abcd\n")
+        for pattern in [r"\x41bcdef", r"[\]x]yz", r"[^]abc]xyz", "(?x) a b c d"]:
+            self.assertIn("odd.txt:1:", self.search(pattern, regex=True), pattern)
+        self.assertEqual(required_literals(r"\x41bcdef"), ["Abcdef"])
+        self.assertEqual(required_literals(r"[\]x]yz"), [])
+        self.assertEqual(required_literals("(?x) a b c d"), ["abcd"])
+        self.assertEqual(required_literals(r"def \w+\(self(, \w+)?"), ["def ", "(self"])
+        self.assertEqual(required_literals("foo(bar|baz)qux+"), ["foo", "qux"])
+        self.assertEqual(required_literals("ab{0,2}cdef(?=ghi)"), ["cdef"])
+        self.assertEqual(required_literals(r"x{}yz(?:abc)+\N{LATIN SMALL LETTER A}bc"), ["x{}yz", "abc", "abc"])
+
+    def test_filters_context_and_limit(self):
+        self.assertNotIn("pkg/calc.py", self.search("Calculator", glob="main.py"))
+        self.assertNotIn("main.py", self.search("Calculator", directory="pkg"))
+        result = self.search("evaluate", context=1, max_results=1)
+        self.assertTrue(result.startswith("main.py-3- calculator = Calculator()\nmain.py:4: print("))
+        self.assertIn("Stopped after 1 matches", result)
+
+    def test_persisted_and_refreshed(self):
+        index = SearchIndex(self.working_dir.name, index_path=self.index_path)
+        self.assertEqual(index.refresh(), 5)
+        reloaded = SearchIndex(self.working_dir.name, index_path=self.index_path)
+        self.assertEqual(reloaded.refresh(), 0)
+        self.assertEqual(reloaded.candidates(["division"]), ["notes.txt"])
+
+        self.write("notes.txt", "TODO: nothing left\n")
+        self.assertEqual(reloaded.refresh(), 1)
+        self.assertEqual(reloaded.candidates(["division"]), [])
+
 class TestGetFileContent(unittest.TestCase):
     def setUp(self):
         self.working_dir = "calculator"
@@ -63,6 +242,119 @@ class TestGetFileContent(unittest.TestCase):
         print("Result for 'pkg/does_not_exist.py':")
         print(result)
 
+class TestGetFileContentRanges(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.TemporaryDirectory()
+        # Long enough to span several blocks of the line index
+        self.lines = [f"line {i} " + "x" * (i % 50) for i in range(1, 20001)]
+        with open(os.path.join(self.working_dir.name, "big.log"), "w") as f:
+            f.write("\n".join(self.lines) + "\n")
+        with open(os.path.join(self.working_dir.name, "small.txt"), "w") as f:
+            f.write("one\ntwo\nthree")
+
+    def tearDown(self):
+        self.working_dir.cleanup()
+
+    def test_small_file_reports_totals(self):
+        result = get_file_content(self.working_dir.name, "small.txt")
+        self.assertEqual(result, 'one\ntwo\nthree\n[File "small.txt": 13 bytes and 3 lines in total, showing lines 1-3 (offset 0, 13 bytes)]')
+
+    def test_truncation_is_reported(self):
+        result = get_file_content(self.working_dir.name, "big.log")
+        self.assertIn(f'[...File "big.log" truncated at {MAX_CHARS} characters;', result)
+        self.assertIn("20000 lines in total", result)
+        self.assertIn(f"Continue with offset={MAX_CHARS}", result)
+
+    def test_line_range(self):
+        result = get_file_content(self.working_dir.name, "big.log", start_line=15000, end_line=15002)
+        content, footer = result.rsplit("\n[", 1)
+        self.assertEqual(content, "\n".join(self.lines[14999:15002]) + "\n")
+        self.assertIn("showing lines 15000-15002", footer)
+
+    def test_truncated_line_range_ends_on_line(self):
+        result = get_file_content(self.working_dir.name, "big.log", start_line=100)
+        next_line = int(result.rsplit("start_line=", 1)[1].rstrip("]"))
+        content = result.rsplit("\n[...", 1)[0]
+        self.assertEqual(content, "\n".join(self.lines[99:next_line - 1]) + "\n")
+
+    def test_long_line_continues_by_offset(self):
+        with open(os.path.join(self.working_dir.name, "long.txt"), "w") as f:
+            f.write("short\n" + "y" * 25000 + "\nlast\n")
+        result = get_file_content(self.working_dir.name, "long.txt", start_line=2)
+        self.assertEqual(result.split("\n[...", 1)[0], "y" * MAX_CHARS)
+        # Continuing with start_line=2 again would return the same part forever
+        self.assertIn(f"Continue with offset={6 + MAX_CHARS}]", result)
+        result = get_file_content(self.working_dir.name, "long.txt", offset=6 + 2 * MAX_CHARS)
+        self.assertTrue(result.startswith("y" * 5000 + "\nlast\n"))
+
+    def test_byte_range(self):
+        with open(os.path.join(self.working_dir.name, "big.log"), "rb") as f:
+            f.seek(123456)
+            expected = f.read(100).decode("utf-8")
+        result = get_file_content(self.working_dir.name, "big.log", offset=123456, length=100)
+        self.assertTrue(result.startswith(expected + "\n[File"))
+
+    def test_invalid_ranges(self):
+        self.assertTrue(get_file_content(self.working_dir.name, "small.txt", offset=100).startswith("Error:"))
+        self.assertTrue(get_file_content(self.working_dir.name, "small.txt", start_line=5).startswith("Error:"))
+        self.assertTrue(get_file_content(self.working_dir.name, "small.txt", offset=0, end_line=2).startswith("Error:"))
+
+class TestFileCache(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.TemporaryDirectory()
+        self.cache = FileCache(max_bytes=100)
+
+    def tearDown(self):
+        self.working_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(os.path.realpath(self.working_dir.name), name)
+
+    def test_write_through_and_revalidation(self):
+        write_file(self.working_dir.name, "a.txt", "first", cache=self.cache)
+        self.assertTrue(get_file_content(self.working_dir.name, "a.txt", cache=self.cache).startswith("first\n"))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 0))
+
+        # Changed behind the cache's back
+        with open(self.path("a.txt"), "w") as f:
+            f.write("second, longer")
+        self.assertTrue(get_file_content(self.working_dir.name, "a.txt", cache=self.cache).startswith("second, longer\n"))
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_lru_eviction(self):
+        for name in ("a.txt", "b.txt", "c.txt"):
+            write_file(self.working_dir.name, name, name * 10, cache=self.cache)
+        self.cache.read(self.path("a.txt"))
+        self.assertEqual(self.cache.misses, 1)
+        self.cache.read(self.path("c.txt"))
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_listing_invalidated_by_write(self):
+        write_file(self.working_dir.name, "a.txt", "short", cache=self.cache)
+        self.assertIn("- a.txt: file_size=5 bytes", get_files_info(self.working_dir.name, cache=self.cache))
+        write_file(self.working_dir.name, "a.txt", "a bit longer", cache=self.cache)
+        self.assertIn("- a.txt: file_size=12 bytes", get_files_info(self.working_dir.name, cache=self.cache))
+
+    def test_unchanged_notice(self):
+        tool = next(t for t in load_tools(self.working_dir.name) if t.name == "get_file_content")
+        write_file(self.working_dir.name, "a.txt", "content")
+        # Without the read log of a session every read returns the content
+        self.assertTrue(tool.func(file_path="a.txt").startswith("content\n"))
+        reads = ReadLog()
+        self.addCleanup(current_reads.reset, current_reads.set(reads))
+        self.assertTrue(tool.func(file_path="a.txt").startswith("content\n"))
+        self.assertIn("is unchanged since you last read it", tool.func(file_path="a.txt"))
+        self.assertTrue(tool.func(file_path="a.txt", refresh=True).startswith("content\n"))
+        # A different part of the file has not been read yet
+        self.assertTrue(tool.func(file_path="a.txt", start_line=1).startswith("content\n"))
+
+        write_file(self.working_dir.name, "a.txt", "changed")
+        self.assertTrue(tool.func(file_path="./a.txt").startswith("changed\n"))
+        self.assertIn("is unchanged since you last read it", tool.func(file_path="a.txt"))
+        # Reads are forgotten by the resolved path, whichever way it was spelled
+        reads.forget(os.path.realpath(os.path.join(self.working_dir.name, "a.txt")))
+        self.assertTrue(tool.func(file_path="a.txt").startswith("changed\n"))
+
 class TestWriteFile(unittest.TestCase):
     def setUp(self):
         self.working_dir = "calculator"
@@ -82,6 +374,216 @@ class TestWriteFile(unittest.TestCase):
         print("Result for '/tmp/temp.txt':")
         print(result)
 
+class TestEditFile(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.working_dir.name, "calc.py")
+        self.original = "".join(f"line {i}\n" for i in range(1, 21))
+        with open(self.path, "w") as f:
+            f.write(self.original)
+        os.chmod(self.path, 0o640)
+
+    def tearDown(self):
+        self.working_dir.cleanup()
+
+    def read(self):
+        with open(self.path, newline="") as f:
+            return f.read()
+
+    def write(self, content):
+        with open(self.path, "w", newline="") as f:
+            f.write(content)
+
+    def test_search_replace(self):
+        result = edit_file(self.working_dir.name, "calc.py", edits=[
+            {"search": "line 3\nline 4\n", "replace": "three\n"},
+            {"search": "line 20", "replace": "twenty"},
+        ])
+        self.assertEqual(result, 'Successfully edited "calc.py" (2 edits applied, 20 -> 19 lines)')
+        self.assertEqual(self.read(), self.original.replace("line 3\nline 4\n", "three\n").replace("line 20", "twenty"))
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+
+    def test_failures_leave_file_untouched(self):
+        result = edit_file(self.working_dir.name, "calc.py", edits=[
+            {"search": "line 1\n", "replace": "one\n"},
+            {"search": "line  5", "replace": "five"},
+        ])
+        self.assertIn("the search text of edit 2 was not found; the most similar line is 5: 'line 5'", result)
+        self.assertIn("occurs 11 times", edit_file(self.working_dir.name, "calc.py", edits=[{"search": "line 1", "replace": ""}]))
+        self.assertEqual(self.read(), self.original)
+        self.assertEqual(os.listdir(self.working_dir.name), ["calc.py"])
+
+    def test_unified_diff(self):
+        # Line numbers that are off by two, as if the model miscounted
+        patch = "--- a/calc.py\n+++ b/calc.py\n@@ -3,3 +3,3 @@\n line 5\n-line 6\n+six\n line 7\n@@ -17,2 +17,3 @@\n line 17\n+inserted\n line 18\n"
+        result = edit_file(self.working_dir.name, "calc.py", patch=patch)
+        self.assertEqual(result, 'Successfully edited "calc.py" (2 hunks applied, 20 -> 21 lines)')
+        self.assertEqual(self.read(), self.original.replace("line 6\n", "six\n").replace("line 17\n", "line 17\ninserted\n"))
+
+    def test_unified_diff_mismatch(self):
+        patch = "@@ -5,2 +5,2 @@\n-line 5\n+five\n line 99\n"
+        result = edit_file(self.working_dir.name, "calc.py", patch=patch)
+        self.assertEqual(result, "Error: Cannot edit \"calc.py\": hunk 1 (@@ -5,2 +5,2 @@) does not match: line 6 is 'line 6', the hunk expects 'line 99'. No changes were made.")
+        self.assertEqual(self.read(), self.original)
+
+    def test_unified_diff_of_several_files(self):
+        patch = "--- a/calc.py\n+++ b/calc.py\n@@ -1,1 +1,1 @@\n-line 1\n+one\n--- a/other.py\n+++ b/other.py\n@@ -2,1 +2,1 @@\n-line 2\n+two\n"
+        result = edit_file(self.working_dir.name, "calc.py", patch=patch)
+        self.assertEqual(result, 'Error: Cannot edit "calc.py": the patch changes more than one file; pass a separate patch for each file. No changes were made.')
+        self.assertEqual(self.read(), self.original)
+        # Removed lines looking like a file header are still part of a hunk whose lines are not all there yet
+        self.write("-- a\n++ b\nc\n")
+        self.assertTrue(edit_file(self.working_dir.name, "calc.py", patch="@@ -1,3 +1,1 @@\n--- a\n-++ b\n c\n").startswith("Successfully"))
+        self.assertEqual(self.read(), "c\n")
+
+    def test_unified_diff_trailing_empty_context(self):
+        # The empty context lines at the end of the hunk have lost their leading space; only the second "b" is
+        # followed by two of them
+        self.write("b\n\nc\nb\n\n\nd\n")
+        result = edit_file(self.working_dir.name, "calc.py", patch="@@ -1,3 +1,3 @@\n-b\n+B\n\n\n\n")
+        self.assertEqual(result, 'Successfully edited "calc.py" (1 hunks applied, 7 -> 7 lines)')
+        self.assertEqual(self.read(), "b\n\nc\nB\n\n\nd\n")
+        # A blank line between hunks is not context
+        result = edit_file(self.working_dir.name, "calc.py", patch="@@ -1,1 +1,1 @@\n-b\n+A\n\n@@ -7,1 +7,1 @@\n-d\n+D\n")
+        self.assertEqual(result, 'Successfully edited "calc.py" (2 hunks applied, 7 -> 7 lines)')
+        self.assertEqual(self.read(), "A\n\nc\nB\n\n\nD\n")
+
+    def test_unified_diff_crlf(self):
+        self.write("line 1\r\nline 2\r\nline 3\r\n")
+        for patch in ["@@ -2,1 +2,2 @@\n-line 2\n+two\n+2\n", "@@ -2,1 +2,2 @@\r\n-two\r\n+2\r\n+two\r\n"]:
+            self.assertTrue(edit_file(self.working_dir.name, "calc.py", patch=patch).startswith("Successfully"), patch)
+        self.assertEqual(self.read(), "line 1\r\n2\r\ntwo\r\n2\r\nline 3\r\n")
+
+    def test_confinement(self):
+        self.assertTrue(edit_file(self.working_dir.name, "../calc.py", patch="").startswith("Error: Cannot edit"))
+        self.assertTrue(edit_file(self.working_dir.name, "calc.py").startswith("Error: Pass either"))
+
+class TestWriteJournal(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.TemporaryDirectory()
+        self.journal_dir = tempfile.TemporaryDirectory()
+        self.write("keep.txt", "original\n")
+        self.write("pkg/module.py", "VALUE = 1\n")
+
+    def tearDown(self):
+        self.working_dir.cleanup()
+        self.journal_dir.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.working_dir.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def tree(self):
+        found = {}
+        for directory, _, names in os.walk(self.working_dir.name):
+            for name in names:
+                path = os.path.join(directory, name)
+                with open(path) as f:
+                    found[os.path.relpath(path, self.working_dir.name)] = f.read()
+        return found
+
+    def test_write_files_all_or_nothing(self):
+        before = self.tree()
+        result = write_files(self.working_dir.name, [
+            {"file_path": "keep.txt", "content": "changed"},
+            {"file_path": "../escape.txt", "content": "nope"},
+        ])
+        self.assertTrue(result.startswith("Error: Cannot write to \"../escape.txt\""))
+        self.assertEqual(self.tree(), before)
+
+        result = write_files(self.working_dir.name, [
+            {"file_path": "keep.txt", "content": "changed"},
+            {"file_path": "new/dir/file.txt", "content": "new"},
+        ])
+        self.assertEqual(result, 'Successfully wrote 2 files (10 characters written): "keep.txt", "new/dir/file.txt"')
+        self.assertEqual(self.tree()["new/dir/file.txt"], "new")
+
+    def test_write_files_failed_commit(self):
+        replaced = []
+        def replace(src, dst, replace=os.replace):
+            replaced.append(dst)
+            if len(replaced) == 2:
+                raise OSError("disk full")
+            replace(src, dst)
+
+        files = [{"file_path": "keep.txt", "content": "changed"}, {"file_path": "pkg/module.py", "content": "VALUE = 2\n"}]
+        with unittest.mock.patch("os.replace", replace):
+            result = write_files(self.working_dir.name, files)
+        self.assertEqual(result, 'Error: Cannot write "pkg/module.py"; error: disk full. These files were written nonetheless: "keep.txt"')
+        # The file which was not committed is left as it was, without a staged copy next to it
+        self.assertEqual(self.tree(), {"keep.txt": "changed", "pkg/module.py": "VALUE = 1\n"})
+
+        # With a journal, the files written before the failure are restored
+        before = self.tree()
+        journal = WriteJournal(self.journal_dir.name)
+        self.addCleanup(current_journal.reset, current_journal.set(journal))
+        files[0]["content"] = "changed again"
+        replaced.clear()
+        with unittest.mock.patch("os.replace", replace):
+            result = write_files(self.working_dir.name, files)
+        self.assertEqual(result, 'Error: Cannot write "pkg/module.py"; error: disk full. The files written before were rolled back, so no files were changed.')
+        self.assertEqual(self.tree(), before)
+        self.assertEqual(journal.paths, [os.path.realpath(os.path.join(self.working_dir.name, "pkg/module.py"))])
+
+    def test_write_files_failed_staging(self):
+        def stage(path, data, stage=stage_write):
+            if path.endswith("file.txt"):
+                raise OSError("disk full")
+            return stage(path, data)
+
+        before = self.tree()
+        files = [{"file_path": "keep.txt", "content": "changed"}, {"file_path": "new/dir/file.txt", "content": "new"}]
+        with unittest.mock.patch("functions.write_files.stage_write", stage):
+            result = write_files(self.working_dir.name, files)
+        self.assertEqual(result, 'Error: Cannot write "new/dir/file.txt"; error: disk full. No files were changed.')
+        self.assertEqual(self.tree(), before)
+        # The directories made for the new file are gone again, without a staged copy left behind
+        self.assertFalse(os.path.exists(os.path.join(self.working_dir.name, "new")))
+        self.assertEqual(sorted(os.listdir(self.working_dir.name)), sorted(set(p.split("/")[0] for p in before)))
+
+    def test_write_files_failed_fsync(self):
+        def fsync_directory(directory):
+            raise OSError("I/O error")
+
+        files = [{"file_path": "keep.txt", "content": "changed"}]
+        with unittest.mock.patch("functions.write_files.fsync_directory", fsync_directory):
+            result = write_files(self.working_dir.name, files)
+        self.assertEqual(result, 'Successfully wrote 1 files (7 characters written): "keep.txt" (the directories could not be flushed to disk; error: I/O error)')
+        self.assertEqual(self.tree()["keep.txt"], "changed")
+
+    def test_agent_rollback(self):
+        before = self.tree()
+        calls = [
+            ToolCall(id=None, name="write_files", arguments={"files": [
+                {"file_path": "keep.txt", "content": "changed"},
+                {"file_path": "new/dir/file.txt", "content": "new"},
+            ]}),
+            ToolCall(id=None, name="edit_file", arguments={"file_path": "pkg/module.py", "edits": [{"search": "1", "replace": "2"}]}),
+            ToolCall(id=None, name="write_file", arguments={"file_path": "pkg/other.py", "content": "x"}),
+        ]
+        provider = FakeProvider([Response(assistant_text="", tool_calls=calls, usage=None), Response(assistant_text="Job's done.", tool_calls=[], usage=None)])
+        # The tools run on pool threads, which have to see the journal as well
+        agent = Agent(provider=provider, tools=load_tools(self.working_dir.name), max_tool_workers=4, journal=WriteJournal(self.journal_dir.name))
+        agent.run("Change things")
+        agent.executor.shutdown()
+        self.assertEqual(self.tree()["pkg/module.py"], "VALUE = 2\n")
+
+        self.assertEqual(len(agent.rollback()), 4)
+        self.assertEqual(self.tree(), before)
+        self.assertFalse(os.path.exists(os.path.join(self.working_dir.name, "new")))
+
+    def test_rollback_after_crash(self):
+        journal = WriteJournal(self.journal_dir.name)
+        journal.record(os.path.join(os.path.realpath(self.working_dir.name), "keep.txt"), os.path.realpath(self.working_dir.name))
+        self.write("keep.txt", "half-written")
+
+        # A new process opening the same journal
+        self.assertEqual(len(WriteJournal(self.journal_dir.name).rollback()), 1)
+        self.assertEqual(self.tree()["keep.txt"], "original\n")
+        self.assertEqual(os.listdir(self.journal_dir.name), [])
+
 class TestRunPythonFile(unittest.TestCase):
     def setUp(self):
         self.working_dir = "calculator"
@@ -118,5 +620,1064 @@ class TestRunPythonFile(unittest.TestCase):
         print("Result for 'lorem3.txt'")
         print(result)
 
+class TestWarmPythonWorkers(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.TemporaryDirectory()
+        self.pool = PythonWorkerPool(self.working_dir.name, size=1)
+
+    def tearDown(self):
+        self.pool.close()
+        self.working_dir.cleanup()
+
+    def write(self, name, code):
+        with open(os.path.join(self.working_dir.name, name), "w") as f:
+            f.write(code)
+
+    def test_same_output_as_cold(self):
+        self.write("helper.py", "VALUE = 42\n")
+        self.write("script.py", "import sys, helper\nprint(helper.VALUE, sys.argv[1:], __name__)\nprint('err', file=sys.stderr)\nsys.exit(3)\n")
+        cold = run_python_file(self.working_dir.name, "script.py", args=["a", "b"])
+        warm = run_python_file(self.working_dir.name, "script.py", args=["a", "b"], pool=self.pool)
+        self.assertEqual(warm, cold)
+        self.assertIn("Process exited with return code 3", warm)
+
+    def test_tracebacks_and_stdin_as_cold(self):
+        self.write("failing.py", "import os, sys\nprint(os.fstat(0).st_ino, __name__, __spec__, __cached__, __file__ == sys.argv[0])\ndef f():\n    raise ValueError('boom')\nf()\n")
+        cold = run_python_file(self.working_dir.name, "failing.py")
+        warm = run_python_file(self.working_dir.name, "failing.py", pool=self.pool)
+        self.assertEqual(warm, cold)
+        self.assertIn('Traceback (most recent call last):\n  File "', warm)
+        self.assertNotIn("<string>", warm)
+
+    def test_fresh_state_per_run(self):
+        self.write("counter.py", "import json\njson.counter = getattr(json, 'counter', 0) + 1\nprint(json.counter)\n")
+        for _ in range(3):
+            self.assertEqual(run_python_file(self.working_dir.name, "counter.py", pool=self.pool), "STDOUT: 1\n\nSTDERR: \n")
+
+    def test_shadowing_falls_back_to_cold(self):
+        self.write("json.py", "dumps = lambda *_: 'local json'\n")
+        self.write("script.py", "import json\nprint(json.dumps({}))\n")
+        self.assertIsNone(self.pool.start(os.path.join(self.working_dir.name, "script.py"), []))
+        self.assertIn("local json", run_python_file(self.working_dir.name, "script.py", pool=self.pool))
+
+class TestRunPythonFileOutput(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.working_dir.cleanup()
+
+    def write(self, name, code):
+        with open(os.path.join(self.working_dir.name, name), "w") as f:
+            f.write(code)
+
+    def test_head_and_tail_kept(self):
+        self.write("script.py", "print('first')\nfor i in range(100000):\n    print(i)\nprint('last')\n")
+        result = run_python_file(self.working_dir.name, "script.py", max_output_bytes=1000)
+        self.assertTrue(result.startswith("STDOUT: first\n"))
+        self.assertIn("bytes elided ...]", result)
+        self.assertIn("99999\nlast\n", result)
+        self.assertLess(len(result), 1200)
+
+    def test_runaway_output_killed(self):
+        self.write("script.py", "import sys\nwhile True:\n    sys.stdout.write('x' * 4096)\n")
+        start = time.perf_counter()
+        result = run_python_file(self.working_dir.name, "script.py", max_output_bytes=100, kill_output_bytes=1024 * 1024)
+        self.assertLess(time.perf_counter() - start, 10)
+        self.assertIn("Process was killed after producing more than 1048576 bytes of output", result)
+        self.assertIn("Process exited with return code -9", result)
+
+    def test_timeout_keeps_output(self):
+        self.write("script.py", "import time\nprint('started', flush=True)\ntime.sleep(30)\n")
+        result = run_python_file(self.working_dir.name, "script.py", timeout=1)
+        self.assertIn("STDOUT: started\n", result)
+        self.assertIn("Process timed out after 1 seconds and was killed", result)
+
+class TestToolExecutor(unittest.TestCase):
+    def setUp(self):
+        self.log = []
+        self.lock = threading.Lock()
+
+        def make(name, read_only):
+            def _fn(file_path):
+                with self.lock:
+                    self.log.append(("start", name, file_path))
+                time.sleep(0.05)
+                with self.lock:
+                    self.log.append(("end", name, file_path))
+                return f"{name}:{file_path}"
+            return ToolSpec(name=name, description="", parameters={}, func=_fn, read_only=read_only, path_arg="file_path")
+
+        self.tools = [make("read", True), make("write", False)]
+
+    def test_results_in_call_order(self):
+        calls = [ToolCall(id=str(i), name="read", arguments={"file_path": f"f{i}"}) for i in range(6)]
+        executor = ToolExecutor(self.tools, max_workers=4)
+        messages = executor.execute(calls)
+        executor.shutdown()
+        self.assertEqual([m.tool_call_id for m in messages], [str(i) for i in range(6)])
+        self.assertEqual(messages[3].content, '{"result": "read:f3"}')
+
+    def test_reads_run_concurrently(self):
+        calls = [ToolCall(id=None, name="read", arguments={"file_path": f"f{i}"}) for i in range(4)]
+        executor = ToolExecutor(self.tools, max_workers=4)
+        start = time.perf_counter()
+        executor.execute(calls)
+        elapsed = time.perf_counter() - start
+        executor.shutdown()
+        self.assertLess(elapsed, 0.15)
+
+    def test_same_path_writes_are_serialized(self):
+        calls = [
+            ToolCall(id=None, name="write", arguments={"file_path": "pkg/a.py"}),
+            ToolCall(id=None, name="read", arguments={"file_path": "pkg/a.py"}),
+            ToolCall(id=None, name="write", arguments={"file_path": "pkg/a.py"}),
+        ]
+        executor = ToolExecutor(self.tools, max_workers=4)
+        executor.execute(calls)
+        executor.shutdown()
+        self.assertEqual([(e[0], e[1]) for e in self.log], [
+            ("start", "write"), ("end", "write"),
+            ("start", "read"), ("end", "read"),
+            ("start", "write"), ("end", "write"),
+        ])
+
+    def test_unknown_function(self):
+        messages = ToolExecutor(self.tools).execute([ToolCall(id=None, name="nope", arguments={})])
+        self.assertEqual(messages[0].content, '{"error": "Unknown function: nope"}')
+
+    def test_absolute_and_relative_paths_conflict(self):
+        working_directory = os.path.abspath("calculator")
+        calls = [
+            ToolCall(id=None, name="write", arguments={"file_path": os.path.join(working_directory, "pkg", "a.py")}),
+            ToolCall(id=None, name="read", arguments={"file_path": "pkg/a.py"}),
+        ]
+        executor = ToolExecutor(ToolRegistry(self.tools, working_directory=working_directory), max_workers=4)
+        executor.execute(calls)
+        executor.shutdown()
+        self.assertEqual([(e[0], e[1]) for e in self.log], [("start", "write"), ("end", "write"), ("start", "read"), ("end", "read")])
+
+    def test_programs_wait_for_writes(self):
+        with tempfile.TemporaryDirectory() as d:
+            os.mkdir(os.path.join(d, "pkg"))
+            with open(os.path.join(d, "pkg", "mod.py"), "w") as f:
+                f.write("VALUE = 'old'\n")
+            with open(os.path.join(d, "main.py"), "w") as f:
+                f.write("from pkg.mod import VALUE\nprint(VALUE)\n")
+
+            tools = load_tools(d)
+            write = tools.get("write_file")
+            run = tools.get("run_python_file")
+            log = []
+            def slow_write(**kwargs):
+                log.append("start write")
+                time.sleep(0.2)
+                result = write.func(**kwargs)
+                log.append("end write")
+                return result
+            def logged_run(**kwargs):
+                log.append("start run")
+                return run.func(**kwargs)
+            tools.register(ToolSpec(name="write_file", description="", parameters=write.parameters, func=slow_write, path_arg="file_path"))
+            tools.register(ToolSpec(name="run_python_file", description="", parameters=run.parameters, func=logged_run, path_arg=run.path_arg))
+
+            executor = ToolExecutor(tools, max_workers=4)
+            messages = executor.execute([
+                ToolCall(id=None, name="write_file", arguments={"file_path": "pkg/mod.py", "content": "VALUE = 'new'\n"}),
+                ToolCall(id=None, name="run_python_file", arguments={"file_path": "main.py"}),
+            ])
+            executor.shutdown()
+            self.assertEqual(log, ["start write", "end write", "start run"])
+            self.assertIn("new", messages[1].content)
+
+class TestToolRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = load_tools("calculator")
+
+    def test_lookup(self):
+        self.assertIn("get_file_content", self.registry)
+        self.assertEqual(self.registry.get("get_file_content").name, "get_file_content")
+        self.assertIsNone(self.registry.get("nope"))
+        self.assertEqual(len(list(self.registry)), len(self.registry))
+
+    def test_dispatch(self):
+        result = self.registry.dispatch(ToolCall(id=None, name="get_files_info", arguments={"directory": "pkg"}))
+        self.assertIn("calculator.py", result["result"])
+        self.assertEqual(self.registry.calls["get_files_info"], 1)
+
+    def test_invalid_arguments(self):
+        result = self.registry.dispatch(ToolCall(id=None, name="get_file_content", arguments={"path": 3}))
+        self.assertEqual(result["error"], "Invalid arguments for get_file_content")
+        self.assertEqual(result["details"], ["arguments.file_path: is required", "arguments.path: unexpected argument"])
+        result = self.registry.dispatch(ToolCall(id=None, name="run_python_file", arguments={"file_path": "main.py", "args": "3 + 5"}))
+        self.assertEqual(result["details"], ["arguments.args: expected array, got str"])
+        self.assertEqual(self.registry.errors["get_file_content"], 1)
+
+    def test_exceptions_become_errors(self):
+        def boom():
+            raise RuntimeError("broken")
+        registry = ToolRegistry([ToolSpec(name="boom", description="", parameters={"type": "object"}, func=boom)])
+        self.assertEqual(registry.dispatch(ToolCall(id=None, name="boom", arguments={})), {"error": "boom raised RuntimeError: broken"})
+
+    def test_integral_floats(self):
+        registry = ToolRegistry([ToolSpec(name="count", description="", parameters={"type": "object", "properties": {"n": {"type": "integer"}}}, func=lambda n: n)])
+        self.assertEqual(registry.dispatch(ToolCall(id=None, name="count", arguments={"n": 3.0})), {"result": 3})
+
+    def test_manifest(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "tools.json")
+            built = load_tools("calculator", manifest_path=path)
+            self.assertTrue(os.path.exists(path))
+            loaded = load_tools("calculator", manifest_path=path)
+            self.assertEqual([(t.name, t.parameters, t.read_only, t.path_arg) for t in loaded], [(t.name, t.parameters, t.read_only, t.path_arg) for t in built])
+            self.assertTrue(all(isinstance(t.func, _LazyTool) for t in loaded))
+            result = loaded.dispatch(ToolCall(id=None, name="get_files_info", arguments={"directory": "pkg"}))
+            self.assertIn("calculator.py", result["result"])
+
+            # A changed module invalidates the manifest
+            with open(path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            self.assertIn(os.path.join("core", "listing.py"), manifest["sources"])
+            manifest["sources"][os.path.join("functions", "get_files_info.py")] = [0, 0]
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+            self.assertFalse(any(isinstance(t.func, _LazyTool) for t in load_tools("calculator", manifest_path=path)))
+
+class TestStartup(unittest.TestCase):
+    def _run(self, code, cache_dir):
+        env = dict(os.environ, XDG_CACHE_HOME=cache_dir)
+        return subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True).stdout
+
+    def test_lazy_imports(self):
+        code = "import sys, main; main.load_tools('calculator'); print(sorted(m for m in sys.modules if m.startswith(('google.genai', 'functions.'))))"
+        with tempfile.TemporaryDirectory() as d:
+            # The first start builds the manifest, later ones do not import any tool
+            self.assertIn("functions.get_file_content", self._run(code, d))
+            self.assertEqual(self._run(code, d).strip(), "[]")
+
+    def test_load_provider(self):
+        self.assertIs(load_provider("ollama"), OpenAIProvider)
+        self.assertIs(load_provider("gemini"), GeminiProvider)
+        with self.assertRaises(ValueError):
+            load_provider("nope")
+
+class TestAgentLoop(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = "calculator"
+        self.script = [
+            Response(assistant_text="", tool_calls=[ToolCall(id=None, name="get_file_content", arguments={"file_path": "main.py"})], usage=None),
+            Response(assistant_text="Job's done.", tool_calls=[], usage=None),
+        ]
+
+    def test_run(self):
+        provider = FakeProvider(self.script)
+        agent = Agent(provider=provider, tools=load_tools(self.working_dir))
+        self.assertEqual(agent.run("Read main.py"), "Job's done.")
+        self.assertEqual(provider.calls, 2)
+
+    def test_run_streaming(self):
+        deltas = []
+        called = []
+        tools = [ToolSpec(name="record", description="", parameters={}, func=lambda value: called.append(value) or "ok", read_only=True)]
+        provider = FakeProvider([
+            Response(assistant_text="Recording first", tool_calls=[ToolCall(id=None, name="record", arguments={"value": 1})], usage=None),
+            # Tool calls after the done phrase are never dispatched
+            Response(assistant_text="All good. Job's done.", tool_calls=[ToolCall(id=None, name="record", arguments={"value": 2})], usage=None),
+        ])
+        agent = Agent(provider=provider, tools=tools)
+        out = agent.run("Record something", on_text=deltas.append)
+        self.assertEqual(out, "All good. Job's done.")
+        self.assertEqual(deltas, ["Recording ", "first", "All ", "good. ", "Job's ", "done."])
+        self.assertEqual(called, [1])
+
+    def test_streamed_calls_before_the_done_phrase(self):
+        class CallsFirst(FakeProvider):
+            def chat_stream(self, messages, tools):
+                response = self._next(messages)
+                yield ResponseChunk(tool_calls=response.tool_calls)
+                yield ResponseChunk(text=response.assistant_text, usage=response.usage)
+
+        called = []
+        tools = [ToolSpec(name="record", description="", parameters={}, func=lambda value: called.append(value) or "ok", read_only=True)]
+        script = [Response(assistant_text="Job's done.", tool_calls=[ToolCall(id=None, name="record", arguments={"value": 1})], usage=None)]
+        session = Session()
+        Agent(provider=CallsFirst(script), tools=tools).run("Record something", on_text=lambda delta: None, session=session)
+        # The call ran, so it is kept in the history along with its result
+        self.assertEqual(called, [1])
+        self.assertEqual(session.messages[-2].tool_calls, script[0].tool_calls)
+        self.assertEqual((session.messages[-1].role, session.messages[-1].payload), ("tool", {"result": "ok"}))
+
+        # Without streaming, the calls of the last response are dropped without running
+        session = Session()
+        Agent(provider=CallsFirst(script), tools=tools).run("Record something", session=session)
+        self.assertEqual(called, [1])
+        self.assertIsNone(session.messages[-1].tool_calls)
+
+    def test_scenario_file(self):
+        provider = FakeProvider.from_scenario("benchmarks/scenarios/calculator_fix.json")
+        out = Agent(provider=provider, tools=load_tools(self.working_dir)).run("Fix the calculator")
+        self.assertIn("Job's done.", out)
+        self.assertEqual(provider.calls, 5)
+
+    def test_reads_belong_to_the_session(self):
+        working_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(working_dir.cleanup)
+        write_file(working_dir.name, "big.txt", "line\n" * 2000)
+        read = Response(assistant_text="", tool_calls=[ToolCall(id=None, name="get_file_content", arguments={"file_path": "big.txt"})], usage=None)
+        script = [read, read, Response(assistant_text="Job's done.", tool_calls=[], usage=None)]
+        tools = load_tools(working_dir.name)
+
+        first = Session()
+        Agent(provider=FakeProvider(script), tools=tools).run("Read big.txt", session=first)
+        outputs = [m.content for m in first.messages if m.role == "tool"]
+        self.assertIn("is unchanged since you last read it", outputs[1])
+
+        # Another session sharing the tools has not read the file yet
+        second = Session()
+        Agent(provider=FakeProvider(script[1:]), tools=tools).run("Read big.txt", session=second)
+        self.assertNotIn("is unchanged", next(m.content for m in second.messages if m.role == "tool"))
+
+        # Once compaction elided the first output, the file is sent again
+        third = Session()
+        Agent(provider=FakeProvider(script), tools=tools, context=ContextManager(token_budget=1000, keep_recent=0)).run("Read big.txt", session=third)
+        outputs = [m.content for m in third.messages if m.role == "tool"]
+        self.assertIn("elided", outputs[0])
+        self.assertNotIn("is unchanged", outputs[1])
+
+    def test_arun_many_sessions(self):
+        agents = [
+            Agent(provider=FakeProvider(self.script, latency=0.05), tools=load_tools(self.working_dir))
+            for _ in range(20)
+        ]
+
+        async def run_all():
+            return await asyncio.gather(*(a.arun("Read main.py") for a in agents))
+
+        start = time.perf_counter()
+        results = asyncio.run(run_all())
+        elapsed = time.perf_counter() - start
+        self.assertEqual(results, ["Job's done."] * 20)
+        # 20 sessions with two model calls each would take at least 2 s when run one after another
+        self.assertLess(elapsed, 1.0)
+
+class TestSessions(unittest.TestCase):
+    def setUp(self):
+        self.session_dir = tempfile.TemporaryDirectory()
+        self.store = SessionStore(self.session_dir.name)
+        self.tools = [ToolSpec(name="count", description="", parameters={}, func=lambda n: f"counted {n}", read_only=True)]
+        self.script = [
+            Response(assistant_text="", tool_calls=[ToolCall(id=None, name="count", arguments={"n": 1})], usage=TokenUsage(input_count=10, output_count=1)),
+            Response(assistant_text="", tool_calls=[ToolCall(id=None, name="count", arguments={"n": 2})], usage=TokenUsage(input_count=20, output_count=2)),
+            Response(assistant_text="Job's done.", tool_calls=[], usage=TokenUsage(input_count=30, output_count=3)),
+        ]
+
+    def tearDown(self):
+        self.session_dir.cleanup()
+
+    def test_resume_after_max_steps(self):
+        session = self.store.create()
+        agent = Agent(provider=FakeProvider(self.script), tools=self.tools, system_prompt="Count")
+        self.assertEqual(agent.run("Count to two", max_steps=1, session=session), "")
+
+        # A new process picks up after the first step without calling the model for it again
+        resumed = self.store.load(session.id)
+        self.assertEqual((resumed.steps, resumed.input_tokens, resumed.done), (1, 10, False))
+        provider = FakeProvider(self.script[1:])
+        agent = Agent(provider=provider, tools=self.tools, system_prompt="Count")
+        self.assertEqual(agent.run(None, session=resumed), "Job's done.")
+        self.assertEqual(provider.calls, 2)
+
+        loaded = self.store.load(session.id)
+        self.assertEqual([m.role for m in loaded.messages], ["system", "user", "assistant", "tool", "assistant", "tool", "assistant"])
+        self.assertEqual(loaded.messages[4].tool_calls, [ToolCall(id=None, name="count", arguments={"n": 2})])
+        self.assertEqual(loaded.messages[5].content, '{"result": "counted 2"}')
+        self.assertEqual((loaded.steps, loaded.input_tokens, loaded.output_tokens, loaded.done), (3, 60, 6, True))
+        self.assertEqual(self.store.list(), [session.id])
+
+        # A finished session only continues with a follow-up
+        self.assertEqual(agent.run(None, session=loaded), "Job's done.")
+        self.assertEqual(provider.calls, 2)
+        agent.run("Now count to three", session=loaded)
+        self.assertEqual(loaded.messages[-2].content, "Now count to three")
+
+    def test_interrupted_checkpoint(self):
+        session = self.store.create()
+        Agent(provider=FakeProvider(self.script), tools=self.tools).run("Count", max_steps=2, session=session)
+        with open(session.path, "a") as f:
+            f.write('{"type":"message","message":{"role":"tool","cont')
+
+        loaded = self.store.load(session.id)
+        self.assertEqual(loaded.steps, 2)
+        self.assertEqual(len(loaded.messages), 5)
+        with self.assertRaises(KeyError):
+            self.store.load("../" + session.id)
+
+        # The resumed session continues on a fresh line
+        loaded.checkpoint(loaded.messages + [Message(role="user", content="More")])
+        loaded.checkpoint(loaded.messages + [Message(role="assistant", content="Done")])
+        reloaded = self.store.load(session.id)
+        self.assertEqual(reloaded.steps, 4)
+        self.assertEqual([m.content for m in reloaded.messages[-2:]], ["More", "Done"])
+
+    def test_rewritten_history(self):
+        session = self.store.create()
+        messages = [Message(role="user", content="Count"), Message(role="tool", content="x" * 1000, name="count")]
+        session.checkpoint(messages)
+        # As done by compaction
+        messages[1] = Message(role="tool", content="[stub]", name="count")
+        messages.append(Message(role="assistant", content="Done"))
+        session.checkpoint(messages)
+
+        loaded = self.store.load(session.id)
+        self.assertEqual([m.content for m in loaded.messages], ["Count", "[stub]", "Done"])
+        with open(session.path) as f:
+            self.assertEqual([json.loads(line)["type"] for line in f], ["message", "message", "step", "history", "step"])
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.exporter = MemoryExporter()
+        self.previous = set_tracer(Tracer([self.exporter]))
+
+    def tearDown(self):
+        set_tracer(self.previous)
+
+    def test_agent_spans(self):
+        tools = [ToolSpec(name="count", description="", parameters={}, func=lambda n: "x" * n, read_only=True)]
+        provider = FakeProvider([
+            Response(assistant_text="", tool_calls=[ToolCall(id=None, name="count", arguments={"n": n}) for n in (10, 20)], usage=None),
+            Response(assistant_text="Job's done.", tool_calls=[], usage=TokenUsage(input_count=50, output_count=5)),
+        ])
+        agent = Agent(provider=provider, tools=tools, max_tool_workers=2, context=ContextManager(token_budget=10000))
+        agent.run("Count", on_text=lambda delta: None)
+
+        steps = self.exporter.find("step")
+        self.assertEqual([s.attributes["step"] for s in steps], [0, 1])
+        calls = self.exporter.find("chat_stream")
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[1].attributes["input_tokens"], 50)
+        self.assertEqual(calls[1].attributes["payload_chars"], len("Count") + 2 * len('{"result": ""}') + 30)
+        self.assertIn("first_chunk_ms", calls[0].attributes)
+
+        # Tool calls run on pool threads, but are still nested in their step
+        counts = self.exporter.find("count")
+        self.assertEqual(sorted(s.attributes["result_chars"] for s in counts), [24, 34])
+        self.assertEqual({s.parent_id for s in counts}, {steps[0].span_id})
+        self.assertEqual(calls[0].parent_id, steps[0].span_id)
+        self.assertLessEqual(sum(s.duration_ns for s in counts), 2 * steps[0].duration_ns)
+        self.assertEqual(len(self.exporter.find("compact")), 2)
+
+    def test_message_conversion(self):
+        _to_gemini_messages([Message(role="user", content="Hi"), Message(role="assistant", content="Hello")])
+        self.assertEqual(self.exporter.find("convert_messages")[0].attributes, {"messages": 2, "converted": 2})
+
+    def test_errors_and_file_exporters(self):
+        with tempfile.TemporaryDirectory() as trace_dir:
+            jsonl_path = os.path.join(trace_dir, "trace.jsonl")
+            chrome_path = os.path.join(trace_dir, "trace.json")
+            tracer = Tracer([JsonlExporter(jsonl_path), ChromeTraceExporter(chrome_path)])
+            with tracer.span("outer", "agent", size=3):
+                with self.assertRaises(ValueError):
+                    with tracer.span("inner", "tool"):
+                        raise ValueError("boom")
+            tracer.close()
+
+            with open(jsonl_path) as f:
+                spans = [json.loads(line) for line in f]
+            self.assertEqual([s["name"] for s in spans], ["inner", "outer"])
+            self.assertEqual(spans[0]["attributes"], {"error": "ValueError: boom"})
+            self.assertEqual(spans[0]["parent_id"], spans[1]["span_id"])
+
+            # The array is left open so that traces of killed runs stay readable
+            with open(chrome_path) as f:
+                events = json.loads(f.read().rstrip(",\n") + "]")
+            self.assertEqual([(e["name"], e["ph"], e["args"]) for e in events], [("inner", "X", {"error": "ValueError: boom"}), ("outer", "X", {"size": 3})])
+
+    def test_disabled(self):
+        set_tracer(Tracer())
+        Agent(provider=FakeProvider([Response(assistant_text="Job's done.", tool_calls=[], usage=None)]), tools=[]).run("Hi")
+        self.assertEqual(self.exporter.spans, [])
+
+class _FlakyHandler(http.server.BaseHTTPRequestHandler):
+    # Answers with the queued (status, headers) pairs first, then with 200
+    def do_GET(self):
+        self.server.hits.append(self.path)
+        status, headers = self.server.failures.pop(0) if self.server.failures else (200, {})
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(b"ok" if status == 200 else b"error")
+
+    def log_message(self, format, *args):
+        pass
+
+class TestRequestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _FlakyHandler)
+        self.server.hits = []
+        self.server.failures = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, path="/"):
+        with urllib.request.urlopen(self.url + path, timeout=5) as response:
+            return response.read()
+
+    def test_retries_transient_errors(self):
+        self.server.failures = [(503, {}), (429, {"Retry-After": "0.3"})]
+        scheduler = RequestScheduler(base_delay=0.01)
+        start = time.perf_counter()
+        self.assertEqual(scheduler.call(self.fetch), b"ok")
+        self.assertGreaterEqual(time.perf_counter() - start, 0.3)
+        self.assertEqual(len(self.server.hits), 3)
+        self.assertEqual((scheduler.metrics.requests, scheduler.metrics.retries, scheduler.metrics.failures), (3, 2, 0))
+
+    def test_final_errors(self):
+        self.server.failures = [(400, {})]
+        scheduler = RequestScheduler(base_delay=0.01)
+        with self.assertRaises(urllib.error.HTTPError):
+            scheduler.call(self.fetch)
+
+        self.server.failures = [(500, {})] * 3
+        with self.assertRaises(urllib.error.HTTPError):
+            RequestScheduler(base_delay=0.01, max_retries=1).call(self.fetch)
+        self.assertEqual(len(self.server.hits), 3)
+        self.assertEqual(scheduler.metrics.failures, 1)
+
+    def test_classify_error(self):
+        self.assertEqual(classify_error(ConnectionResetError()), (True, None))
+        self.assertEqual(classify_error(ValueError()), (False, None))
+        error = Exception()
+        error.code = 429
+        error.details = {"error": {"code": 429, "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "31s"}]}}
+        self.assertEqual(classify_error(error), (True, 31.0))
+
+    def test_rate_limit_and_priorities(self):
+        # One request every 0.2 s, after the one in the bucket
+        scheduler = RequestScheduler(requests=TokenBucket(per_minute=300, capacity=1))
+        scheduler.call(self.fetch)
+
+        order = []
+        threads = []
+        for priority in (5, 9, 1):
+            thread = threading.Thread(target=scheduler.call, args=(lambda p=priority: order.append(p),), kwargs={"priority": priority})
+            thread.start()
+            threads.append(thread)
+            time.sleep(0.02)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(order, [1, 5, 9])
+        metrics = scheduler.metrics.snapshot()
+        self.assertEqual(metrics["requests"], 4)
+        self.assertGreaterEqual(metrics["queue_delay_max"], 0.5)
+
+    def test_token_limit_async(self):
+        # 6000 tokens per minute: a second 50-token request has to wait about 0.5 s
+        scheduler = RequestScheduler(tokens=TokenBucket(per_minute=6000, capacity=50))
+
+        async def request():
+            await asyncio.sleep(0)
+            return "done"
+
+        async def run_all():
+            return await asyncio.gather(*(scheduler.acall(request, tokens=50) for _ in range(2)))
+
+        start = time.perf_counter()
+        self.assertEqual(asyncio.run(run_all()), ["done", "done"])
+        self.assertGreaterEqual(time.perf_counter() - start, 0.45)
+
+    def test_scheduled_provider(self):
+        class FlakyProvider(FakeProvider):
+            failures = 2
+
+            def chat_stream(self, messages, tools):
+                if self.failures:
+                    self.failures -= 1
+                    raise ConnectionResetError("connection reset")
+                yield from super().chat_stream(messages, tools)
+
+        inner = FlakyProvider([Response(assistant_text="Job's done.", tool_calls=[], usage=TokenUsage(input_count=10, output_count=2))])
+        scheduler = RequestScheduler(base_delay=0.01, tokens=TokenBucket(per_minute=1000))
+        provider = ScheduledProvider(inner, scheduler=scheduler)
+        self.assertEqual(Agent(provider=provider, tools=[]).run("Hi", on_text=lambda delta: None), "Job's done.")
+        self.assertEqual(scheduler.metrics.retries, 2)
+        # The estimate was replaced by the actual usage
+        self.assertAlmostEqual(scheduler.tokens.level, 1000 - 12, delta=1)
+
+class _OpenAIStubHandler(http.server.BaseHTTPRequestHandler):
+    # Answers chat completion requests with the queued replies: a dict (JSON), a list of dicts (streamed as server-sent
+    # events) or a (status, headers) pair
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append((self.path, self.client_address[1], body))
+        reply = self.server.replies.pop(0)
+        # Simulates a server dropping idle connections without saying so; decided before replying, as the client may
+        # change the setting as soon as it has the reply
+        self.close_connection = self.server.drop_connections
+
+        if isinstance(reply, tuple):
+            status, headers = reply
+            data = json.dumps({"error": {"message": "slow down"}}).encode()
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif isinstance(reply, dict):
+            data = json.dumps(reply).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for event in [json.dumps(e) for e in reply] + ["[DONE]"]:
+                data = f"data: {event}\n\n".encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+class TestOpenAIProvider(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _OpenAIStubHandler)
+        self.server.requests = []
+        self.server.replies = []
+        self.server.drop_connections = False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.provider = OpenAIProvider(base_url=f"http://127.0.0.1:{self.server.server_address[1]}/v1", model="local", system_prompt="Be brief", api_key="secret")
+
+    def tearDown(self):
+        self.provider.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def completion(content=None, tool_calls=None):
+        message = {"role": "assistant", "content": content}
+        if tool_calls:
+            message["tool_calls"] = [
+                {"id": call_id, "type": "function", "function": {"name": name, "arguments": json.dumps(arguments)}}
+                for call_id, name, arguments in tool_calls
+            ]
+        return {"choices": [{"index": 0, "message": message, "finish_reason": "stop"}], "usage": {"prompt_tokens": 12, "completion_tokens": 3}}
+
+    def test_agent_tool_calls(self):
+        self.server.replies = [
+            self.completion(tool_calls=[("call_a", "get_file_content", {"file_path": "main.py"}), ("call_b", "get_files_info", {})]),
+            self.completion(content="Job's done."),
+        ]
+        out = Agent(provider=self.provider, tools=load_tools("calculator"), system_prompt="Be brief").run("Look around", max_steps=3)
+        self.assertEqual(out, "Job's done.")
+
+        (path, first_port, first), (_, second_port, second) = self.server.requests
+        self.assertEqual(path, "/v1/chat/completions")
+        self.assertEqual(first["model"], "local")
+        self.assertEqual({t["function"]["name"] for t in first["tools"]}, {t.name for t in load_tools("calculator")})
+        messages = second["messages"]
+        self.assertEqual([m["role"] for m in messages], ["system", "user", "assistant", "tool", "tool"])
+        self.assertEqual([c["id"] for c in messages[2]["tool_calls"]], ["call_a", "call_b"])
+        self.assertEqual(json.loads(messages[2]["tool_calls"][0]["function"]["arguments"]), {"file_path": "main.py"})
+        self.assertEqual([(m["tool_call_id"], m["name"]) for m in messages[3:]], [("call_a", "get_file_content"), ("call_b", "get_files_info")])
+
+        # Both requests went over the same keep-alive connection
+        self.assertEqual(first_port, second_port)
+        self.assertEqual(self.provider.pool.created, 1)
+
+    def test_calls_without_ids(self):
+        messages = [
+            Message(role="user", content="Hi"),
+            Message(role="assistant", content="", tool_calls=[ToolCall(id=None, name="a", arguments={}), ToolCall(id=None, name="b", arguments={})]),
+            Message(role="tool", name="a", content="{}"),
+            Message(role="tool", name="b", content="{}"),
+        ]
+        self.server.replies = [self.completion(content="ok")]
+        self.assertEqual(self.provider.chat(messages, []).assistant_text, "ok")
+        sent = self.server.requests[0][2]["messages"]
+        self.assertEqual(sent[0], {"role": "system", "content": "Be brief"})
+        self.assertEqual([c["id"] for c in sent[2]["tool_calls"]], [m["tool_call_id"] for m in sent[3:]])
+        self.assertNotIn("tools", self.server.requests[0][2])
+
+    def test_streaming(self):
+        self.server.replies = [
+            [
+                {"choices": [{"index": 0, "delta": {"role": "assistant", "content": "Reading "}}]},
+                {"choices": [{"index": 0, "delta": {"content": "it"}}]},
+                {"choices": [{"index": 0, "delta": {"tool_calls": [{"index": 0, "id": "call_a", "function": {"name": "get_file_content", "arguments": '{"file_'}}]}}]},
+                {"choices": [{"index": 0, "delta": {"tool_calls": [{"index": 0, "function": {"arguments": 'path": "main.py"}'}}]}}]},
+                {"choices": [{"index": 0, "delta": {}, "finish_reason": "tool_calls"}]},
+                {"choices": [], "usage": {"prompt_tokens": 40, "completion_tokens": 9, "prompt_tokens_details": {"cached_tokens": 32}}},
+            ],
+            self.completion(content="Job's done."),
+        ]
+        chunks = list(self.provider.chat_stream([Message(role="user", content="Read main.py")], []))
+        self.assertEqual([c.text for c in chunks if c.text], ["Reading ", "it"])
+        self.assertEqual([t for c in chunks for t in c.tool_calls], [ToolCall(id="call_a", name="get_file_content", arguments={"file_path": "main.py"})])
+        self.assertEqual(chunks[-1].usage, TokenUsage(input_count=40, output_count=9, cached_count=32))
+        self.assertTrue(self.server.requests[0][2]["stream"])
+
+        # The connection is reused after the stream
+        self.provider.chat([Message(role="user", content="Hi")], [])
+        self.assertEqual(self.provider.pool.created, 1)
+
+    def test_errors_and_dropped_connections(self):
+        self.server.replies = [(429, {"Retry-After": "7"})]
+        with self.assertRaises(OpenAIError) as caught:
+            self.provider.chat([Message(role="user", content="Hi")], [])
+        self.assertEqual(str(caught.exception), "429: slow down")
+        self.assertEqual(classify_error(caught.exception), (True, 7.0))
+
+        # A request on a connection the server has closed in the meantime is repeated on a new one
+        self.server.drop_connections = True
+        self.server.replies = [self.completion(content="one"), self.completion(content="two")]
+        self.assertEqual(self.provider.chat([Message(role="user", content="Hi")], []).assistant_text, "one")
+        self.assertEqual(self.provider.chat([Message(role="user", content="Hi")], []).assistant_text, "two")
+        self.assertEqual(self.provider.pool.created, 2)
+
+def _batch_provider():
+    # Writes a file named after the prompt, then finishes; module-level so that worker processes can unpickle it
+    class PromptProvider(FakeProvider):
+        def chat(self, messages, tools):
+            if messages[-1].role == "tool":
+                return Response(assistant_text="Job's done.", tool_calls=[], usage=TokenUsage(input_count=20, output_count=2))
+            call = ToolCall(id=None, name="write_file", arguments={"file_path": "out.txt", "content": messages[-1].content})
+            return Response(assistant_text="", tool_calls=[call], usage=TokenUsage(input_count=10, output_count=1))
+
+    return PromptProvider([Response(assistant_text="", tool_calls=[], usage=None)])
+
+def _batch_agent(provider, working_directory):
+    return Agent(provider=provider, tools=load_tools(working_directory))
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.source = tempfile.TemporaryDirectory()
+        self.workspaces = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.source.name, "pkg"))
+        with open(os.path.join(self.source.name, "pkg", "calc.py"), "w") as f:
+            f.write("VALUE = 1\n")
+        with open(os.path.join(self.source.name, "out.txt"), "w") as f:
+            f.write("original")
+
+    def tearDown(self):
+        self.source.cleanup()
+        self.workspaces.cleanup()
+
+    def test_workspace_modes(self):
+        for link in ("reflink", "hardlink", "copy"):
+            destination = os.path.join(self.workspaces.name, link)
+            used = create_workspace(self.source.name, destination, link)
+            self.assertIn(used, (link, "copy"))
+            with open(os.path.join(destination, "pkg", "calc.py")) as f:
+                self.assertEqual(f.read(), "VALUE = 1\n")
+            linked = os.stat(os.path.join(destination, "out.txt")).st_ino == os.stat(os.path.join(self.source.name, "out.txt")).st_ino
+            self.assertEqual(linked, used == "hardlink")
+
+    def test_run_batch(self):
+        tasks_path = os.path.join(self.workspaces.name, "tasks.jsonl")
+        with open(tasks_path, "w") as f:
+            for n in range(4):
+                f.write(json.dumps({"id": f"task {n}", "prompt": f"content {n}", "working_directory": self.source.name}) + "\n")
+            f.write(json.dumps({"prompt": "broken", "working_directory": os.path.join(self.source.name, "missing"), "max_steps": 3}) + "\n")
+        tasks = load_tasks(tasks_path)
+        self.assertEqual(tasks[4], BatchTask(id="5", prompt="broken", working_directory=os.path.join(self.source.name, "missing"), max_steps=3))
+
+        output = io.StringIO()
+        # Hard links are safe for the agent's own writes, which replace files instead of modifying them
+        summary = run_batch(tasks, _batch_provider, _batch_agent, output, workers=2, workspace_root=self.workspaces.name, link="hardlink")
+        results = {r["id"]: r for r in map(json.loads, output.getvalue().splitlines())}
+
+        self.assertEqual((summary.tasks, summary.done, summary.incomplete, summary.failed), (5, 4, 0, 1))
+        self.assertEqual((summary.input_tokens, summary.output_tokens), (120, 12))
+        self.assertGreater(summary.tasks_per_minute, 0)
+        self.assertEqual(results["5"]["status"], "error")
+        for n in range(4):
+            result = results[f"task {n}"]
+            self.assertEqual((result["status"], result["steps"], result["response"]), ("done", 2, "Job's done."))
+            with open(os.path.join(result["workspace"], "out.txt")) as f:
+                self.assertEqual(f.read(), f"content {n}")
+        with open(os.path.join(self.source.name, "out.txt")) as f:
+            self.assertEqual(f.read(), "original")
+
+class TestGeminiRequestCache(unittest.TestCase):
+    def setUp(self):
+        self.provider = GeminiProvider(api_key="offline", system_prompt="system")
+        self.tools = load_tools("calculator")
+
+    def test_tool_bundle_is_cached(self):
+        first = self.provider._request([Message(role="user", content="hi")], self.tools)["config"].tools[0]
+        second = self.provider._request([Message(role="user", content="hi")], self.tools)["config"].tools[0]
+        self.assertIs(first, second)
+
+    def test_incremental_conversion_matches_full_conversion(self):
+        messages = [Message(role="system", content="system"), Message(role="user", content="hi")]
+        for i in range(5):
+            messages.append(Message(role="assistant", content=f"step {i}"))
+            messages.append(Message(role="tool", name="get_files_info", content=f'{{"result": "{i}"}}'))
+            contents = self.provider._request(messages, self.tools)["contents"]
+            self.assertEqual(contents, _to_gemini_messages(messages))
+
+        # Replacing an earlier message invalidates everything from that point on
+        messages[3] = Message(role="tool", name="get_files_info", content='{"result": "replaced"}')
+        contents = self.provider._request(messages, self.tools)["contents"]
+        self.assertEqual(contents, _to_gemini_messages(messages))
+
+    def test_function_calls(self):
+        contents = _to_gemini_messages([Message(role="assistant", content="Looking", tool_calls=[ToolCall(id=None, name="get_files_info", arguments={"directory": "pkg"})])])
+        self.assertEqual(contents[0].role, "model")
+        self.assertEqual(contents[0].parts[0].text, "Looking")
+        self.assertEqual((contents[0].parts[1].function_call.name, contents[0].parts[1].function_call.args), ("get_files_info", {"directory": "pkg"}))
+
+class _StubGeminiClient:
+    """
+    An offline stand-in for the models and caches surface of genai.Client, recording the requests
+    """
+    def __init__(self, fail_caching=False):
+        self.models = self
+        self.caches = self
+        self.fail_caching = fail_caching
+        self.requests = []
+        self.created = []
+        self.deleted = []
+
+    def create(self, model, config):
+        if self.fail_caching:
+            raise genai_errors.ClientError(400, {"error": {"code": 400, "message": "too small", "status": "INVALID_ARGUMENT"}})
+        self.created.append(config)
+        return genai_types.CachedContent(name=f"cachedContents/{len(self.created)}", model=model)
+
+    def delete(self, name):
+        self.deleted.append(name)
+
+    def generate_content(self, model, contents, config):
+        self.requests.append((contents, config))
+        cached = 1000 if config.cached_content else 0
+        return genai_types.GenerateContentResponse(
+            candidates=[genai_types.Candidate(content=genai_types.Content(role="model", parts=[genai_types.Part(text="ok")]))],
+            usage_metadata=genai_types.GenerateContentResponseUsageMetadata(prompt_token_count=cached + len(contents), candidates_token_count=1, cached_content_token_count=cached or None),
+        )
+
+class TestGeminiContextCache(unittest.TestCase):
+    def setUp(self):
+        self.client = _StubGeminiClient()
+        self.provider = GeminiProvider(api_key=None, system_prompt="system", client=self.client, context_cache=True)
+        self.tools = load_tools("calculator")
+        self.messages = [Message(role="system", content="system"), Message(role="user", content="x" * 20000)]
+
+    def _step(self, text="step"):
+        self.messages.append(Message(role="assistant", content=text))
+        self.messages.append(Message(role="tool", name="get_files_info", content='{"result": "ok"}'))
+        return self.provider.chat(self.messages, self.tools).usage
+
+    def test_prefix_is_cached_and_reused(self):
+        usage = self.provider.chat(self.messages, self.tools).usage
+        # Nothing but the newest message yet
+        self.assertIsNone(usage.cache_hit)
+        self.assertEqual(self.client.requests[-1][1].system_instruction, "system")
+
+        usage = self._step()
+        self.assertEqual((usage.cache_hit, usage.cached_count), (False, 1000))
+        config = self.client.created[0]
+        self.assertEqual((len(config.contents), config.system_instruction, config.ttl), (2, "system", "600s"))
+        self.assertEqual(len(config.tools[0].function_declarations), len(self.tools))
+        contents, request = self.client.requests[-1]
+        self.assertEqual((len(contents), request.cached_content, request.system_instruction, request.tools), (1, "cachedContents/1", None, None))
+
+        usage = self._step()
+        self.assertTrue(usage.cache_hit)
+        self.assertEqual(len(self.client.requests[-1][0]), 3)
+        self.assertEqual(len(self.client.created), 1)
+
+    def test_compaction_refreshes_the_prefix(self):
+        self._step()
+        self._step()
+        self.messages[2] = Message(role="assistant", content="compacted")
+        usage = self._step()
+        self.assertFalse(usage.cache_hit)
+        self.assertEqual(len(self.client.created), 2)
+        self.assertEqual(self.client.deleted, ["cachedContents/1"])
+        self.provider.close()
+        self.assertEqual(self.client.deleted, ["cachedContents/1", "cachedContents/2"])
+
+    def test_wrappers_forward_close(self):
+        self._step()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            CachingProvider(ScheduledProvider(self.provider, scheduler=RequestScheduler()), cache_dir=cache_dir).close()
+        self.assertEqual(self.client.deleted, ["cachedContents/1"])
+
+    def test_small_prefixes_and_failures_are_not_cached(self):
+        self.messages[1] = Message(role="user", content="short")
+        self.assertIsNone(self._step().cache_hit)
+        self.assertEqual(self.client.created, [])
+
+        provider = GeminiProvider(api_key=None, system_prompt="system", client=_StubGeminiClient(fail_caching=True), context_cache=True)
+        self.messages[1] = Message(role="user", content="x" * 20000)
+        self.assertIsNone(provider.chat(self.messages, self.tools).usage.cache_hit)
+        self.assertEqual(provider.client.requests[-1][1].system_instruction, "system")
+
+class TestContextManager(unittest.TestCase):
+    def setUp(self):
+        def read(path, body):
+            return Message(role="tool", name="get_file_content", content=json.dumps({"result": body}), arguments={"file_path": path})
+
+        self.messages = [
+            Message(role="system", content="system"),
+            Message(role="user", content="task"),
+            read("a.py", "a" * 4000),
+            read("b.py", "b" * 4000),
+            read("a.py", "A" * 4000),
+            Message(role="assistant", content="done reading"),
+        ]
+
+    def test_within_budget_is_untouched(self):
+        before = list(self.messages)
+        ContextManager(token_budget=100_000).compact(self.messages)
+        self.assertEqual([m is b for m, b in zip(self.messages, before)], [True] * len(before))
+
+    def test_superseded_outputs_go_first(self):
+        total = ContextManager(token_budget=2500, keep_recent=1, target_ratio=0.9).compact(self.messages)
+        self.assertLessEqual(total, 2250)
+        self.assertEqual(total, estimate_messages_tokens(self.messages))
+        self.assertIn("superseded", self.messages[2].content)
+        # The newer read of a.py and the unrelated b.py are kept
+        self.assertTrue("A" * 4000 in self.messages[4].content)
+        self.assertTrue("b" * 4000 in self.messages[3].content)
+
+    def test_summarizer(self):
+        summarized = []
+        def summarize(msgs):
+            summarized.extend(msgs)
+            return "read a.py and b.py"
+
+        ContextManager(token_budget=100, keep_recent=1, summarizer=summarize).compact(self.messages)
+        self.assertEqual(len(summarized), 3)
+        self.assertEqual([m.role for m in self.messages], ["system", "user", "user", "assistant"])
+        self.assertIn("read a.py and b.py", self.messages[2].content)
+
+class TestBlobStore(unittest.TestCase):
+    def setUp(self):
+        self.tools = [ToolSpec(name="read", description="", parameters={}, func=lambda file_path: "x" * 500, read_only=True, path_arg="file_path")]
+
+    def test_identical_outputs_are_shared(self):
+        blobs = BlobStore()
+        messages = ToolExecutor(self.tools, blobs=blobs).execute([
+            ToolCall(id=None, name="read", arguments={"file_path": "a.py"}),
+            ToolCall(id=None, name="read", arguments={"file_path": "b.py"}),
+        ])
+        self.assertIs(messages[0].content, messages[1].content)
+        self.assertIs(messages[0].payload, messages[1].payload)
+        self.assertEqual(messages[0].payload, {"result": "x" * 500})
+        self.assertEqual(json.loads(messages[0].content), messages[0].payload)
+        self.assertEqual((len(blobs), blobs.hits, blobs.saved_chars), (1, 1, len(messages[0].content)))
+
+    def test_eviction(self):
+        blobs = BlobStore(max_bytes=100)
+        first = blobs.put({"result": "a" * 60})
+        blobs.put({"result": "b" * 60})
+        self.assertIsNone(blobs.get(first.digest))
+        self.assertIsNot(blobs.put({"result": "a" * 60}), first)
+
+    def test_references(self):
+        executor = ToolExecutor(self.tools, blobs=BlobStore())
+        history = [Message(role="user", content="task")] + executor.execute([ToolCall(id=None, name="read", arguments={"file_path": "a.py"})])
+        results = reference_repeats(history, executor.execute([
+            ToolCall(id=None, name="read", arguments={"file_path": "a.py"}),
+            ToolCall(id=None, name="read", arguments={"file_path": "c.py"}),
+        ]))
+        self.assertEqual(results[0].payload, {"result": "[Same output as the earlier call read(file_path='a.py') (514 characters).]"})
+        self.assertEqual(json.loads(results[1].content), results[1].payload)
+        self.assertEqual(results[1].digest, history[1].digest)
+
+        # Compaction keeps the output a later call refers to
+        history.extend(results)
+        ContextManager(token_budget=10, keep_recent=0, min_stub_chars=100).compact(history)
+        self.assertNotIn("superseded", history[1].content)
+        # but once it truncates that output, the references to it go as well
+        self.assertIn("characters of old output elided", history[1].content)
+        for m in history[2:]:
+            self.assertEqual(m.payload, {"result": f"[Output of {m.name}(file_path={m.arguments['file_path']!r}) elided (514 characters, old output). Call the tool again if you need it.]"})
+            self.assertIsNone(m.digest)
+
+    def test_references_to_summarized_outputs(self):
+        executor = ToolExecutor(self.tools, blobs=BlobStore())
+        history = [Message(role="user", content="task")] + executor.execute([ToolCall(id=None, name="read", arguments={"file_path": "a.py"})])
+        history.append(Message(role="assistant", content="read a.py"))
+        history.append(Message(role="assistant", content="now b.py"))
+        history.extend(reference_repeats(history, executor.execute([ToolCall(id=None, name="read", arguments={"file_path": "b.py"})])))
+        self.assertIn("Same output", history[4].content)
+        ContextManager(token_budget=10, keep_recent=1, summarizer=lambda msgs: "read a.py").compact(history)
+        self.assertEqual([m.role for m in history], ["user", "user", "assistant", "tool"])
+        self.assertIn("elided (514 characters", history[3].content)
+
+    def test_agent(self):
+        provider = FakeProvider([
+            Response(assistant_text="", tool_calls=[ToolCall(id=None, name="read", arguments={"file_path": "a.py"})], usage=None),
+            Response(assistant_text="", tool_calls=[ToolCall(id=None, name="read", arguments={"file_path": "a.py"})], usage=None),
+            Response(assistant_text="Job's done.", tool_calls=[], usage=None),
+        ])
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        store = SessionStore(directory.name)
+        session = store.create()
+        Agent(provider=provider, tools=self.tools, dedupe_outputs=True).run("Read twice", session=session)
+        tool_messages = [m for m in session.messages if m.role == "tool"]
+        self.assertIn("[Same output", tool_messages[1].content)
+
+        # Payloads are restored, and repeated outputs are shared again, when a session is loaded
+        loaded = store.load(session.id)
+        loaded_tools = [m for m in loaded.messages if m.role == "tool"]
+        self.assertEqual([m.payload for m in loaded_tools], [m.payload for m in tool_messages])
+        self.assertEqual([m.digest for m in loaded_tools], [m.digest for m in tool_messages])
+
+class TestCachingProvider(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.script = [
+            Response(assistant_text="", tool_calls=[ToolCall(id=None, name="get_files_info", arguments={"directory": "pkg"})], usage=None),
+            Response(assistant_text="Job's done.", tool_calls=[], usage=None),
+        ]
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_record_then_replay(self):
+        recorder = CachingProvider(FakeProvider(self.script), cache_dir=self.cache_dir.name)
+        out = Agent(provider=recorder, tools=load_tools("calculator")).run("List pkg")
+        self.assertEqual((recorder.hits, recorder.misses), (0, 2))
+
+        # The wrapped provider would answer differently, so the same result proves both steps came from the cache
+        player = CachingProvider(FakeProvider([Response(assistant_text="live", tool_calls=[], usage=None)]), cache_dir=self.cache_dir.name, replay=True)
+        self.assertEqual(Agent(provider=player, tools=load_tools("calculator")).run("List pkg"), out)
+        self.assertEqual((player.hits, player.misses), (2, 0))
+        self.assertEqual(player.provider.calls, 0)
+
+    def test_replay_miss(self):
+        player = CachingProvider(FakeProvider(self.script), cache_dir=self.cache_dir.name, replay=True)
+        with self.assertRaises(CacheMissError):
+            player.chat([Message(role="user", content="never recorded")], [])
+
+    def test_lru_eviction(self):
+        provider = CachingProvider(FakeProvider([Response(assistant_text="x" * 100, tool_calls=[], usage=None)]), cache_dir=self.cache_dir.name, max_bytes=500)
+        for i in range(10):
+            provider.chat([Message(role="user", content=str(i))], [])
+            # mtime based recency needs distinguishable timestamps
+            time.sleep(0.01)
+        self.assertLessEqual(sum(e.stat().st_size for e in os.scandir(self.cache_dir.name)), 500)
+        # The most recent request is still cached
+        provider.chat([Message(role="user", content="9")], [])
+        self.assertEqual(provider.provider.calls, 10)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file